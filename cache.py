@@ -22,12 +22,17 @@ from tradeexcept import TradeException
 
 import corrections
 import csv
+import hashlib
 import math
+import multiprocessing
+import operator
 import os
 import prices
 import re
+import shutil
 import sqlite3
 import sys
+import time
 import tradedb
 
 ######################################################################
@@ -308,6 +313,11 @@ class BuildCacheBaseException(TradeException):
                 self.error,
         )
 
+    def __reduce__(self):
+        # Rebuilt from the attributes rather than __init__'s arguments
+        # when they come back from a process parsing a .csv file.
+        return (self.__class__.__new__, (self.__class__,), self.__dict__)
+
 
 class UnknownSystemError(BuildCacheBaseException):
     """
@@ -479,6 +489,31 @@ def getItemByNameIndex(cur):
     return { name: itemID for (itemID, name) in cur }
 
 
+# Upper-cases the way sqlite's UPPER() does, and so its NOCASE collation:
+# only a-z.
+asciiUpper = {ch: ch - 32 for ch in range(ord('a'), ord('z') + 1)}
+
+
+def getForeignKeyIndex(db, srcKey, tableJoins, lookupColumns):
+    """
+        Build an index of the values of srcKey ("Table.column") by
+        the upper-cased values of lookupColumns, from tableJoins.
+    """
+    cur = db.execute("""
+            SELECT {lookups}, {key}
+              FROM {tables}
+        """.format(
+            lookups=",".join(
+                "UPPER({})".format(column) for column in lookupColumns
+            ),
+            key=srcKey,
+            tables=" ".join(tableJoins),
+        ))
+    if len(lookupColumns) == 1:
+        return { lookup: key for (lookup, key) in cur }
+    return { tuple(row[:-1]): row[-1] for row in cur }
+
+
 def checkForOcrDerp(tdenv, systemName, stationName):
     match = ocrDerp.search(stationName.upper())
     if match:
@@ -490,10 +525,16 @@ def checkForOcrDerp(tdenv, systemName, stationName):
     return None
 
 
-def processPrices(tdenv, priceFile, db, defaultZero):
+def processPrices(tdenv, priceFile, db, defaultZero, counts):
     """
-        Yields SQL for populating the database with prices
-        by reading the file handle for price lines.
+        Reads the file handle for price lines and yields
+        (stationID, items, zeros) for each station in turn: the
+        StationItem rows to add or replace, and the (station, item)
+        pairs to remove. Only one station's prices are held at a time,
+        apart from stations that can be listed twice (see holdStation).
+
+        The numbers of new, updated and ignored items and of systems
+        are put in counts at the end.
     """
 
     DEBUG0, DEBUG1 = tdenv.DEBUG0, tdenv.DEBUG1
@@ -517,6 +558,16 @@ def processPrices(tdenv, priceFile, db, defaultZero):
         for stn, alt in corrections.stations.items()
         if isinstance(alt, str)
     }
+    # A station can only be listed twice if one of the entries is under
+    # a name that gets corrected to it.
+    correctedSystems = set(
+        alt.upper() for alt in sysCorrections.values()
+        if isinstance(alt, str)
+    )
+    correctedStations = set(
+        "/".join((stn.partition('/')[0], alt.upper()))
+        for stn, alt in stnCorrections.items()
+    )
 
     itemByName = getItemByNameIndex(cur)
 
@@ -529,6 +580,8 @@ def processPrices(tdenv, priceFile, db, defaultZero):
     processedSystems = set()
     processedItems = {}
     stationItemDates = {}
+    mayRepeat = False
+    heldStations = {}
     itemPrefix = ""
     DELETED = corrections.DELETED
     items, zeros, buys, sells = [], [], [], []
@@ -543,7 +596,7 @@ def processPrices(tdenv, priceFile, db, defaultZero):
     def changeStation(matches):
         nonlocal facility, stationID
         nonlocal processedStations, processedItems, localAdd
-        nonlocal stationItemDates
+        nonlocal stationItemDates, mayRepeat
 
         ### Change current station
         stationItemDates = {}
@@ -629,6 +682,11 @@ def processPrices(tdenv, priceFile, db, defaultZero):
                 )
 
         stationID = newID
+        mayRepeat = (
+            corrected
+            or systemName in correctedSystems
+            or facility in correctedStations
+        )
         processedSystems.add(systemName)
         processedStations[stationID] = lineNo
         processedItems = {}
@@ -732,6 +790,22 @@ def processPrices(tdenv, priceFile, db, defaultZero):
 
         processedItems[itemID] = lineNo
 
+    def isStation():
+        return stationID and stationID != DELETED
+
+    def holdStation():
+        """
+        Keeps the prices of a station that may be listed again until
+        the end, so that all of its entries are checked against what
+        the DB held before the import and written together.
+        """
+        if stationID not in heldStations:
+            heldStations[stationID] = (items, zeros)
+        else:
+            heldItems, heldZeros = heldStations[stationID]
+            heldItems.extend(items)
+            heldZeros.extend(zeros)
+
     for line in priceFile:
         lineNo += 1
         text, _, comment = line.partition('#')
@@ -752,6 +826,13 @@ def processPrices(tdenv, priceFile, db, defaultZero):
                 raise SyntaxError("Unrecognized '@' line: {}".format(
                             text
                         ))
+            if isStation():
+                if mayRepeat:
+                    holdStation()
+                else:
+                    yield stationID, items, zeros
+                items, zeros = [], []
+                addItem, addZero = items.append, zeros.append
             changeStation(matches)
             continue
 
@@ -778,7 +859,13 @@ def processPrices(tdenv, priceFile, db, defaultZero):
 
         processItemLine(matches)
 
-    numSys = len(processedSystems)
+    if isStation():
+        if mayRepeat:
+            holdStation()
+        else:
+            yield stationID, items, zeros
+    for stationID, (items, zeros) in heldStations.items():
+        yield stationID, items, zeros
 
     if localAdd > 0:
         tdenv.NOTE(
@@ -788,46 +875,79 @@ def processPrices(tdenv, priceFile, db, defaultZero):
             "if you /need/ to persist them."
         )
 
-    stations = tuple((ID,) for ID in processedStations.keys())
-    return stations, items, zeros, newItems, updtItems, ignItems, numSys
+    counts.update(
+        new=newItems, updated=updtItems, ignored=ignItems,
+        systems=len(processedSystems),
+    )
 
 
 ######################################################################
 
+# How many StationItem rows processPricesFile writes at a time.
+pricesChunkSize = 10000
+
+
 def processPricesFile(tdenv, db, pricesPath, pricesFh=None, defaultZero=False):
+    """
+        Imports a .prices file, writing the prices a few thousand
+        at a time as they are read so that memory use doesn't grow
+        with the size of the file. If anything goes wrong, none of
+        it is kept.
+    """
     tdenv.DEBUG0("Processing Prices file '{}'", pricesPath)
 
-    with pricesFh or pricesPath.open('rU', encoding='utf-8') as pricesFh:
-        stations, items, zeros, newItems, updtItems, ignItems, numSys = processPrices(
-            tdenv, pricesFh, db, defaultZero
-        )
+    merging = tdenv.mergeImport
+    counts = {}
+    stations = set()
+    removedItems = 0
+    newStations, zeros, items = [], [], []
+
+    def writeChunk():
+        if newStations:
+            db.executemany("""
+                DELETE FROM StationItem
+                 WHERE station_id = ?
+            """, newStations)
+        if zeros:
+            db.executemany("""
+                DELETE FROM StationItem
+                 WHERE station_id = ?
+                   AND item_id = ?
+            """, zeros)
+        if items:
+            db.executemany("""
+                INSERT OR REPLACE INTO StationItem (
+                    station_id, item_id, modified,
+                    demand_price, demand_units, demand_level,
+                    supply_price, supply_units, supply_level
+                ) VALUES (
+                    ?, ?, IFNULL(?, CURRENT_TIMESTAMP),
+                    ?, ?, ?,
+                    ?, ?, ?
+                )
+            """, items)
+        newStations.clear()
+        zeros.clear()
+        items.clear()
 
-    if not tdenv.mergeImport:
-        db.executemany("""
-            DELETE FROM StationItem
-             WHERE station_id = ?
-        """, stations)
-    if zeros:
-        db.executemany("""
-            DELETE FROM StationItem
-             WHERE station_id = ?
-               AND item_id = ?
-        """, zeros)
-    removedItems = len(zeros)
-
-    if items:
-        db.executemany("""
-            INSERT OR REPLACE INTO StationItem (
-                station_id, item_id, modified,
-                demand_price, demand_units, demand_level,
-                supply_price, supply_units, supply_level
-            ) VALUES (
-                ?, ?, IFNULL(?, CURRENT_TIMESTAMP),
-                ?, ?, ?,
-                ?, ?, ?
-            )
-        """, items)
-    updatedItems = len(items)
+    with pricesFh or pricesPath.open('rU', encoding='utf-8') as pricesFh:
+        try:
+            for stationID, stnItems, stnZeros in processPrices(
+                    tdenv, pricesFh, db, defaultZero, counts
+                    ):
+                if stationID not in stations:
+                    stations.add(stationID)
+                    if not merging:
+                        newStations.append((stationID,))
+                zeros.extend(stnZeros)
+                items.extend(stnItems)
+                removedItems += len(stnZeros)
+                if len(items) + len(zeros) >= pricesChunkSize:
+                    writeChunk()
+            writeChunk()
+        except Exception:
+            db.rollback()
+            raise
 
     tdenv.DEBUG0("Marking populated stations as having a market")
     db.execute(
@@ -841,8 +961,8 @@ def processPricesFile(tdenv, db, pricesPath, pricesFh=None, defaultZero=False):
     db.commit()
 
     changes = " and ".join("{} {}".format(v, k) for k, v in {
-        "new": newItems,
-        "updated": updtItems,
+        "new": counts['new'],
+        "updated": counts['updated'],
         "removed": removedItems,
     }.items() if v) or "0"
 
@@ -853,11 +973,11 @@ def processPricesFile(tdenv, db, pricesPath, pricesFh=None, defaultZero=False):
             "in {:n} systems",
                 changes,
                 len(stations),
-                numSys,
+                counts['systems'],
     )
 
-    if ignItems:
-        tdenv.NOTE("Ignored {} items with old data", ignItems)
+    if counts['ignored']:
+        tdenv.NOTE("Ignored {} items with old data", counts['ignored'])
 
 
 ######################################################################
@@ -907,85 +1027,35 @@ def deprecationCheckItem(importPath, lineNo, line):
     )
 
 
-def processImportFile(tdenv, db, importPath, tableName):
-    tdenv.DEBUG0(
-        "Processing import file '{}' for table '{}'",
-        str(importPath), tableName
-    )
+def parseImportFile(importPath, tableName, ignoreUnknown):
+    """
+        Reads and checks a .csv file for tableName without going near
+        the database, so that it can be done in another process.
+
+        Yields the column definitions, then what is found as it goes,
+        in file order: ("rows", lineNos, lines) batches to be inserted,
+        ("warning", error) and ("columns", lineNo, line) to be reported,
+        and ("error", error) to stop at. Yields nothing for an empty
+        file.
+    """
 
-    fkeySelectStr = ("("
-            "SELECT {newValue}"
-            " FROM {table}"
-            " WHERE {stmt}"
-            ")"
-    )
     uniquePfx = "unq:"
-    uniqueLen = len(uniquePfx)
-    ignorePfx = "!"
+    batchSize = 10000
 
     with importPath.open('rU', encoding='utf-8') as importFile:
         csvin = csv.reader(
             importFile, delimiter=',', quotechar="'", doublequote=True
         )
         # first line must be the column names
-        columnDefs = next(csvin)
+        columnDefs = next(csvin, None)
+        if columnDefs is None:
+            return
+        yield columnDefs
         columnCount = len(columnDefs)
-
-        # split up columns and values
-        # this is necessqary because the insert might use a foreign key
-        bindColumns = []
-        bindValues  = []
-        joinHelper  = []
-        uniqueIndexes = []
-        for (cIndex, cName) in enumerate(columnDefs):
-            colName, _, srcKey = cName.partition('@')
-            # is this a unique index?
-            if colName.startswith(uniquePfx):
-                uniqueIndexes.append(cIndex)
-                colName = colName[uniqueLen:]
-            if not srcKey:
-                # no foreign key, straight insert
-                bindColumns.append(colName)
-                bindValues.append('?')
-                continue
-
-            queryTab, _, queryCol = srcKey.partition('.')
-            if colName.startswith(ignorePfx):
-                # this column is only used to resolve an FK
-                assert srcKey
-                colName = colName[len(ignorePfx):]
-                joinHelper.append((colName, queryTab, queryCol))
-                continue
-
-            # foreign key, we need to make a select
-            joinTable = [ queryTab ]
-            joinStmt  = []
-            for nextCol, nextTab, nextJoin in joinHelper:
-                joinTable.append(
-                    "INNER JOIN {} USING({})".format(nextTab, nextJoin)
-                )
-                joinStmt.append(
-                    "{}.{} = ?".format(nextTab, nextCol)
-                )
-            joinHelper = []
-            joinStmt.append("{}.{} = ?".format(queryTab, colName))
-            bindColumns.append(queryCol)
-            bindValues.append(
-                fkeySelectStr.format(
-                    newValue=srcKey,
-                    table=" ".join(joinTable),
-                    stmt=" AND ".join(joinStmt),
-                )
-            )
-        # now we can make the sql statement
-        sql_stmt = """
-            INSERT INTO {table} ({columns}) VALUES({values})
-        """.format(
-                table=tableName,
-                columns=','.join(bindColumns),
-                values=','.join(bindValues)
-            )
-        tdenv.DEBUG0("SQL-Statement: {}", sql_stmt)
+        uniqueIndexes = [
+            cIndex for (cIndex, cName) in enumerate(columnDefs)
+            if cName.startswith(uniquePfx)
+        ]
 
         # Check if there is a deprecation check for this table.
         deprecationFn = getattr(
@@ -994,24 +1064,34 @@ def processImportFile(tdenv, db, importPath, tableName):
             None
         )
 
-        # import the data
-        importCount = 0
+        steps = []
         uniqueIndex = dict()
+        batch, batchLineNos = [], []
+
+        def endBatch():
+            nonlocal batch, batchLineNos
+            if batch:
+                steps.append(("rows", batchLineNos, batch))
+                batch, batchLineNos = [], []
 
         for linein in csvin:
+            if steps:
+                yield from steps
+                steps.clear()
             if not linein:
                 continue
             lineNo = csvin.line_num
             if len(linein) == columnCount:
-                tdenv.DEBUG1("       Values: {}", ', '.join(linein))
                 if deprecationFn:
                     try:
                         deprecationFn(importPath, lineNo, linein)
                     except (DeprecatedKeyError, DeletedKeyError) as e:
-                        if not tdenv.ignoreUnknown:
-                            raise e
+                        endBatch()
+                        if not ignoreUnknown:
+                            steps.append(("error", e))
+                            break
                         e.category = "WARNING"
-                        tdenv.NOTE("{}", e)
+                        steps.append(("warning", e))
                         continue
                 if uniqueIndexes:
                     # Need to construct the actual unique index key as
@@ -1024,48 +1104,380 @@ def processImportFile(tdenv, db, importPath, tableName):
                     key = ":!:".join(keyValues)
                     prevLineNo = uniqueIndex.get(key, 0)
                     if prevLineNo:
+                        endBatch()
                         # Make a human-readable key
                         key = "/".join(keyValues)
-                        raise DuplicateKeyError(
+                        steps.append(("error", DuplicateKeyError(
                             importPath, lineNo,
                             "entry", key,
                             prevLineNo
-                        )
+                        )))
+                        break
                     uniqueIndex[key] = lineNo
 
-                try:
-                    db.execute(sql_stmt, linein)
-                except Exception as e:
-                    raise SystemExit(
-                        "*** INTERNAL ERROR: {err}\n"
-                        "CSV File: {file}:{line}\n"
-                        "SQL Query: {query}\n"
-                        "Params: {params}\n"
-                        .format(
-                            err=str(e),
-                            file=str(importPath),
-                            line=lineNo,
-                            query=sql_stmt.strip(),
-                            params=linein
-                        )
-                    ) from None
-                importCount += 1
+                batch.append(linein)
+                batchLineNos.append(lineNo)
+                if len(batch) >= batchSize:
+                    endBatch()
             else:
-                tdenv.NOTE(
-                        "Wrong number of columns ({}:{}): {}",
-                            importPath,
-                            lineNo,
-                            ', '.join(linein)
+                endBatch()
+                steps.append(("columns", lineNo, linein))
+        endBatch()
+        yield from steps
+
+
+def importParsedFile(tdenv, db, importPath, tableName, parsed):
+    """
+        Imports what parseImportFile found in a .csv file into
+        tableName. Foreign keys (columns named "column@Table.key") are
+        looked up in indexes of the referenced tables, loaded once, and
+        the rows are inserted in batches.
+    """
+    tdenv.DEBUG0(
+        "Processing import file '{}' for table '{}'",
+        str(importPath), tableName
+    )
+
+    uniquePfx = "unq:"
+    uniqueLen = len(uniquePfx)
+    ignorePfx = "!"
+
+    columnDefs = next(parsed)
+
+    # split up columns and values
+    # this is necessqary because the insert might use a foreign key
+    bindColumns = []
+    bindValues  = []
+    joinHelper  = []
+    for (cIndex, cName) in enumerate(columnDefs):
+        colName, _, srcKey = cName.partition('@')
+        # is this a unique index?
+        if colName.startswith(uniquePfx):
+            colName = colName[uniqueLen:]
+        if not srcKey:
+            # no foreign key, straight insert
+            bindColumns.append(colName)
+            bindValues.append((cIndex, None))
+            continue
+
+        queryTab, _, queryCol = srcKey.partition('.')
+        if colName.startswith(ignorePfx):
+            # this column is only used to resolve an FK
+            assert srcKey
+            colName = colName[len(ignorePfx):]
+            joinHelper.append((colName, queryTab, queryCol, cIndex))
+            continue
+
+        # foreign key, we need to look it up
+        joinTable = [ queryTab ]
+        joinColumns = []
+        joinIndexes = []
+        for nextCol, nextTab, nextJoin, nextIndex in joinHelper:
+            joinTable.append(
+                "INNER JOIN {} USING({})".format(nextTab, nextJoin)
+            )
+            joinColumns.append("{}.{}".format(nextTab, nextCol))
+            joinIndexes.append(nextIndex)
+        joinHelper = []
+        joinColumns.append("{}.{}".format(queryTab, colName))
+        joinIndexes.append(cIndex)
+        bindColumns.append(queryCol)
+        keyIndex = getForeignKeyIndex(db, srcKey, joinTable, joinColumns)
+        tdenv.DEBUG1(
+            "{} index of {}: {} entries", srcKey, joinColumns, len(keyIndex)
+        )
+        bindValues.append((joinIndexes, keyIndex.get))
+    # now we can make the sql statement
+    sql_stmt = """
+        INSERT INTO {table} ({columns}) VALUES({values})
+    """.format(
+            table=tableName,
+            columns=','.join(bindColumns),
+            values=','.join('?' * len(bindColumns))
+        )
+    tdenv.DEBUG0("SQL-Statement: {}", sql_stmt)
+
+    def insertBatch(batchLineNos, batch):
+        """
+        Inserts a batch of rows, a column at a time, reporting the
+        first one that can't be inserted.
+        """
+        columns = []
+        for index, getKey in bindValues:
+            if not getKey:
+                columns.append([linein[index] for linein in batch])
+                continue
+            keys = [
+                [
+                    value.translate(asciiUpper)
+                    for value in map(operator.itemgetter(joinIndex), batch)
+                ]
+                for joinIndex in index
+            ]
+            keys = zip(*keys) if len(keys) > 1 else keys[0]
+            columns.append(list(map(getKey, keys)))
+        changes = db.total_changes
+        try:
+            db.executemany(sql_stmt, zip(*columns))
+        except Exception as e:
+            failed = db.total_changes - changes
+            raise SystemExit(
+                "*** INTERNAL ERROR: {err}\n"
+                "CSV File: {file}:{line}\n"
+                "SQL Query: {query}\n"
+                "Params: {params}\n"
+                .format(
+                    err=str(e),
+                    file=str(importPath),
+                    line=batchLineNos[failed],
+                    query=sql_stmt.strip(),
+                    params=batch[failed]
                 )
-        db.commit()
-        tdenv.DEBUG0("{count} {table}s imported",
-                            count=importCount,
-                            table=tableName)
+            ) from None
+
+    # import the data
+    importCount = 0
+    for step in parsed:
+        if step[0] == "rows":
+            _, batchLineNos, batch = step
+            if tdenv.debug > 1:
+                for linein in batch:
+                    tdenv.DEBUG1("       Values: {}", ', '.join(linein))
+            insertBatch(batchLineNos, batch)
+            importCount += len(batch)
+        elif step[0] == "warning":
+            tdenv.NOTE("{}", step[1])
+        elif step[0] == "columns":
+            _, lineNo, linein = step
+            tdenv.NOTE(
+                    "Wrong number of columns ({}:{}): {}",
+                        importPath,
+                        lineNo,
+                        ', '.join(linein)
+            )
+        else:
+            raise step[1]
+    db.commit()
+    tdenv.DEBUG0("{count} {table}s imported",
+                        count=importCount,
+                        table=tableName)
+
+
+def processImportFile(tdenv, db, importPath, tableName):
+    """
+        Imports a .csv file into tableName.
+    """
+    parsed = parseImportFile(importPath, tableName, tdenv.ignoreUnknown)
+    importParsedFile(tdenv, db, importPath, tableName, parsed)
 
 
 
 ######################################################################
 
+# What each source file held when the cache was last brought up to date
+# with it, so updateCache can tell which of them have really changed.
+sourceHashTable = """
+    CREATE TABLE IF NOT EXISTS SourceHash
+     (
+       name VARCHAR(40) NOT NULL PRIMARY KEY,
+       hash CHAR(40) NOT NULL
+     )
+"""
+
+
+def getSourcePaths(tdb):
+    """
+    Returns the Paths of the files the cache is built from: the .sql,
+    the .csv files and the .prices file.
+    """
+    paths = [tdb.sqlPath]
+    paths += [Path(importName) for (importName, _) in tdb.importTables]
+    paths.append(tdb.pricesPath)
+    return paths
+
+
+def getSourceHash(path):
+    """
+    Returns a hash of the contents of path, or None if it doesn't exist.
+    """
+    try:
+        with path.open('rb') as sourceFile:
+            return hashlib.sha1(sourceFile.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def saveSourceHashes(db, paths):
+    """
+    Records what the given source files hold now in the SourceHash
+    table of db.
+    """
+    db.execute(sourceHashTable)
+    for path in paths:
+        sourceHash = getSourceHash(path)
+        if sourceHash:
+            db.execute("""
+                INSERT OR REPLACE INTO SourceHash (name, hash) VALUES (?, ?)
+            """, [path.name, sourceHash])
+        else:
+            db.execute("DELETE FROM SourceHash WHERE name = ?", [path.name])
+
+
+def importTableFile(tdenv, db, importName, tableName, parsed=None):
+    """
+    Imports the .csv file importName into tableName, if there is one.
+    parsed, if given, is what parseImportFile makes of the file.
+    """
+    importPath = Path(importName)
+    try:
+        if parsed is None:
+            parsed = parseImportFile(
+                importPath, tableName, tdenv.ignoreUnknown
+            )
+        importParsedFile(tdenv, db, importPath, tableName, parsed)
+    except FileNotFoundError:
+        tdenv.DEBUG0(
+            "WARNING: processImportFile found no {} file", importName
+        )
+    except StopIteration:
+        tdenv.NOTE(
+            "{} exists but is empty. "
+            "Remove it or add the column definition line.",
+            importName
+        )
+
+
+def parseImportFileInto(queue, importPath, tableName, ignoreUnknown):
+    """
+    Runs in another process, putting what parseImportFile yields on
+    queue followed by None, or the exception that stopped it.
+    """
+    try:
+        for parsed in parseImportFile(importPath, tableName, ignoreUnknown):
+            queue.put(parsed)
+    except Exception as e:
+        queue.put(e)
+    else:
+        queue.put(None)
+
+
+def readImportQueue(queue):
+    """
+    Yields what parseImportFileInto puts on queue.
+    """
+    while True:
+        parsed = queue.get()
+        if parsed is None:
+            return
+        if isinstance(parsed, Exception):
+            raise parsed
+        yield parsed
+
+
+def importTablesInParallel(tdenv, db, importTables, workers, timer):
+    """
+    Imports the .csv files into db in order while up to workers other
+    processes read and check the ones that are next. Each passes its
+    batches through a short queue, so only a few are held at a time.
+    """
+    context = multiprocessing.get_context()
+    parsers = {}
+
+    def startParser(index):
+        if index >= len(importTables):
+            return
+        importName, importTable = importTables[index]
+        queue = context.Queue(2)
+        process = context.Process(
+            target=parseImportFileInto,
+            args=(queue, Path(importName), importTable, tdenv.ignoreUnknown),
+            daemon=True,
+        )
+        process.start()
+        parsers[index] = (queue, process)
+
+    try:
+        for index in range(workers):
+            startParser(index)
+        for index, (importName, importTable) in enumerate(importTables):
+            queue, process = parsers.pop(index)
+            importTableFile(
+                tdenv, db, importName, importTable, readImportQueue(queue)
+            )
+            process.join()
+            startParser(index + workers)
+            timer.lap(Path(importName).name)
+    finally:
+        # Something went wrong: the rest are no longer wanted.
+        for queue, process in parsers.values():
+            process.terminate()
+            process.join()
+
+
+class BuildTimer(object):
+    """
+    Times the phases of building the cache, for a report at the end
+    (shown with -v).
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.started = self.lapStarted = time.time()
+
+    def lap(self, phase):
+        """ Records the time since the last lap as phase. """
+        now = time.time()
+        self.phases.append((phase, now - self.lapStarted))
+        self.lapStarted = now
+
+    def report(self, tdenv, title):
+        report = "{} in {:.2f}s:".format(title, time.time() - self.started)
+        for phase, taken in self.phases:
+            report += "\n    {:<24}{:>7.2f}s".format(phase, taken)
+        if tdenv.detail:
+            tdenv.NOTE("{}", report, file=sys.stderr)
+        else:
+            tdenv.DEBUG0("{}", report)
+
+
+def openBuildDB(path):
+    """
+    Connects to a database which is being built to replace the cache.
+    Nothing else uses it until it's swapped in, and if anything goes
+    wrong it's thrown away, so it doesn't need a journal or to wait
+    for the disk.
+    """
+    db = sqlite3.connect(str(path))
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    return db
+
+
+def swapCache(tdb, tdenv, tempPath):
+    """
+    Replaces the cache with the database at tempPath in one step,
+    keeping the previous one as a backup.
+    """
+    tdenv.DEBUG0("Swapping out db files")
+
+    # Don't leave TradeDB talking to the old file.
+    if tdb.conn:
+        tdb.conn.close()
+        tdb.conn = None
+
+    dbPath = tdb.dbPath
+    backupPath = dbPath.with_suffix(".old")
+    if dbPath.exists():
+        if backupPath.exists():
+            backupPath.unlink()
+        try:
+            os.link(str(dbPath), str(backupPath))
+        except OSError:
+            shutil.copyfile(str(dbPath), str(backupPath))
+    os.replace(str(tempPath), str(dbPath))
+    tdb.invalidateSnapshot()
+
+
 def buildCache(tdb, tdenv):
     """
     Rebuilds the SQlite database from source files.
@@ -1079,6 +1491,11 @@ def buildCache(tdb, tdenv):
     We load both sets of data into an SQLite database, after which we can
     avoid the text-processing overhead by simply checking if the text files
     are newer than the database.
+
+    The database is built beside the cache and swapped in when it's
+    complete. Its indexes are only created once all of the data is in.
+    With tdenv.cacheWorkers > 1 the .csv files are read in that many
+    other processes while they are written to it, in order.
     """
 
     tdenv.NOTE(
@@ -1086,18 +1503,18 @@ def buildCache(tdb, tdenv):
         file=sys.stderr
     )
 
+    timer = BuildTimer()
     dbPath = tdb.dbPath
     sqlPath = tdb.sqlPath
     pricesPath = tdb.pricesPath
 
     # Create an in-memory database to populate with our data.
     tempPath = dbPath.with_suffix(".new")
-    backupPath = dbPath.with_suffix(".old")
 
     if tempPath.exists():
         tempPath.unlink()
 
-    tempDB = sqlite3.connect(str(tempPath))
+    tempDB = openBuildDB(tempPath)
     tempDB.execute("PRAGMA foreign_keys=ON")
     # Read the SQL script so we are ready to populate structure, etc.
     tdenv.DEBUG0("Executing SQL Script '{}' from '{}'", sqlPath, os.getcwd())
@@ -1105,24 +1522,32 @@ def buildCache(tdb, tdenv):
         sqlScript = sqlFile.read()
         tempDB.executescript(sqlScript)
 
+    # It's quicker to index the tables once they are full. UNIQUE
+    # constraints stay, since the imports look things up by them.
+    indexes = tempDB.execute("""
+        SELECT  name, sql
+          FROM  sqlite_master
+         WHERE  type = 'index' AND sql IS NOT NULL
+    """).fetchall()
+    for indexName, _ in indexes:
+        tempDB.execute("DROP INDEX {}".format(indexName))
+    timer.lap("schema")
+
     # import standard tables
-    for (importName, importTable) in tdb.importTables:
-        try:
-            processImportFile(tdenv, tempDB, Path(importName), importTable)
-        except FileNotFoundError:
-            tdenv.DEBUG0(
-                "WARNING: processImportFile found no {} file", importName
-            )
-        except StopIteration:
-            tdenv.NOTE(
-                "{} exists but is empty. "
-                "Remove it or add the column definition line.",
-                importName
-            )
+    importTables = tdb.importTables
+    workers = min(getattr(tdenv, 'cacheWorkers', None) or 1, len(importTables))
+    if workers > 1:
+        tdenv.DEBUG0("Parsing .csv files with {} workers", workers)
+        importTablesInParallel(tdenv, tempDB, importTables, workers, timer)
+    else:
+        for (importName, importTable) in importTables:
+            importTableFile(tdenv, tempDB, importName, importTable)
+            timer.lap(Path(importName).name)
 
     # Parse the prices file
     if pricesPath.exists():
         processPricesFile(tdenv, tempDB, pricesPath)
+        timer.lap(pricesPath.name)
     else:
         tdenv.NOTE(
                 "Missing \"{}\" file - no price data.",
@@ -1130,17 +1555,145 @@ def buildCache(tdb, tdenv):
                     file=sys.stderr,
         )
 
+    for indexName, indexSql in indexes:
+        tdenv.DEBUG1("Creating index {}", indexName)
+        tempDB.execute(indexSql)
+    timer.lap("indexes")
+    tempDB.execute("ANALYZE")
+    timer.lap("analyze")
+
+    saveSourceHashes(tempDB, getSourcePaths(tdb))
     tempDB.commit()
     tempDB.close()
+    timer.lap("hashes")
 
-    tdenv.DEBUG0("Swapping out db files")
+    swapCache(tdb, tdenv, tempPath)
+    timer.lap("swap")
 
-    if dbPath.exists():
-        if backupPath.exists():
-            backupPath.unlink()
-        dbPath.rename(backupPath)
-    tempPath.rename(dbPath)
+    timer.report(tdenv, "Rebuilt cache")
+    tdenv.DEBUG0("Finished")
+
+
+def updateCache(tdb, tdenv, paths):
+    """
+    Brings the SQLite database up to date after the given source files
+    have been changed.
+
+    Only the tables whose .csv files hold something different now are
+    imported again, along with the tables that refer to them, and the
+    prices if they refer to any of those. The tables that are left
+    alone are the same as buildCache would make them, and the ones that
+    are imported again are given the same IDs.
+
+    A change to the .sql file, or a database that doesn't know what its
+    source files held, means rebuilding everything with buildCache.
+    """
+
+    try:
+        oldHashes = dict(tdb.getDB().execute(
+            "SELECT name, hash FROM SourceHash"
+        ))
+    except sqlite3.OperationalError:
+        oldHashes = {}
+    changedPaths = [
+        path for path in paths
+        if getSourceHash(path) != oldHashes.get(path.name)
+    ]
+    tdenv.DEBUG0("Changed source files: {}", [str(p) for p in changedPaths])
+
+    if not oldHashes or tdb.sqlPath in changedPaths:
+        buildCache(tdb, tdenv)
+        return
+
+    if not changedPaths:
+        # Touch the db so we don't check them again.
+        os.utime(tdb.dbFilename)
+        return
+
+    pricesPath = tdb.pricesPath
+    tablesByPath = {
+        Path(importName): importTable
+        for importName, importTable in tdb.importTables
+    }
+    changedTables = set(
+        tablesByPath[path] for path in changedPaths if path in tablesByPath
+    )
+    if not changedTables:
+        if pricesPath in changedPaths:
+            tdenv.DEBUG0(".prices has changed: re-importing")
+            importDataFromFile(tdb, tdenv, pricesPath, reset=True)
+            db = tdb.getDB()
+            saveSourceHashes(db, changedPaths)
+            db.commit()
+        return
+
+    tdenv.NOTE(
+        "Updating cache file for changes to {}.",
+        ", ".join(path.name for path in changedPaths),
+        file=sys.stderr
+    )
+
+    # Work on a copy, so nothing changes if an import fails.
+    timer = BuildTimer()
+    tempPath = tdb.dbPath.with_suffix(".new")
+    shutil.copyfile(str(tdb.dbPath), str(tempPath))
+    tempDB = openBuildDB(tempPath)
+    timer.lap("copy")
+
+    def refersTo(table, tables):
+        return any(
+            fkey[2] in tables
+            for fkey in tempDB.execute(
+                "PRAGMA foreign_key_list({})".format(table)
+            )
+        )
+
+    # importTables lists each table after the ones it refers to.
+    reimport, reimportTables = [], set()
+    for importName, importTable in tdb.importTables:
+        if importTable in changedTables or refersTo(importTable, reimportTables):
+            reimport.append((importName, importTable))
+            reimportTables.add(importTable)
+    reloadPrices = (
+        pricesPath in changedPaths or refersTo("StationItem", reimportTables)
+    )
+    tdenv.DEBUG0(
+        "Re-importing {}{}",
+        ", ".join(sorted(reimportTables)), " and prices" if reloadPrices else ""
+    )
+
+    # Empty the tables, those that refer to others first, and start
+    # their IDs again from 1. Nothing is left referring to the rows
+    # that go, so there's no need for sqlite to check.
+    if reloadPrices:
+        tempDB.execute("DELETE FROM StationItem")
+    for _, importTable in reversed(reimport):
+        tempDB.execute("DELETE FROM {}".format(importTable))
+    tempDB.execute("""
+        DELETE FROM sqlite_sequence WHERE name IN ({})
+    """.format(",".join("?" * len(reimport))), list(reimportTables))
+    tempDB.commit()
+    tempDB.execute("PRAGMA foreign_keys=ON")
+    timer.lap("delete")
+
+    for importName, importTable in reimport:
+        importTableFile(tdenv, tempDB, importName, importTable)
+        timer.lap(Path(importName).name)
+    if reloadPrices and pricesPath.exists():
+        processPricesFile(tdenv, tempDB, pricesPath)
+        timer.lap(pricesPath.name)
+    tempDB.execute("ANALYZE")
+    timer.lap("analyze")
+
+    saveSourceHashes(tempDB, changedPaths)
+    tempDB.commit()
+    tempDB.close()
+    timer.lap("hashes")
+
+    swapCache(tdb, tdenv, tempPath)
+    timer.lap("swap")
 
+    timer.report(tdenv, "Updated cache")
     tdenv.DEBUG0("Finished")
 
 ######################################################################
@@ -1184,6 +1737,7 @@ def importDataFromFile(tdb, tdenv, path, pricesFh=None, reset=False):
             pricesPath=path,
             pricesFh=pricesFh,
             )
+    tdb.invalidateSnapshot()
 
     # If everything worked, we may need to re-build the prices file.
     if path != tdb.pricesPath:
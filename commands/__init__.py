@@ -234,11 +234,23 @@ class CommandIndex(object):
                     type=float,
                     default=None, dest='maxSystemLinkLy',
                 )
+        stdArgs.add_argument('--range-cache',
+                    help='Number of neighbouring systems to remember, '
+                        'dropping the least recently used. '
+                        'Use --debug to see how well it is doing.',
+                    type=int, metavar='N',
+                    default=None, dest='rangeCacheSize',
+                )
 
         fromfilePath = _findFromFile(cmdModule.name)
         if fromfilePath:
             argv.insert(2, '{}{}'.format(fromfile_prefix, fromfilePath))
         properties = parser.parse_args(argv[1:])
+        if properties.rangeCacheSize is not None:
+            if properties.rangeCacheSize < 0:
+                raise exceptions.CommandLineError(
+                    "--range-cache can't be negative."
+                )
 
         parsed = CommandEnv(properties, argv, cmdModule)
         parsed.DEBUG0("Command line was: {}", argv)
@@ -42,6 +42,13 @@ switches = [
             "recognized is reported as warning but skipped."
         ),
     ),
+    ParseArgument('--workers',
+        help='Number of processes to read the .csv files with.',
+        default=None,
+        dest='cacheWorkers',
+        metavar='N',
+        type=int,
+    ),
 ]
 
 ######################################################################
@@ -61,6 +68,9 @@ def run(results, cmdenv, tdb):
                      "Either remove the file first or use the '-f' option."
                         .format(tdb.dbFilename))
 
+    if cmdenv.cacheWorkers is not None and cmdenv.cacheWorkers < 1:
+        raise CommandLineError("--workers must be 1 or more.")
+
     if not tdb.sqlPath.exists():
         raise CommandLineError(
                     "SQL File does not exist: {}"
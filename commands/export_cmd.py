@@ -83,8 +83,9 @@ def run(results, cmdenv, tdb):
     conn = tdb.getDB()
     conn.row_factory = sqlite3.Row
 
-    # some tables might be ignored
-    ignoreList = []
+    # some tables might be ignored; source file hashes only live
+    # in the DB
+    ignoreList = ["SourceHash"]
 
     # extract tables from command line
     if cmdenv.tables:
@@ -3,7 +3,7 @@ from commands.commandenv import ResultRow
 from commands.parsing import *
 from formatting import RowFormat, ColumnFormat, max_len
 from itertools import chain
-from tradedb import TradeDB
+from tradedb import TradeDB, StationFeatures
 from tradeexcept import TradeException
 
 import math
@@ -78,39 +78,26 @@ def run(results, cmdenv, tdb):
 
     showStations = cmdenv.detail
     wantStations = cmdenv.stations
-    padSize = cmdenv.padSize
-    planetary = cmdenv.planetary
-    wantNoPlanet = cmdenv.noPlanet
     wantTrading = cmdenv.trading
-    wantShipYard = cmdenv.shipyard
-    wantBlackMarket = cmdenv.blackMarket
-    wantOutfitting = cmdenv.outfitting
-    wantRearm = cmdenv.rearm
-    wantRefuel = cmdenv.refuel
-    wantRepair = cmdenv.repair
+    wantYes = lambda want: 'Y' if want else None
+    featureMask = StationFeatures.compile(
+        noPlanet=cmdenv.noPlanet,
+        maxPadSize=cmdenv.padSize,
+        planetary=cmdenv.planetary,
+        blackMarket=wantYes(cmdenv.blackMarket),
+        shipyard=wantYes(cmdenv.shipyard),
+        outfitting=wantYes(cmdenv.outfitting),
+        rearm=wantYes(cmdenv.rearm),
+        refuel=wantYes(cmdenv.refuel),
+        repair=wantYes(cmdenv.repair),
+    )
 
     def station_filter(stations):
         for station in stations:
-            if wantNoPlanet and station.planetary != 'N':
+            if station.features & featureMask:
                 continue
             if wantTrading and not station.isTrading:
                 continue
-            if wantBlackMarket and station.blackMarket != 'Y':
-                continue
-            if wantShipYard and station.shipyard != 'Y':
-                continue
-            if padSize and not station.checkPadSize(padSize):
-                continue
-            if planetary and not station.checkPlanetary(planetary):
-                continue
-            if wantOutfitting and station.outfitting != 'Y':
-                continue
-            if wantRearm and station.rearm != 'Y':
-                continue
-            if wantRefuel and station.refuel != 'Y':
-                continue
-            if wantRepair and station.repair != 'Y':
-                continue
             yield station
 
     for (system, dist) in sorted(distances.items(), key=lambda x: x[1]):
@@ -6,6 +6,7 @@ from formatting import RowFormat, ColumnFormat
 from tradedb import TradeDB, System, Station, describeAge
 from tradecalc import TradeCalc, Route, NoHopsError
 
+import heapq
 import math
 
 ######################################################################
@@ -206,6 +207,22 @@ switches = [
         type=int,
         dest='maxRoutes',
     ),
+    ParseArgument('--beam',
+        help='Beam search: at the end of each hop, only continue with '
+                'the N routes that could make the best score, '
+                'counting the most they could gain in the hops left.',
+        default=0,
+        metavar='N',
+        type=int,
+    ),
+    ParseArgument('--keep-per-dest',
+        help='Keep the K best routes to each station after each hop, '
+                'rather than just the best one. DEFAULT: 1',
+        default=1,
+        metavar='K',
+        type=int,
+        dest='keepPerDest',
+    ),
     ParseArgument('--checklist',
         help='Provide a checklist flow for the route.',
         action='store_true',
@@ -235,6 +252,26 @@ switches = [
         default=False,
         action='store_true',
     ),
+    ParseArgument('--lazy-prices',
+        help='Only load prices for stations the run could reach.',
+        action='store_true',
+        default=False,
+        dest='lazyPrices',
+    ),
+    ParseArgument('--workers',
+        help='Number of processes to share the work of each hop between.',
+        default=1,
+        metavar='N',
+        type=int,
+    ),
+    ParseArgument('--fit-cache',
+        help='Number of cargo-fit results to remember between hops, '
+            '0 to disable. Use -vv to see how well it is doing.',
+        default=None,
+        metavar='N',
+        type=int,
+        dest='fitCacheSize',
+    ),
     ParseArgument('--supply',
         help='Only considers items which have at least this many units.',
         default=None,
@@ -413,6 +450,9 @@ def expandForJumps(tdb, cmdenv, calc, origin, jumps, srcName, purpose):
             [sys.dbname for sys in origins]
         )
         thisJump, origins = origins, set()
+        calc.loadStations(chain.from_iterable(
+            sys.stations or () for sys in thisJump
+        ))
         for sys in thisJump:
             avoid.add(sys)
             for stn in sys.stations or ():
@@ -555,6 +595,7 @@ def checkStationSuitability(cmdenv, calc, station, src=None):
                     src, station.name(),
             ))
         return False
+    calc.loadStations((station,))
     if src != "--to" and station.ID not in calc.stationsSelling:
         if src:
             raise NoDataError(
@@ -670,6 +711,7 @@ def checkOrigins(tdb, cmdenv, calc):
                         "No stations at --from system, {}"
                             .format(cmdenv.origPlace.name())
                         )
+            calc.loadStations(cmdenv.origPlace.stations)
             cmdenv.origins = tuple(
                 station
                 for station in cmdenv.origPlace.stations
@@ -688,6 +730,7 @@ def checkOrigins(tdb, cmdenv, calc):
         if cmdenv.startJumps:
             raise CommandLineError("--start-jumps (-s) only works with --from")
         cmdenv.DEBUG0("using all suitable origins")
+        calc.loadStations(tdb.stationByID.values())
         cmdenv.origins = tuple(
             station
             for station in tdb.stationByID.values()
@@ -704,6 +747,26 @@ def checkOrigins(tdb, cmdenv, calc):
     ))
 
 
+def reachableStations(tdb, cmdenv):
+    """
+    Stations that are within the longest distance a run could
+    cover of any of its origins.
+    """
+    maxLy = cmdenv.hops * cmdenv.maxJumpsPer * cmdenv.maxLyPer
+    systems = set(cmdenv.origSystems)
+    for origSys in cmdenv.origSystems:
+        systems.update(
+            system for system, _ in tdb.genSystemsInRange(origSys, maxLy)
+        )
+    cmdenv.DEBUG0(
+        "{:n} systems within {}ly of the origins", len(systems), maxLy
+    )
+    return (
+        station for station in tdb.stationByID.values()
+        if station.system in systems
+    )
+
+
 def checkDestinations(tdb, cmdenv, calc):
     cmdenv.destinations = None
     if cmdenv.destPlace:
@@ -721,6 +784,7 @@ def checkDestinations(tdb, cmdenv, calc):
             cmdenv.destinations = (cmdenv.destPlace,)
         else:
             cmdenv.DEBUG0("destPlace: System: {}", cmdenv.destPlace.name())
+            calc.loadStations(cmdenv.destPlace.stations)
             cmdenv.destinations = tuple(
                 station
                 for station in cmdenv.destPlace.stations
@@ -742,8 +806,12 @@ def checkDestinations(tdb, cmdenv, calc):
             stationSrc = chain.from_iterable(
                 system.stations for system in cmdenv.origSystems
             )
+        elif cmdenv.lazyPrices and not cmdenv.direct:
+            stationSrc = reachableStations(tdb, cmdenv)
         else:
             stationSrc = tdb.stationByID.values()
+        stationSrc = tuple(stationSrc)
+        calc.loadStations(stationSrc)
 
         cmdenv.destinations = tuple(
             station
@@ -944,6 +1012,15 @@ def validateRunArguments(tdb, cmdenv, calc):
     else:
         cmdenv.pruneScores = cmdenv.pruneHops = 0
 
+    if cmdenv.fitCacheSize is not None and cmdenv.fitCacheSize < 0:
+        raise CommandLineError("--fit-cache can't be negative.")
+    if cmdenv.workers < 1:
+        raise CommandLineError("--workers must be 1 or more.")
+    if cmdenv.beam < 0:
+        raise CommandLineError("--beam can't be negative.")
+    if cmdenv.keepPerDest < 1:
+        raise CommandLineError("--keep-per-dest must be 1 or more.")
+
 ######################################################################
 
 
@@ -1090,6 +1167,35 @@ def extraRouteProgress(routes):
 
     return ".. {}, {}".format(gainText, gptText)
 
+
+def dropDominatedRoutes(routes):
+    """
+    Drops the routes that another route from the same station, to the
+    same station, beats on both score and credits: whatever the next
+    hops bring, the other route can do at least as well.
+    """
+    byPlace = {}
+    for route in routes:
+        place = (route.firstStation, route.lastStation)
+        byPlace.setdefault(place, []).append(route)
+    dominated = set()
+    for placeRoutes in byPlace.values():
+        if len(placeRoutes) < 2:
+            continue
+        placeRoutes.sort(
+            key=lambda rt: (rt.score, rt.startCr + rt.gainCr), reverse=True
+        )
+        mostCr = None
+        for route in placeRoutes:
+            credits = route.startCr + route.gainCr
+            if mostCr is not None and credits <= mostCr:
+                dominated.add(id(route))
+            else:
+                mostCr = credits
+    if not dominated:
+        return routes
+    return [route for route in routes if id(route) not in dominated]
+
 ######################################################################
 # Perform query and populate result set
 
@@ -1195,6 +1301,24 @@ def run(results, cmdenv, tdb):
             if pruned:
                 cmdenv.NOTE("Pruned {} origins too far from any end stations", pruned)
 
+        if hopNo >= 1 and cmdenv.beam and cmdenv.keepPerDest > 1:
+            # Where the route has been only matters for these.
+            if not (cmdenv.unique or cmdenv.loopInt or viaSet):
+                preCrop = len(routes)
+                routes = dropDominatedRoutes(routes)
+                cmdenv.DEBUG0(
+                    "Dropped {} dominated routes", preCrop - len(routes)
+                )
+
+        if hopNo >= 1 and cmdenv.beam and len(routes) > cmdenv.beam:
+            hopsLeft = numHops - hopNo
+            preCrop = len(routes)
+            routes = heapq.nlargest(
+                cmdenv.beam, routes,
+                key=lambda rt: rt.score + calc.routeGainBound(rt, hopsLeft)
+            )
+            cmdenv.DEBUG0("Beam kept {} of {} routes", len(routes), preCrop)
+
         if hopNo >= 1 and (cmdenv.maxRoutes or pruneMod):
             routes.sort()
             if pruneMod and hopNo + 1 >= cmdenv.pruneHops and len(routes) > 10:
@@ -10,8 +10,11 @@
 -- which are designed to be human readable text that
 -- closely aproximates the in-game UI.
 --
--- When the .SQL file or the .CSV files change, TD will
--- destroy and rebuild the cache next time it is run.
+-- When the .SQL file changes, TD will destroy and rebuild
+-- the cache next time it is run.
+--
+-- When a .CSV file changes, only its table and the tables
+-- that refer to it (see FOREIGN KEY) are imported again.
 --
 -- When the .prices file is changed, only the price data
 -- is reset.
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+"""
+Times TradeDB.getRoute over a fixed set of long routes, e.g.
+
+    misc/routebench.py --ly 15 --repeat 3
+
+Run it from the top of the repository.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+import tradedb
+import tradeenv
+
+# Pairs of systems from one side of the bubble to the other.
+routes = (
+    ("SOL", "ELECTRA"),
+    ("18 TAURI", "HIP 57242"),
+    ("COL 285 SECTOR SK-L B9-0", "SYNUEFE AB-C B46-1"),
+    ("MEL 111 SECTOR XJ-R B4-0", "HIP 117114"),
+    ("HIP 21129", "MEL 111 SECTOR XJ-R B4-0"),
+    ("SYNUEFE BU-M B53-2", "HIP 57242"),
+    ("ACHENAR", "PLEIONE"),
+    ("LHS 3447", "HR 1172"),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--ly', type=float, default=15, help='Max ly per jump.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each route.')
+    args = parser.parse_args()
+
+    tdb = tradedb.TradeDB(tradeenv.TradeEnv())
+    # Get any graph or landmarks built before we start the clock.
+    tdb.getRoute(tdb.lookupSystem(routes[0][0]), tdb.lookupSystem(routes[0][1]), args.ly)
+
+    total = 0
+    for origName, destName in routes:
+        orig, dest = tdb.lookupSystem(origName), tdb.lookupSystem(destName)
+        best = None
+        for _ in range(args.repeat):
+            started = time.time()
+            route = tdb.getRoute(orig, dest, args.ly)
+            taken = time.time() - started
+            best = taken if best is None else min(best, taken)
+        total += best
+        if route:
+            summary = "{:>3} jumps {:>7.2f}ly".format(len(route) - 1, route[-1][1])
+        else:
+            summary = "no route"
+        print("{:>26} -> {:<26} {} {:>7.3f}s".format(
+            origName, destName, summary, best
+        ))
+    print("{:>81.3f}s".format(total))
+
+
+if __name__ == "__main__":
+    main()
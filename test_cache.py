@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# Noses test file
+
+from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
+import cache
+import corrections
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import tradeenv
+from pathlib import Path
+from test_tradedb import makeDataDir, makeTradeDB
+
+
+class PricesFile(io.StringIO):
+    name = "test.prices"
+
+
+def importPrices(text, chunkSize, existing=()):
+    """
+    Imports text as a .prices file into a small DB, writing chunkSize
+    rows at a time, and returns what's in StationItem after.
+    """
+    db = sqlite3.connect(":memory:")
+    with open("data/TradeDangerous.sql", encoding="utf-8") as sqlFile:
+        db.executescript(sqlFile.read())
+    db.execute("INSERT INTO System (name, pos_x, pos_y, pos_z) VALUES ('ACHERNAR', 0, 0, 0)")
+    db.execute("INSERT INTO Station (name, system_id) VALUES ('Dawes Hub', 1)")
+    db.execute("INSERT INTO Category (name) VALUES ('Stuff')")
+    for number in range(1, 51):
+        db.execute("INSERT INTO Station (name, system_id) VALUES (?, 1)", ["Filler {}".format(number)])
+        db.execute("INSERT INTO Item (name, category_id) VALUES (?, 1)", ["Item{}".format(number)])
+    db.executemany("""
+        INSERT INTO StationItem VALUES (1, ?, 1, 1, 1, 1, 1, 1, '2017-01-01 00:00:00')
+    """, [(itemID,) for itemID in existing])
+    db.commit()
+
+    oldSystems, oldChunkSize = dict(corrections.systems), cache.pricesChunkSize
+    corrections.systems['ACHENAR'] = 'ACHERNAR'
+    cache.pricesChunkSize = chunkSize
+    try:
+        tdenv = tradeenv.TradeEnv(quiet=1)
+        cache.processPricesFile(tdenv, db, Path("test.prices"), PricesFile(text))
+    finally:
+        corrections.systems.clear()
+        corrections.systems.update(oldSystems)
+        cache.pricesChunkSize = oldChunkSize
+    return db.execute("""
+        SELECT station_id, item_id, demand_price, modified
+          FROM StationItem
+         ORDER BY station_id, item_id
+    """).fetchall()
+
+
+def repeatedStationPrices():
+    """
+    Dawes Hub, then fillers, then Dawes Hub again under a system name
+    that is corrected to the first one.
+    """
+    lines = [
+        "@ ACHERNAR/Dawes Hub",
+        "  Item1 10 20 1H 1H 2017-05-01 12:00:00",
+        "  Item2 10 20 1H 1H 2017-05-01 12:00:00",
+    ]
+    for number in range(1, 51):
+        lines.append("@ ACHERNAR/Filler {}".format(number))
+        lines += [
+            "  Item{} 10 20 1H 1H 2017-05-01 12:00:00".format(item)
+            for item in range(1, 51)
+        ]
+    lines += [
+        "@ ACHENAR/Dawes Hub",
+        "  Item1 0 0 - - 2017-05-01 12:00:00",
+        "  Item3 30 40 1H 1H 2017-05-01 12:00:00",
+    ]
+    return "\n".join(lines)
+
+
+def test_repeated_station_across_chunks():
+    text = repeatedStationPrices()
+    oneChunk = importPrices(text, 10000)
+    assert importPrices(text, 100) == oneChunk
+    assert importPrices(text, 1) == oneChunk
+    dawesHub = [row[1] for row in oneChunk if row[0] == 1]
+    assert dawesHub == [1, 2, 3]
+
+
+def test_repeated_station_across_chunks_with_existing_prices():
+    text = repeatedStationPrices()
+    oneChunk = importPrices(text, 10000, existing=(1, 4))
+    assert importPrices(text, 100, existing=(1, 4)) == oneChunk
+    assert importPrices(text, 1, existing=(1, 4)) == oneChunk
+    dawesHub = [row[1] for row in oneChunk if row[0] == 1]
+    assert dawesHub == [1, 2, 3]
+
+
+def tableContents(dataDir):
+    """ {table: sorted rows} of everything in dataDir's cache. """
+    db = sqlite3.connect(str(Path(dataDir) / "TradeDangerous.db"))
+    try:
+        tables = [
+            name for name, in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+            if not name.startswith("sqlite_stat")
+        ]
+        return {
+            table: sorted(
+                db.execute("SELECT * FROM {}".format(table)),
+                key=repr
+            )
+            for table in tables
+        }
+    finally:
+        db.close()
+
+
+def rebuiltContents(dataDir):
+    """ tableContents of a cache built from scratch from dataDir's files. """
+    fullDir = tempfile.mkdtemp(prefix="tdtest")
+    try:
+        for path in Path(dataDir).iterdir():
+            if path.suffix in (".sql", ".csv", ".prices"):
+                shutil.copy(str(path), fullDir)
+        makeTradeDB(fullDir).close()
+        return tableContents(fullDir)
+    finally:
+        shutil.rmtree(fullDir, True)
+
+
+def editSource(dataDir, name, edit):
+    """
+    Replaces the lines of a source file with edit(lines) and makes it
+    newer than the cache.
+    """
+    path = Path(dataDir) / name
+    with path.open() as fh:
+        lines = fh.read().splitlines()
+    with path.open("w") as fh:
+        fh.write("\n".join(edit(lines)) + "\n")
+    later = (Path(dataDir) / "TradeDangerous.db").stat().st_mtime + 10
+    os.utime(str(path), (later, later))
+
+
+def test_update_cache_matches_full_rebuild():
+    dataDir = makeDataDir()
+    makeTradeDB(dataDir).close()
+    before = tableContents(dataDir)
+
+    # Touched but the same: nothing is imported again.
+    editSource(dataDir, "Item.csv", lambda lines: lines)
+    makeTradeDB(dataDir).close()
+    assert tableContents(dataDir) == before
+
+    # A station changes and one is added: Station is imported again.
+    editSource(dataDir, "Station.csv", lambda lines: (
+        [lines[0], lines[1].replace(",'2017-01-01", ",'2017-02-02")]
+        + lines[2:] + ["'SYS 0','New Port',123,'Y','L','Y','N','2017-03-03 00:00:00',"
+                       "'Y','Y','Y','Y','N'"]
+    ))
+    makeTradeDB(dataDir).close()
+    updated = tableContents(dataDir)
+    assert updated != before
+    assert updated == rebuiltContents(dataDir)
+
+    # A system moves and one is added: everything that refers to
+    # System, and the prices, are imported again.
+    editSource(dataDir, "System.csv", lambda lines: (
+        lines[:2] + ["'SYS 1',1.5,2.5,3.5,'','2017-03-03 00:00:00'"]
+        + lines[3:] + ["'SYS NEW',4.5,5.5,6.5,'','2017-03-03 00:00:00'"]
+    ))
+    makeTradeDB(dataDir).close()
+    updated = tableContents(dataDir)
+    assert updated == rebuiltContents(dataDir)
+    assert ("SYS NEW",) in [row[1:2] for row in updated["System"]]
+
+
+def test_parallel_import_matches_serial():
+    serialDir, parallelDir = makeDataDir(), makeDataDir()
+    makeTradeDB(serialDir, cacheWorkers=1).close()
+    makeTradeDB(parallelDir, cacheWorkers=4).close()
+    serial = tableContents(serialDir)
+    assert serial["Station"] and serial["StationItem"]
+    assert tableContents(parallelDir) == serial
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# Noses test file
+
+from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
+import random
+import tradeenv
+from test_tradedb import makeDataDir, makeTradeDB, runWithAndWithoutNumpy
+from tradecalc import Route, TradeCalc
+from tradedb import Trade
+
+
+def randomItems(rand):
+    """
+    A few items with small costs and gains; supply is unknown (-1),
+    none listed (0) or limited.
+    """
+    return [
+        Trade(
+            "Item{}".format(number),
+            rand.randint(1, 60), rand.randint(1, 40),
+            rand.choice((-1, 0, rand.randint(1, 8))), 0,
+            0, 0, 0, 0,
+        )
+        for number in range(rand.randint(1, 4))
+    ]
+
+
+def test_exact_fit_matches_brute_force():
+    # The fitters don't touch the DB, so there's no need for one.
+    calc = TradeCalc.__new__(TradeCalc)
+    rand = random.Random(1)
+    for _ in range(500):
+        items = randomItems(rand)
+        credits = rand.randint(0, 400)
+        capacity = rand.randint(1, 12)
+        maxUnits = rand.randint(1, capacity)
+        expected = calc.bruteForceFit(items, credits, capacity, maxUnits)
+        load = calc.exactFit(items, credits, capacity, maxUnits)
+        case = (items, credits, capacity, maxUnits)
+        assert (load.gainCr, load.units, load.costCr) == (
+            expected.gainCr, expected.units, expected.costCr
+        ), case
+        assert load.costCr <= credits, case
+        assert load.units <= capacity, case
+        for item, qty in load.items:
+            assert qty <= maxUnits, case
+            if item.supply > 0:
+                assert qty <= item.supply, case
+        assert sum(qty for _, qty in load.items) == load.units, case
+        assert sum(item.gainCr * qty for item, qty in load.items) == load.gainCr, case
+        assert sum(item.costCr * qty for item, qty in load.items) == load.costCr, case
+
+
+def tradeValues(trades):
+    """ What getTrades found, less the ages of the prices. """
+    if trades is None:
+        return None
+    return [trade[:7] for trade in trades]
+
+
+def checkTradesTo(dataDir):
+    tdb = makeTradeDB(dataDir)
+    stations = sorted(tdb.stationByID.values(), key=lambda stn: stn.ID)[:80]
+    calc = TradeCalc(tdb)
+    expected = {}
+    for src in stations:
+        expected[src] = [(dst, calc.getTrades(src, dst)) for dst in stations]
+        assert list(calc.getTradesTo(src, stations)) == expected[src]
+    assert any(trades for src in stations for _, trades in expected[src])
+
+    # The same again with the prices loaded a few stations at a time.
+    lazy = TradeCalc(tdb, tradeenv.TradeEnv(tdb.tdenv, lazyPrices=True))
+    for first in range(0, len(stations), 7):
+        lazy.loadStations(stations[first:first + 7])
+    for src in stations:
+        assert [
+            (dst, tradeValues(trades))
+            for dst, trades in lazy.getTradesTo(src, stations)
+        ] == [
+            (dst, tradeValues(trades)) for dst, trades in expected[src]
+        ]
+
+
+def test_trades_to_matches_get_trades():
+    runWithAndWithoutNumpy(checkTradesTo, makeDataDir())
+
+
+def hopCalc(tdb, **kwargs):
+    """ A TradeCalc for 'run' style hops, using exactFit. """
+    tdenv = tradeenv.TradeEnv(
+        tdb.tdenv, credits=20000, capacity=30, maxJumpsPer=2, maxLyPer=12,
+        margin=0, **kwargs
+    )
+    calc = TradeCalc(tdb, tdenv)
+    calc.defaultFit = calc.exactFit
+    return calc
+
+
+def bestHopsTheSlowWay(calc, routes):
+    """
+    {dstID: (score, from station ID, gain)} of the best hop to each
+    station, fitting every trade from every route without pruning.
+    """
+    tdenv = calc.tdenv
+    _, destinations = calc._destinationFinder()
+    best = {}
+    for routeNo, route in enumerate(routes):
+        src = route.lastStation
+        startCr = tdenv.credits + route.gainCr
+        for dest in destinations(src):
+            if dest.station is src:
+                continue
+            trades = calc.getTrades(src, dest.station)
+            if not trades:
+                continue
+            load = calc.exactFit(trades, startCr, tdenv.capacity, tdenv.capacity)
+            if not load.units:
+                continue
+            key = (route.score + load.gainCr, -dest.distLy, -routeNo)
+            if dest.station.ID not in best or key > best[dest.station.ID][0]:
+                best[dest.station.ID] = (key, src.ID, load.gainCr)
+    return {dstID: (key[0], srcID, gain) for dstID, (key, srcID, gain) in best.items()}
+
+
+def bestHops(routes):
+    return {
+        route.lastStation.ID: (route.score, route.parent.lastStation.ID, route.hops[-1].gainCr)
+        for route in routes
+    }
+
+
+def test_best_hops_match_unpruned_fits():
+    tdb = makeTradeDB(makeDataDir())
+    stations = sorted(
+        (stn for stn in tdb.stationByID.values() if stn.itemCount),
+        key=lambda stn: stn.ID
+    )[:30]
+    for fitCacheSize in (0, None):
+        calc = hopCalc(tdb, fitCacheSize=fitCacheSize)
+        routes = [Route((stn,), (), calc.tdenv.credits, 0, (), 0) for stn in stations]
+        # The second hop reuses what the first learned about the trades.
+        for _ in range(3):
+            expected = bestHopsTheSlowWay(calc, routes)
+            assert expected
+            routes = calc.getBestHops(routes)
+            assert bestHops(routes) == expected
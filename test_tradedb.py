@@ -0,0 +1,369 @@
+#! /usr/bin/env python
+# Noses test file
+
+from __future__ import absolute_import, with_statement, print_function, division, unicode_literals
+import atexit
+import csv
+import heapq
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import tradedb
+import tradeenv
+from pathlib import Path
+
+
+def writeDataDir(dataDir, seed=1, systemCount=300):
+    """
+    Writes the .csv and .prices files for a small made up bubble of
+    systems, with a station or two in most of them, into dataDir.
+    """
+    rand = random.Random(seed)
+    dataDir = Path(dataDir)
+    for name in ("TradeDangerous.sql", "Added.csv", "Category.csv", "Item.csv"):
+        shutil.copy(str(Path("data") / name), str(dataDir / name))
+    with (dataDir / "System.csv").open("w") as fh:
+        fh.write("unq:name,pos_x,pos_y,pos_z,name@Added.added_id,modified\n")
+        for number in range(systemCount):
+            pos = [rand.uniform(-40, 40) for _ in range(3)]
+            fh.write("'SYS {}',{:.5f},{:.5f},{:.5f},'','2017-01-01 00:00:00'\n".format(number, *pos))
+    stations = []
+    with (dataDir / "Station.csv").open("w") as fh:
+        fh.write(
+            "unq:name@System.system_id,unq:name,ls_from_star,blackmarket,"
+            "max_pad_size,market,shipyard,modified,outfitting,rearm,refuel,"
+            "repair,planetary\n"
+        )
+        for number in range(systemCount):
+            for stnNo in range(rand.randint(0, 2)):
+                stations.append(("SYS {}".format(number), "Port {}".format(stnNo)))
+                fh.write("'{}','{}',{},'{}','{}','{}','{}','2017-01-01 00:00:00',"
+                         "'{}','{}','{}','{}','{}'\n".format(
+                    stations[-1][0], stations[-1][1], rand.randint(0, 5000),
+                    rand.choice('?YN'), rand.choice('?SML'), rand.choice('?YN'),
+                    rand.choice('?YN'), rand.choice('?YN'), rand.choice('?YN'),
+                    rand.choice('?YN'), rand.choice('?YN'), rand.choice('?YN'),
+                ))
+    with (Path("data") / "Item.csv").open() as fh:
+        items = [row[1] for row in list(csv.reader(fh, quotechar="'"))[1:]]
+    with (dataDir / "TradeDangerous.prices").open("w") as fh:
+        for system, station in stations:
+            fh.write("@ {}/{}\n".format(system, station))
+            for item in rand.sample(items, 20):
+                sell = rand.randint(100, 5000)
+                buy = rand.randint(100, 5000) if rand.random() < 0.5 else 0
+                supply = "{}M".format(rand.randint(10, 5000)) if buy else "-"
+                fh.write("   {} {} {} {}H {} 2017-05-01 12:00:00\n".format(
+                    item, sell, buy, rand.randint(1, 9999), supply
+                ))
+
+
+def makeDataDir():
+    """ A temporary directory with a made up bubble, see writeDataDir. """
+    dataDir = tempfile.mkdtemp(prefix="tdtest")
+    atexit.register(shutil.rmtree, dataDir, True)
+    writeDataDir(dataDir)
+    return dataDir
+
+
+def runWithAndWithoutNumpy(check, dataDir):
+    """
+    Runs check(dataDir) here, and in a child process with numpy the
+    other way around, since numpy is picked when tradedb is imported.
+    """
+    check(dataDir)
+    env = dict(os.environ, NUMPY="" if tradedb.haveNumpy else "1")
+    subprocess.check_call([
+        sys.executable, "-c",
+        "import sys, {0}; {0}.{1}(sys.argv[1])".format(
+            check.__module__, check.__name__
+        ),
+        dataDir,
+    ], env=env, cwd=str(Path(__file__).resolve().parent))
+
+
+def makeTradeDB(dataDir=None, **kwargs):
+    """
+    Returns a TradeDB of the made up bubble in dataDir, or in a new
+    temporary directory; the DB is built on first use.
+    """
+    if dataDir is None:
+        dataDir = makeDataDir()
+    tdenv = tradeenv.TradeEnv(dataDir=str(dataDir), quiet=1, **kwargs)
+    return tradedb.TradeDB(tdenv)
+
+
+_sharedDB = None
+
+
+def sharedTradeDB():
+    """ One TradeDB for the tests that don't change it. """
+    global _sharedDB
+    if _sharedDB is None:
+        _sharedDB = makeTradeDB()
+    return _sharedDB
+
+
+def test_system_graph_matches_stellar_grid():
+    tdb = sharedTradeDB()
+    systems = sorted(tdb.systemByID.values(), key=lambda system: system.ID)
+    graph = tdb.getSystemGraph(12)
+    assert graph.ly >= 12
+    found = 0
+    for ly in (5, 8.5, 12):
+        for system in systems[::7]:
+            expected = list(tdb.genSystemsInRange(system, ly))
+            assert list(graph.genSystemsInRange(system, ly)) == expected
+            found += len(expected)
+    assert found > 100
+    # Saved beside the DB and read back the same.
+    tdb.systemGraph = None
+    saved = tdb.getSystemGraph(12, build=False)
+    assert saved is not graph
+    for system in systems[::7]:
+        assert list(saved.genSystemsInRange(system, 12)) == list(graph.genSystemsInRange(system, 12))
+
+
+def test_list_search_word_matches():
+    names = ["Solati", "Sol Port", "LHS 10", "LHS 1 (A)", "Wolf 359"]
+    search = lambda lookup: tradedb.TradeDB.listSearch("Place", lookup, names)
+    # Starting with a whole word beats containing it.
+    assert search("sol") == "Sol Port"
+    assert search("sola") == "Solati"
+    # Regex characters in the lookup are only characters.
+    assert search("lhs 1 (") == "LHS 1 (A)"
+    assert search("lhs 1") == "LHS 1 (A)"
+    assert search("f 3") == "Wolf 359"
+    try:
+        search("l")
+    except tradedb.AmbiguityError:
+        pass
+    else:
+        assert False, "'l' should be ambiguous"
+
+
+def checkSystemsInRange(dataDir):
+    tdb = makeTradeDB(dataDir)
+    systems = sorted(tdb.systemByID.values(), key=lambda system: system.ID)
+    found = 0
+    for ly in (3, 7.5, 15, 40):
+        for system in systems[::11]:
+            expected = sorted(
+                (other.distanceTo(system), other.ID)
+                for other in systems
+                if other is not system and other.distanceTo(system) <= ly
+            )
+            inRange = list(tdb.genSystemsInRange(system, ly))
+            dists = [dist for _, dist in inRange]
+            assert dists == sorted(dists)
+            assert sorted((dist, other.ID) for other, dist in inRange) == expected
+            found += len(expected)
+    assert found > 1000
+
+
+def test_systems_in_range_match_every_distance():
+    runWithAndWithoutNumpy(checkSystemsInRange, makeDataDir())
+
+
+def test_range_cache_stays_bounded_and_right():
+    dataDir = sharedTradeDB().dataPath
+    cached = makeTradeDB(dataDir, rangeCacheSize=200)
+    uncached = makeTradeDB(dataDir, rangeCacheSize=0)
+    systems = sorted(cached.systemByID.values(), key=lambda system: system.ID)
+    rand = random.Random(2)
+    for _ in range(2000):
+        system = rand.choice(systems[:40])
+        ly = rand.choice((4, 8, 12, 20))
+        expected = [
+            (other.ID, dist) for other, dist in
+            uncached.genSystemsInRange(uncached.systemByID[system.ID], ly)
+        ]
+        assert [
+            (other.ID, dist) for other, dist in
+            cached.genSystemsInRange(system, ly)
+        ] == expected
+        cache = cached.rangeCache
+        assert cache.neighbours == sum(len(near) for _, near in cache.entries.values())
+        assert cache.neighbours <= 200 or len(cache.entries) == 1
+    assert cache.hits and cache.evictions
+    assert not uncached.rangeCache.entries
+
+
+def routeLengths(tdb, origin, ly, avoiding=()):
+    """
+    Plain Dijkstra over genSystemsInRange: {system: shortest route
+    length} for every system reachable from origin.
+    """
+    lengths, openSet = {origin: 0}, [(0, origin.ID, origin)]
+    while openSet:
+        length, _, system = heapq.heappop(openSet)
+        if length > lengths[system]:
+            continue
+        for other, dist in tdb.genSystemsInRange(system, ly):
+            if other in avoiding or length + dist >= lengths.get(other, math.inf):
+                continue
+            lengths[other] = length + dist
+            heapq.heappush(openSet, (length + dist, other.ID, other))
+    return lengths
+
+
+def shortestRouteLength(tdb, origin, dest, ly, avoiding=()):
+    """ inf if there's no route. """
+    return routeLengths(tdb, origin, ly, avoiding).get(dest, math.inf)
+
+
+def checkRoute(route, origin, dest, ly, avoiding):
+    assert route[0] == (origin, 0)
+    assert route[-1][0] is dest
+    total = 0
+    for (system, _), (nextSystem, soFar) in zip(route, route[1:]):
+        assert nextSystem not in avoiding
+        jumpLy = system.distanceTo(nextSystem)
+        assert jumpLy <= ly
+        total += jumpLy
+        assert abs(soFar - total) < 1e-6
+
+
+def test_routes_are_shortest():
+    dataDir = sharedTradeDB().dataPath
+    withLandmarks, withoutGraph = makeTradeDB(dataDir), makeTradeDB(dataDir)
+    for tdb in (withLandmarks, withoutGraph):
+        # Only the search itself, not routes cached from before.
+        tdb.routeCacheStamp = False
+    withoutGraph.systemGraph, withoutGraph.systemGraphJumps = False, math.inf
+    rand = random.Random(3)
+    routes = 0
+    for ly in (7, 10, 15):
+        withLandmarks.getSystemGraph(ly).findLandmarks(withLandmarks.routeLandmarks)
+        systems = sorted(withLandmarks.systemByID.values(), key=lambda system: system.ID)
+        for _ in range(30):
+            origin, dest, *avoiding = rand.sample(systems, rand.choice((2, 5)))
+            expected = shortestRouteLength(withLandmarks, origin, dest, ly, avoiding)
+            for tdb in (withLandmarks, withoutGraph):
+                byID = tdb.systemByID
+                route = tdb.getRoute(
+                    byID[origin.ID], byID[dest.ID], ly,
+                    [byID[system.ID] for system in avoiding]
+                )
+                if expected == math.inf:
+                    assert route is None
+                    continue
+                checkRoute(
+                    route, byID[origin.ID], byID[dest.ID], ly,
+                    [byID[system.ID] for system in avoiding]
+                )
+                assert abs(route[-1][1] - expected) < 1e-6
+                routes += 1
+    assert routes > 50
+
+
+def test_route_cache_reuses_parts_of_routes():
+    dataDir = makeDataDir()
+    tdb = makeTradeDB(dataDir)
+    conn = tdb.getDB()
+    dbStamp = tdb._snapshotStamp(conn)
+    systems = sorted(tdb.systemByID.values(), key=lambda system: system.ID)
+    # The first long route at 10ly, to have plenty of parts.
+    for origin in systems:
+        lengths = routeLengths(tdb, origin, 10)
+        dest = max(lengths, key=lengths.get)
+        route = tdb.getRoute(origin, dest, 10)
+        if len(route) > 12:
+            break
+    assert len(route) > 12
+    # Saving it doesn't change the DB.
+    assert tdb._snapshotStamp(conn) == dbStamp
+    tdb.close()
+
+    cached, uncached = makeTradeDB(dataDir), makeTradeDB(dataDir)
+    uncached.routeCacheStamp = False
+
+    def noSearching(*args):
+        raise AssertionError("route should have come from the cache")
+    findRoute, cached._findRoute = cached._findRoute, noSearching
+    rand = random.Random(4)
+    for _ in range(30):
+        first, last = sorted(rand.sample(range(len(route)), 2))
+        if rand.random() < 0.5:
+            first, last = last, first
+        fromID, toID = route[first][0].ID, route[last][0].ID
+        part = cached.getRoute(cached.systemByID[fromID], cached.systemByID[toID], 10)
+        checkRoute(part, cached.systemByID[fromID], cached.systemByID[toID], 10, ())
+        fresh = uncached.getRoute(uncached.systemByID[fromID], uncached.systemByID[toID], 10)
+        assert abs(part[-1][1] - fresh[-1][1]) < 1e-6
+    # Other ranges aren't answered from it.
+    cached._findRoute = findRoute
+    cached.routeCacheSize = 3
+    origin = cached.systemByID[origin.ID]
+    for other in systems[:7]:
+        cached.getRoute(origin, cached.systemByID[other.ID], 12)
+    routeIDs = cached.routeCacheDB.execute("SELECT route_id FROM RouteCache").fetchall()
+    jumpIDs = cached.routeCacheDB.execute(
+        "SELECT DISTINCT route_id FROM RouteCacheJump"
+    ).fetchall()
+    assert len(routeIDs) == 3
+    assert sorted(jumpIDs) == sorted(routeIDs)
+
+
+def stationMeets(stn, avoidStations, maxPadSize, maxLsFromStar, noPlanet, planetary):
+    """ getStationFilter's checks, one attribute at a time. """
+    if noPlanet and stn.planetary != 'N':
+        return False
+    if stn in avoidStations:
+        return False
+    if not stn.checkPadSize(maxPadSize) or not stn.checkPlanetary(planetary):
+        return False
+    if maxLsFromStar and not 0 < stn.lsFromStar <= maxLsFromStar:
+        return False
+    return True
+
+
+def checkStationFilters(dataDir):
+    tdb = makeTradeDB(dataDir)
+    stations = sorted(tdb.stationByID.values(), key=lambda stn: stn.ID)
+
+    def checkFilters():
+        # The same filters each time, so remembered ones get used.
+        rand = random.Random(5)
+        for _ in range(60):
+            kwargs = dict(
+                maxPadSize=rand.choice((None, "", "L", "ML?", "S?")),
+                maxLsFromStar=rand.choice((0, 500, 2500)),
+                noPlanet=rand.random() < 0.3,
+                planetary=rand.choice((None, "Y", "N?", "?")),
+            )
+            avoiding = rand.sample(stations, rand.choice((0, 3)))
+            stationFilter = tdb.getStationFilter(avoidPlaces=avoiding, **kwargs)
+            for stn in stations:
+                assert stationFilter(stn) == stationMeets(stn, avoiding, **kwargs), (stn, kwargs)
+
+    checkFilters()
+    rand = random.Random(6)
+    # Every other attribute, straight from a mask.
+    for attr, values in tradedb.StationFeatures.attributes:
+        for _ in range(5):
+            allowed = "".join(rand.sample(values, rand.randint(1, len(values))))
+            mask = tradedb.StationFeatures.compile(**{attr: allowed})
+            for stn in stations:
+                assert (not stn.features & mask) == (getattr(stn, attr) in allowed)
+    # Filters that were remembered don't outlive a change to a station.
+    # (The next value along, so that each run changes something.)
+    for stn in stations[::5]:
+        tdb.updateLocalStation(
+            stn,
+            lsFromStar=(stn.lsFromStar + 1000) % 5000,
+            maxPadSize='?SML'[('?SML'.index(stn.maxPadSize) + 1) % 4],
+            planetary='?YN'[('?YN'.index(stn.planetary) + 1) % 3],
+            force=True,
+            commit=False,
+        )
+    tdb.getDB().commit()
+    checkFilters()
+
+
+def test_station_filters_match_attribute_checks():
+    runWithAndWithoutNumpy(checkStationFilters, makeDataDir())
@@ -33,21 +33,30 @@ Classes:
 ######################################################################
 # Imports
 
+from collections import Counter
 from collections import defaultdict
 from collections import namedtuple
+from collections import OrderedDict
 from tradedb import System, Station, Trade, TradeDB, describeAge
-from tradedb import Destination
+from tradedb import Destination, haveNumpy
 from tradeexcept import TradeException
 
+import bisect
 import datetime
+import heapq
+import itertools
 import locale
 import math
 import os
 import misc.progress as pbar
+import multiprocessing
 import re
 import sys
 import time
 
+if haveNumpy:
+    import numpy
+
 locale.setlocale(locale.LC_ALL, '')
 
 ######################################################################
@@ -135,49 +144,103 @@ class Route(object):
     jump to System3, dock at Station B, sell everything, buy gold,
     jump to system4 and sell everything at Station X.
     """
-    __slots__ = ('route', 'hops', 'startCr', 'gainCr', 'jumps', 'score')
+    __slots__ = (
+        'parent', 'lastStation', 'hop', 'hopJumps', 'numHops',
+        'startCr', 'gainCr', 'score',
+    )
 
     def __init__(self, stations, hops, startCr, gainCr, jumps, score):
+        """
+        Routes are stored as a chain of nodes, each of which has the
+        station it ends at, the hop and jumps that got it there and
+        a reference to the route before it; so that plus() doesn't
+        have to copy the route so far. .route, .hops and .jumps are
+        put together when something asks for them.
+        """
         assert stations
-        self.route = stations
-        self.hops = hops
+        assert len(hops) == len(jumps) == len(stations) - 1
+        parent = None
+        for hopNo, station in enumerate(stations[:-1]):
+            node = Route.__new__(Route)
+            node._link(
+                parent, station,
+                hops[hopNo - 1] if hopNo else None,
+                jumps[hopNo - 1] if hopNo else None,
+            )
+            node.startCr, node.gainCr, node.score = startCr, None, None
+            parent = node
+        self._link(
+            parent, stations[-1],
+            hops[-1] if hops else None,
+            jumps[-1] if jumps else None,
+        )
         self.startCr = startCr
         self.gainCr = gainCr
-        self.jumps = jumps
         self.score = score
 
+    def _link(self, parent, station, hop, jumps):
+        self.parent = parent
+        self.lastStation = station
+        self.hop = hop
+        self.hopJumps = jumps
+        self.numHops = parent.numHops + 1 if parent else 0
+
+    def _nodes(self):
+        """ Returns the nodes of the route, first station first. """
+        nodes, node = [], self
+        while node:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    @property
+    def route(self):
+        """ The stations visited, starting with the first. """
+        return tuple(node.lastStation for node in self._nodes())
+
+    @property
+    def hops(self):
+        """ The (TradeLoad, gainCr) for each hop. """
+        return tuple(node.hop for node in self._nodes()[1:])
+
+    @property
+    def jumps(self):
+        """ The systems jumped through on each hop. """
+        return tuple(node.hopJumps for node in self._nodes()[1:])
+
     @property
     def firstStation(self):
         """ Returns the first station in the route. """
-        return self.route[0]
+        node = self
+        while node.parent:
+            node = node.parent
+        return node.lastStation
 
     @property
     def firstSystem(self):
         """ Returns the first system in the route. """
-        return self.route[0].system
-
-    @property
-    def lastStation(self):
-        """ Returns the last station in the route. """
-        return self.route[-1]
+        return self.firstStation.system
 
     @property
     def lastSystem(self):
         """ Returns the last system in the route. """
-        return self.route[-1].system
+        return self.lastStation.system
 
     @property
     def avggpt(self):
-        if self.hops:
-            return sum(hop.gpt for hop in self.hops) // len(self.hops)
+        hops = self.hops
+        if hops:
+            return sum(hop.gpt for hop in hops) // len(hops)
         return 0
 
     @property
     def gpt(self):
-        if self.hops:
+        hops = self.hops
+        if hops:
             return (
-                sum(hop.gainCr for hop in self.hops) //
-                sum(hop.units for hop in self.hops)
+                sum(hop.gainCr for hop in hops) //
+                sum(hop.units for hop in hops)
             )
         return 0
 
@@ -185,24 +248,22 @@ class Route(object):
         """
         Returns a new route describing the sum of this route plus a new hop.
         """
-        return Route(
-            self.route + (dst,),
-            self.hops + (hop,),
-            self.startCr,
-            self.gainCr + hop[1],
-            self.jumps + (jumps,),
-            self.score + score,
-        )
+        route = Route.__new__(Route)
+        route._link(self, dst, hop, jumps)
+        route.startCr = self.startCr
+        route.gainCr = self.gainCr + hop[1]
+        route.score = self.score + score
+        return route
 
     def __lt__(self, rhs):
         # One route is less than the other if it has a higher score,
         # or the scores are even and the number of jumps are shorter.
         if self.score == rhs.score:
-            return len(self.jumps) < len(rhs.jumps)
+            return self.numHops < rhs.numHops
         return self.score > rhs.score
 
     def __eq__(self, rhs):
-        return self.score == rhs.score and len(self.jumps) == len(rhs.jumps)
+        return self.score == rhs.score and self.numHops == rhs.numHops
 
     def str(self):
         return "%s -> %s" % (self.firstStation.name(), self.lastStation.name())
@@ -219,6 +280,7 @@ class Route(object):
         route = self.route
 
         hops = self.hops
+        routeJumps = self.jumps
 
         # TODO: Write as a comprehension, just can't wrap my head
         # around it this morning.
@@ -370,12 +432,12 @@ class Route(object):
                 station=decorateStation(route[i]),
                 purchases=purchases
             )
-            if tdenv.showJumps and jumpsFmt and self.jumps[i]:
+            if tdenv.showJumps and jumpsFmt and routeJumps[i]:
                 startStn = route[i]
                 endStn = route[i+1]
                 if startStn.system is not endStn.system:
                     fmt = jumpsFmt
-                    travelled, jumps = jumpList(self.jumps[i])
+                    travelled, jumps = jumpList(routeJumps[i])
                 else:
                     fmt = cruiseFmt
                     travelled, jumps = 0., "{start} >>> {stop}".format(
@@ -388,7 +450,7 @@ class Route(object):
                     credits=credits + gainCr + hopGainCr,
                     stn=route[i+1].dbname
                 )
-                if travelled and distFmt and len(self.jumps[i]) > 2:
+                if travelled and distFmt and len(routeJumps[i]) > 2:
                     text += distFmt.format(
                         dist=startStn.system.distanceTo(endStn.system),
                         trav=travelled,
@@ -452,6 +514,17 @@ class TradeCalc(object):
     Container for accessing trade calculations with common properties.
     """
 
+    # Default number of fit results getBestHops remembers.
+    defaultFitCacheSize = 50000
+    # Number of station-to-station trade bounds getBestHops remembers.
+    tradeBoundsSize = 200000
+    # Number of systems getBestHops keeps the destination lists of.
+    destCacheSize = 64
+    # Number of systems systemDistances keeps the distances from.
+    systemDistsSize = 16
+    # Most stations loadStations asks the DB for in one statement.
+    loadChunkSize = 500
+
     def __init__(self, tdb, tdenv=None, fit=None, items=None):
         """
         Constructs the TradeCalc object and loads sell/buy data.
@@ -475,18 +548,41 @@ class TradeCalc(object):
                 Require at least this much supply to load an item
             tdenv.demand
                 Require at least this much demand to load an item
+            tdenv.fitCacheSize
+                Number of fit results to remember between hops,
+                0 disables the cache
+            tdenv.lazyPrices
+                Only load the prices for a station when it is first
+                needed, see loadStations()
         """
         if not tdenv:
             tdenv = tdb.tdenv
         self.tdb = tdb
         self.tdenv = tdenv
         self.defaultFit = fit or self.fastFit
+        if "EXACT_FIT" in os.environ:
+            self.defaultFit = self.exactFit
         if "BRUTE_FIT" in os.environ:
             self.defaultFit = self.bruteForceFit
-        minSupply = self.tdenv.supply or 0
-        minDemand = self.tdenv.demand or 0
-
-        db = tdb.getDB()
+        fitCacheSize = getattr(tdenv, 'fitCacheSize', None)
+        if fitCacheSize is None:
+            fitCacheSize = self.defaultFitCacheSize
+        self.fitCacheSize = fitCacheSize
+        self.fitCache = OrderedDict()
+        self.fitCacheHits = self.fitCacheMisses = 0
+        # What getBestHops has learned about the trades from one station
+        # to another: the credits they hold good below, the most they
+        # could gain, the best gain per credit and the best gain per ton.
+        # Kept for the most recently used source stations, up to
+        # tradeBoundsSize in all.
+        self.tradeBounds = OrderedDict()
+        self.tradeBoundsCount = 0
+        # Distances from the --towards goal and route origins to every
+        # system, by System.row, when using numpy; see systemDistances.
+        self.systemCoords = None
+        self.systemDists = OrderedDict()
+        self.minSupply = self.tdenv.supply or 0
+        self.minDemand = self.tdenv.demand or 0
 
         wheres, binds = [], []
         if tdenv.maxAge:
@@ -495,6 +591,7 @@ class TradeCalc(object):
             wheres.append("(modified >= ?)")
             binds.append(str(cutoff.replace(microsecond=0)))
 
+        loadItemIDs = None
         if tdenv.avoidItems or items:
             avoidItemIDs = set(item.ID for item in tdenv.avoidItems)
             loadItems = items or tdb.itemByID.values()
@@ -502,30 +599,129 @@ class TradeCalc(object):
             for item in loadItems:
                 ID = item if isinstance(item, int) else item.ID
                 if ID not in avoidItemIDs:
-                    loadItemIDs.add(str(ID))
+                    loadItemIDs.add(ID)
             if not loadItemIDs:
                 raise TradeException("No items to load.")
-            loadItemIDs = ",".join(str(ID) for ID in loadItemIDs)
-            wheres.append("(item_id IN ({}))".format(loadItemIDs))
-
-        demand = self.stationsBuying = defaultdict(list)
-        supply = self.stationsSelling = defaultdict(list)
-
-        whereClause = " AND ".join(wheres) or "1"
+            wheres.append("(item_id IN ({}))".format(
+                ",".join(str(ID) for ID in loadItemIDs)
+            ))
+        self.priceWheres, self.priceBinds = wheres, binds
+        self.priceItemIDs = loadItemIDs
+
+        self.stationsBuying = defaultdict(list)
+        self.stationsSelling = defaultdict(list)
+        # Best price each station pays for anything, so getBestHops can
+        # tell when a station can't possibly be worth going to.
+        self.maxBuyPrice = {}
+
+        if getattr(tdenv, 'lazyPrices', False):
+            # Stations get loaded as they are needed; see loadStations.
+            self.loadedStationIDs = set()
+            whereClause = " AND ".join(wheres) or "1"
+            db = tdb.getDB()
+            itemBuyPrice = dict(db.execute("""
+                    SELECT  item_id, MAX(demand_price)
+                      FROM  StationItem
+                     WHERE  {where}
+                            AND demand_price > 0
+                     GROUP  BY item_id
+            """.format(where=whereClause), binds))
+            itemSellPrice = dict(db.execute("""
+                    SELECT  item_id, MIN(supply_price)
+                      FROM  StationItem
+                     WHERE  {where}
+                            AND supply_price > 0 AND supply_units > 0
+                     GROUP  BY item_id
+            """.format(where=whereClause), binds))
+            self._setGainBounds(itemBuyPrice, itemSellPrice)
+            return
+
+        self.loadedStationIDs = None
+        self._loadPrices()
+        itemBuyPrice, itemSellPrice = {}, {}
+        for buying in self.stationsBuying.values():
+            for itemID, price, *_ in buying:
+                if price > itemBuyPrice.get(itemID, 0):
+                    itemBuyPrice[itemID] = price
+        for selling in self.stationsSelling.values():
+            for itemID, price, *_ in selling:
+                if price < itemSellPrice.get(itemID, price + 1):
+                    itemSellPrice[itemID] = price
+        self._setGainBounds(itemBuyPrice, itemSellPrice)
+
+        if haveNumpy:
+            self._loadPriceArrays()
+
+    def _setGainBounds(self, itemBuyPrice, itemSellPrice):
+        """
+        Works out what routeGainBound needs from the best price paid
+        for each item, and the lowest price each item is sold for.
+        """
+        self.itemBuyPrice = itemBuyPrice
+        # Best anyone could make on a ton, and on a credit spent, of
+        # anything anywhere.
+        self.bestGainPerTon, self.bestGainPerCr = 0, 0
+        for itemID, costCr in itemSellPrice.items():
+            gainCr = itemBuyPrice.get(itemID, 0) - costCr
+            if gainCr > 0:
+                self.bestGainPerTon = max(self.bestGainPerTon, gainCr)
+                self.bestGainPerCr = max(self.bestGainPerCr, gainCr / costCr)
+        # The same for each station, as needed; see _stationGainBounds.
+        self.stationGainBounds = {}
+        # Best price paid for each item a hop from a system.
+        self.reachBuyPrices = OrderedDict()
+
+    def loadStations(self, stations):
+        """
+        Makes sure the prices for the given stations (Station or
+        station IDs) have been loaded; only does anything when
+        tdenv.lazyPrices was set, otherwise everything is loaded
+        up front.
+        """
+        loaded = self.loadedStationIDs
+        if loaded is None:
+            return
+        stationIDs = set(
+            station if isinstance(station, int) else station.ID
+            for station in stations
+        )
+        stationIDs.difference_update(loaded)
+        if not stationIDs:
+            return
+        loaded.update(stationIDs)
+        self._loadPrices(stationIDs)
+        if haveNumpy:
+            self._loadPriceArrays(stationIDs)
+
+    def _loadPrices(self, stationIDs=None):
+        """
+        Loads the StationItem prices for the given station IDs,
+        or for every station.
+        """
+        tdenv = self.tdenv
+        minSupply, minDemand = self.minSupply, self.minDemand
+        demand, supply = self.stationsBuying, self.stationsSelling
+
+        cur = self._snapshotPrices(stationIDs)
+        if cur is None:
+            tdenv.DEBUG1("TradeCalc loading StationItem values")
+            if stationIDs is None:
+                cur = self._queryPrices(self.priceWheres)
+            else:
+                # A few hundred stations at a time, to keep the
+                # statements well inside SQLite's limits.
+                stnIDs = sorted(stationIDs)
+                cur = itertools.chain.from_iterable(
+                    self._queryPrices(self.priceWheres + [
+                        "(station_id IN ({}))".format(",".join(
+                            str(ID) for ID in stnIDs[i:i + self.loadChunkSize]
+                        ))
+                    ])
+                    for i in range(0, len(stnIDs), self.loadChunkSize)
+                )
 
         lastStnID, stnAppend = 0, None
         dmdCount, supCount = 0, 0
-        stmt = """
-                SELECT  station_id, item_id,
-                        strftime('%s', modified),
-                        demand_price, demand_units, demand_level,
-                        supply_price, supply_units, supply_level
-                  FROM  StationItem
-                 WHERE  {where}
-        """.format(where=whereClause)
-        tdenv.DEBUG1("TradeCalc loading StationItem values")
-        tdenv.DEBUG2("sql: {}, binds: {}", stmt, binds)
-        cur = db.execute(stmt, binds)
         now = int(time.time())
         for (stnID, itmID,
                 timestamp,
@@ -553,6 +749,117 @@ class TradeCalc(object):
 
         tdenv.DEBUG0("Loaded {} buys, {} sells".format(dmdCount, supCount))
 
+        if stationIDs is None:
+            stationIDs = set(demand)
+        for stnID in stationIDs:
+            buying = demand.get(stnID)
+            if buying:
+                self.maxBuyPrice[stnID] = max(values[1] for values in buying)
+
+    def _queryPrices(self, wheres):
+        """ Selects the StationItem rows matching wheres from the DB. """
+        binds = self.priceBinds
+        stmt = """
+                SELECT  station_id, item_id,
+                        strftime('%s', modified),
+                        demand_price, demand_units, demand_level,
+                        supply_price, supply_units, supply_level
+                  FROM  StationItem
+                 WHERE  {where}
+        """.format(where=" AND ".join(wheres) or "1")
+        self.tdenv.DEBUG2("sql: {}, binds: {}", stmt, binds)
+        return self.tdb.getDB().execute(stmt, binds)
+
+    def _snapshotPrices(self, stationIDs=None):
+        """
+        Returns the StationItem rows for the given station IDs, or
+        every station, from the TradeDB snapshot; or None when they
+        have to come from the DB.
+        """
+        if self.tdenv.maxAge:
+            return None
+        rows = self.tdb.snapshotPrices(stationIDs)
+        if rows is None:
+            return None
+        itemIDs = self.priceItemIDs
+        if itemIDs:
+            rows = (row for row in rows if row[1] in itemIDs)
+        return rows
+
+    def _loadPriceArrays(self, stationIDs=None):
+        """
+        Copies the loaded prices into dense numpy arrays with a row
+        per station and a column per item, so that getTradesTo can
+        work out the gains for many destinations at once.
+
+        Rows for stationIDs, or every station, are added to any
+        that are already there. The arrays are views of the first
+        rows of bigger ones which double in size when they fill up,
+        so that loading stations a few at a time doesn't copy all
+        the rows each time.
+        """
+        selling, buying = self.stationsSelling, self.stationsBuying
+        if stationIDs is None:
+            stationIDs = set(selling) | set(buying)
+        if not hasattr(self, 'stationRow'):
+            itemIDs = sorted(self.tdb.itemByID)
+            self.stationRow = {}
+            self.itemCol = {ID: col for col, ID in enumerate(itemIDs)}
+            itemByID = self.tdb.itemByID
+            self.colItems = [itemByID[ID] for ID in itemIDs]
+            # price, units, level, age (seconds) for selling, then buying
+            dtypes = (numpy.int32, numpy.int32, numpy.int8, numpy.int32)
+            self.priceBuffers = tuple(
+                numpy.zeros((0, len(itemIDs)), dtype) for dtype in dtypes * 2
+            )
+
+        stationRow, itemCol = self.stationRow, self.itemCol
+        stationIDs = sorted(
+            ID for ID in stationIDs
+            if ID not in stationRow and (selling.get(ID) or buying.get(ID))
+        )
+        if not stationIDs:
+            return
+        firstRow = len(stationRow)
+        for row, ID in enumerate(stationIDs, firstRow):
+            stationRow[ID] = row
+        rowCount = len(stationRow)
+
+        buffers = self.priceBuffers
+        if rowCount > len(buffers[0]):
+            size = max(rowCount, len(buffers[0]) * 2)
+            grown = []
+            for buffer in buffers:
+                newBuffer = numpy.zeros((size, len(itemCol)), buffer.dtype)
+                newBuffer[:firstRow] = buffer[:firstRow]
+                grown.append(newBuffer)
+            buffers = self.priceBuffers = tuple(grown)
+
+        def _fill(prices, arrays):
+            """ Fills in the new rows of price, units, level and age """
+            rows, cols, values = [], [], []
+            for stnID in stationIDs:
+                row = stationRow[stnID]
+                for stnValues in prices.get(stnID, ()):
+                    rows.append(row)
+                    cols.append(itemCol[stnValues[0]])
+                    values.append(stnValues[1:])
+            if values:
+                values = numpy.array(values, numpy.int64)
+                for arrNo, array in enumerate(arrays):
+                    array[rows, cols] = values[:, arrNo]
+
+        _fill(selling, buffers[:4])
+        _fill(buying, buffers[4:])
+        (
+            self.sellPrice, self.sellUnits, self.sellLevel, self.sellAge,
+            self.buyPrice, self.buyUnits, self.buyLevel, self.buyAge,
+        ) = (buffer[:rowCount] for buffer in buffers)
+        self.tdenv.DEBUG0(
+            "Price arrays: {:n} stations x {:n} items",
+            len(stationRow), len(itemCol),
+        )
+
     def bruteForceFit(self, items, credits, capacity, maxUnits):
         """
         Brute-force generation of all possible combinations of items.
@@ -699,6 +1006,275 @@ class TradeCalc(object):
 
         return _fitCombos(0, credits, capacity)
 
+    def exactFit(self, items, credits, capacity, maxUnits):
+        """
+            Best load calculator using a depth-first branch-and-bound
+            search over the quantity of each item.
+
+            Each branch is bounded by what the remaining items could
+            add if we only had to worry about the hold, only about the
+            credits, or if credits could be bought at the "price" that
+            best balances the two; branches which can't beat the best
+            load found so far are cut.
+
+            Unlike fastFit this always finds the most profitable load,
+            and it breaks ties the way bruteForceFit does: fewest units
+            and then lowest cost.
+        """
+
+        if not items or credits <= 0 or capacity <= 0:
+            return emptyLoad
+
+        def _limit(item):
+            # -1 = unknown supply
+            supply = item.supply
+            return supply if 0 < supply < maxUnits else maxUnits
+
+        # Every unit weighs a ton, so if we can afford to fill the hold
+        # with the highest gain items we can't do any better.
+        bestFirst = sorted(items, key=lambda item: (-item.gainCr, item.costCr))
+        loadItems, gainCr, costCr, capLeft = [], 0, 0, capacity
+        for item in bestFirst:
+            qty = min(_limit(item), capLeft)
+            loadItems.append((item, qty))
+            gainCr += item.gainCr * qty
+            costCr += item.costCr * qty
+            capLeft -= qty
+            if capLeft <= 0:
+                break
+        if costCr <= credits:
+            return TradeLoad(
+                tuple(loadItems), gainCr, costCr, capacity - capLeft
+            )
+        if len(items) == 1:
+            item = items[0]
+            qty = min(_limit(item), capacity, credits // item.costCr)
+            if qty <= 0:
+                return emptyLoad
+            return TradeLoad(
+                ((item, qty),), item.gainCr * qty, item.costCr * qty, qty
+            )
+
+        def _relaxed(lam, order):
+            """
+                Best gain ignoring the credit limit but paying 'lam'
+                per credit spent, plus the credits at that price;
+                this is never less than the best real load.
+            """
+            gainCr, capLeft = lam * credits, capacity
+            for item in order:
+                value = item.gainCr - lam * item.costCr
+                if value <= 0:
+                    break
+                qty = min(_limit(item), capLeft)
+                gainCr += value * qty
+                capLeft -= qty
+                if capLeft <= 0:
+                    break
+            return gainCr
+
+        # The relaxed gain is convex in the price, so a golden-section
+        # search will find the price that gives the tightest bound.
+        def _relaxedAt(lam):
+            return _relaxed(lam, sorted(
+                items, key=lambda item: item.costCr * lam - item.gainCr
+            ))
+
+        lwr, upr = 0., max(item.gainCr / item.costCr for item in items)
+        golden = (math.sqrt(5) - 1) / 2
+        lhs, rhs = upr - golden * upr, golden * upr
+        lhsGain, rhsGain = _relaxedAt(lhs), _relaxedAt(rhs)
+        while upr - lwr > upr * 1e-4:
+            if lhsGain <= rhsGain:
+                upr, rhs, rhsGain = rhs, lhs, lhsGain
+                lhs = upr - golden * (upr - lwr)
+                lhsGain = _relaxedAt(lhs)
+            else:
+                lwr, lhs, lhsGain = lhs, rhs, rhsGain
+                rhs = lwr + golden * (upr - lwr)
+                rhsGain = _relaxedAt(rhs)
+        lam = (lwr + upr) / 2
+
+        items = sorted(
+            items,
+            key=lambda item: (
+                item.costCr * lam - item.gainCr, -item.gainCr, item.costCr
+            )
+        )
+        numItems = len(items)
+        gains = [item.gainCr for item in items]
+        costs = [item.costCr for item in items]
+        limits = [_limit(item) for item in items]
+        values = [gains[iNo] - lam * costs[iNo] for iNo in range(numItems)]
+
+        # Items are considered in order of their value at that price,
+        # so keep running totals of units and value for those worth
+        # having and the relaxed gain from any offset is a bisect away.
+        numValued = 0
+        unitTotals, valueTotals = [0], [0.]
+        while numValued < numItems and values[numValued] > 0:
+            unitTotals.append(unitTotals[-1] + limits[numValued])
+            valueTotals.append(
+                valueTotals[-1] + values[numValued] * limits[numValued]
+            )
+            numValued += 1
+
+        def _priceBound(offset, cap, cr):
+            """ Upper bound paying for items at the credit price. """
+            bound = lam * cr
+            if offset >= numValued:
+                return bound
+            unitsBefore = unitTotals[offset]
+            endNo = bisect.bisect_right(
+                unitTotals, unitsBefore + cap, offset, numValued + 1
+            ) - 1
+            bound += valueTotals[endNo] - valueTotals[offset]
+            if endNo < numValued:
+                bound += values[endNo] * (
+                    cap - (unitTotals[endNo] - unitsBefore)
+                )
+            return bound
+
+        byGain = sorted(range(numItems), key=lambda iNo: -gains[iNo])
+        byRatio = sorted(
+            range(numItems), key=lambda iNo: -gains[iNo] / costs[iNo]
+        )
+
+        def _capacityBound(offset, cap, cr):
+            """ Upper bound filling the hold with the best gain items. """
+            bound = 0
+            for iNo in byGain:
+                if iNo < offset:
+                    continue
+                qty = min(limits[iNo], cap, cr / costs[iNo])
+                bound += gains[iNo] * qty
+                cap -= qty
+                if cap <= 0:
+                    break
+            return bound
+
+        def _creditBound(offset, cap, cr):
+            """ Upper bound spending credits on the best gain per credit. """
+            bound = 0
+            for iNo in byRatio:
+                if iNo < offset:
+                    continue
+                costCr = costs[iNo]
+                qty = min(limits[iNo], cap)
+                if qty * costCr >= cr:
+                    return bound + cr * gains[iNo] / costCr
+                bound += gains[iNo] * qty
+                cr -= qty * costCr
+            return bound
+
+        # If an item gains at least as much as this one for no more
+        # credits, we would always rather have another unit of it, so
+        # there is no point buying this item until those are exhausted.
+        # Such an item is never worth less at the credit price, so it
+        # is always considered before this one.
+        dominators = [
+            [
+                lNo for lNo in range(iNo)
+                if gains[lNo] >= gains[iNo] and costs[lNo] <= costs[iNo]
+            ]
+            for iNo in range(numItems)
+        ]
+
+        qtys = [0] * numItems
+        best = [0, 0, 0, ()]    # gain, units, cost, qtys
+
+        def _search(offset, cap, cr, gainCr, units, costCr):
+            bestGainCr = best[0]
+            if gainCr >= bestGainCr:
+                if gainCr > bestGainCr or units < best[1] or (
+                        units == best[1] and costCr < best[2]
+                        ):
+                    best[:] = gainCr, units, costCr, tuple(qtys)
+
+            if offset >= numItems or cap <= 0:
+                return
+
+            itemGainCr, itemCostCr = gains[offset], costs[offset]
+            maxQty = min(limits[offset], cap, cr // itemCostCr)
+            for lNo in dominators[offset]:
+                if qtys[lNo] < limits[lNo]:
+                    maxQty = 0
+                    break
+            if offset == numItems - 1:
+                # Last item: fill up with as much of it as we can.
+                if maxQty > 0:
+                    qtys[offset] = maxQty
+                    _search(
+                        numItems, cap - maxQty, cr - itemCostCr * maxQty,
+                        gainCr + itemGainCr * maxQty, units + maxQty,
+                        costCr + itemCostCr * maxQty
+                    )
+                    qtys[offset] = 0
+                return
+            # The bound on the load is concave in the quantity of this
+            # item, so find where it peaks and work outwards from there
+            # until it falls short of the best load on both sides.
+            bounds = {}
+
+            def _loadBound(qty):
+                try:
+                    return bounds[qty]
+                except KeyError:
+                    pass
+                capLeft, crLeft = cap - qty, cr - itemCostCr * qty
+                bound = bounds[qty] = itemGainCr * qty + min(
+                    _priceBound(offset + 1, capLeft, crLeft),
+                    _creditBound(offset + 1, capLeft, crLeft),
+                    _capacityBound(offset + 1, capLeft, crLeft),
+                )
+                return bound
+
+            lwr, upr = 0, maxQty
+            while lwr < upr:
+                mid = (lwr + upr) // 2
+                if _loadBound(mid + 1) > _loadBound(mid):
+                    lwr = mid + 1
+                else:
+                    upr = mid
+
+            upr = lwr + 1
+            while True:
+                if lwr >= 0 and (
+                        upr > maxQty or _loadBound(lwr) >= _loadBound(upr)
+                        ):
+                    qty, lwr = lwr, lwr - 1
+                elif upr <= maxQty:
+                    qty, upr = upr, upr + 1
+                else:
+                    break
+                # The bound is approximate; allow for rounding, we only
+                # need it to be good to the nearest credit.
+                if gainCr + _loadBound(qty) + 0.5 < best[0]:
+                    break
+                loadCostCr = itemCostCr * qty
+                qtys[offset] = qty
+                _search(
+                    offset + 1, cap - qty, cr - loadCostCr,
+                    gainCr + itemGainCr * qty, units + qty,
+                    costCr + loadCostCr
+                )
+            qtys[offset] = 0
+
+        _search(0, capacity, credits, 0, 0, 0)
+
+        bestGainCr, bestUnits, bestCostCr, bestQtys = best
+        if not bestGainCr:
+            return emptyLoad
+
+        return TradeLoad(
+            tuple(
+                (items[iNo], qty)
+                for iNo, qty in enumerate(bestQtys)
+                if qty
+            ),
+            bestGainCr, bestCostCr, bestUnits
+        )
+
     def getTrades(self, srcStation, dstStation, srcSelling=None):
         """
         Returns the most profitable trading options from
@@ -739,6 +1315,248 @@ class TradeCalc(object):
         return trading
 
 
+    def getTradesTo(self, srcStation, dstStations, srcSelling=None):
+        """
+        Generates (dstStation, trades) for each of dstStations in
+        turn, where trades is what getTrades would return for it.
+
+        When numpy is available the gains are worked out for all of
+        the destinations at once from the price arrays.
+        """
+        if not haveNumpy:
+            for dstStation in dstStations:
+                yield dstStation, self.getTrades(
+                    srcStation, dstStation, srcSelling
+                )
+            return
+
+        dstStations = tuple(dstStations)
+        if not srcSelling:
+            srcSelling = self.stationsSelling.get(srcStation.ID, None)
+        getBuying = self.stationsBuying.get
+        buying = [
+            dstStation for dstStation in dstStations
+            if srcSelling and getBuying(dstStation.ID, None)
+        ]
+        if not buying:
+            for dstStation in dstStations:
+                yield dstStation, None
+            return
+
+        minGainCr = max(1, self.tdenv.minGainPerTon or 1)
+        maxGainCr = max(minGainCr, self.tdenv.maxGainPerTon or sys.maxsize)
+
+        # One row per destination and a column for each item the
+        # source sells, in the order the source lists them.
+        stationRow, itemCol = self.stationRow, self.itemCol
+        srcRow = stationRow[srcStation.ID]
+        cols = numpy.array(
+            [itemCol[values[0]] for values in srcSelling], numpy.intp
+        )
+        dstRows = numpy.array(
+            [stationRow[dstStation.ID] for dstStation in buying], numpy.intp
+        )
+        srcPrices = self.sellPrice[srcRow, cols]
+        dstPrices = self.buyPrice[dstRows[:, None], cols]
+        gains = dstPrices - srcPrices
+        dstNos, srcNos = numpy.nonzero(
+            (dstPrices > 0) & (gains >= minGainCr) & (gains <= maxGainCr)
+        )
+        gains = gains[dstNos, srcNos]
+        costs = srcPrices[srcNos]
+
+        # SORT BY destination, profit DESC, cost ASC
+        order = numpy.lexsort((costs, -gains, dstNos))
+        dstNos, srcNos = dstNos[order], srcNos[order]
+        itemCols, itemRows = cols[srcNos], dstRows[dstNos]
+        ends = numpy.searchsorted(
+            dstNos, numpy.arange(1, len(buying) + 1)
+        ).tolist()
+
+        colItems = self.colItems
+        trades = list(map(
+            Trade,
+            [colItems[col] for col in itemCols.tolist()],
+            costs[order].tolist(),
+            gains[order].tolist(),
+            self.sellUnits[srcRow, itemCols].tolist(),
+            self.sellLevel[srcRow, itemCols].tolist(),
+            self.buyUnits[itemRows, itemCols].tolist(),
+            self.buyLevel[itemRows, itemCols].tolist(),
+            self.sellAge[srcRow, itemCols].tolist(),
+            self.buyAge[itemRows, itemCols].tolist(),
+        ))
+
+        dstTrades, start = {}, 0
+        for dstStation, end in zip(buying, ends):
+            dstTrades[dstStation] = trades[start:end]
+            start = end
+        for dstStation in dstStations:
+            yield dstStation, dstTrades.get(dstStation, None)
+
+    def routeGainBound(self, route, hops):
+        """
+        Returns an optimistic estimate of how much route could add to
+        its score over the next 'hops' hops: no real route can do any
+        better. Used to rank partial routes for beam searching.
+
+        Only gain is bounded: routes heading towards a goal are scored
+        on distance, and get an estimate of 0.
+        """
+        tdenv = self.tdenv
+        if hops <= 0 or tdenv.goalSystem:
+            return 0
+
+        station = route.lastStation
+        try:
+            bounds = self.stationGainBounds[station.ID]
+        except KeyError:
+            bounds = self._stationGainBounds(station)
+            self.stationGainBounds[station.ID] = bounds
+        minSellCr, gains, gainPerCr = bounds
+        if not gains:
+            return 0
+
+        # The next hop can only buy what this station has and sell it
+        # somewhere within reach, but after that we could be anywhere.
+        # No hop can gain more on a ton, or on a credit spent, than the
+        # best there is, and each hop's gain goes towards the next
+        # one's credits.
+        capacity = tdenv.capacity
+        maxUnits = getattr(tdenv, 'limit') or capacity
+        credits = route.startCr + route.gainCr
+        hopGain, capLeft = 0, min(capacity, credits // minSellCr)
+        for gainCr, supply in gains:  # sorted by gain DESC
+            qty = min(maxUnits, capLeft, supply)
+            hopGain += gainCr * qty
+            capLeft -= qty
+            if capLeft <= 0:
+                break
+        hopGain = min(hopGain, gainPerCr * credits)
+        gainCr = hopGain
+        for _ in range(hops - 1):
+            credits += hopGain
+            hopGain = min(
+                self.bestGainPerTon * capacity, self.bestGainPerCr * credits
+            )
+            gainCr += hopGain
+
+        # A short supercruise can increase a hop's score by up to a
+        # 12th of the ls penalty.
+        if tdenv.lsPenalty:
+            gainCr *= 1 + tdenv.lsPenalty / 100 / 12
+
+        return gainCr
+
+    def _stationGainBounds(self, station):
+        """
+        Returns (minSellCr, gains, gainPerCr) for a hop from station:
+        the cheapest thing it sells; the (gainCr, supply) of everything
+        it sells, best first, if sold at the best price paid within a
+        hop of it; and the most a credit spent there could gain.
+        """
+        tdenv = self.tdenv
+        self.loadStations((station,))
+        selling = self.stationsSelling.get(station.ID)
+        if not selling:
+            return 0, (), 0
+
+        if tdenv.direct:
+            # Direct hops can go anywhere.
+            buyPrice = self.itemBuyPrice
+        else:
+            reachBuyPrices = self.reachBuyPrices
+            system = station.system
+            try:
+                buyPrice = reachBuyPrices[system]
+                reachBuyPrices.move_to_end(system)
+            except KeyError:
+                _, destinations = self._destinationFinder()
+                dstStations = [dest.station for dest in destinations(station)]
+                self.loadStations(dstStations)
+                buyPrice = {}
+                getBuying = self.stationsBuying.get
+                for dstStation in dstStations:
+                    for itemID, costCr, *_ in getBuying(dstStation.ID, ()):
+                        if costCr > buyPrice.get(itemID, 0):
+                            buyPrice[itemID] = costCr
+                reachBuyPrices[system] = buyPrice
+                if len(reachBuyPrices) > self.destCacheSize:
+                    reachBuyPrices.popitem(last=False)
+
+        minSellCr = min(values[1] for values in selling)
+        gains, gainPerCr = [], 0
+        for itemID, costCr, supply, *_ in selling:
+            gainCr = buyPrice.get(itemID, 0) - costCr
+            if gainCr > 0:
+                gains.append((gainCr, supply if supply > 0 else float('inf')))
+                gainPerCr = max(gainPerCr, gainCr / costCr)
+        gains.sort(reverse=True)
+        return minSellCr, tuple(gains), gainPerCr
+
+    def systemDistances(self, system):
+        """
+        Returns a numpy array of the distance from system to every
+        system, by System.row. The arrays for the systemDistsSize most
+        recently used systems are kept.
+        """
+        systemDists = self.systemDists
+        try:
+            dists = systemDists[system]
+            systemDists.move_to_end(system)
+            return dists
+        except KeyError:
+            pass
+        coords = self.systemCoords
+        if coords is None:
+            systems = self.tdb.systemByID.values()
+            coords = numpy.zeros((system.positions.count, 3), numpy.float64)
+            coords[[sys.row for sys in systems]] = [
+                (sys.posX, sys.posY, sys.posZ) for sys in systems
+            ]
+            self.systemCoords = coords
+        delta = coords - coords[system.row]
+        delta *= delta
+        distSq = delta[:, 0] + delta[:, 1] + delta[:, 2]
+        dists = numpy.sqrt(distSq)
+        systemDists[system] = dists
+        if len(systemDists) > self.systemDistsSize:
+            systemDists.popitem(last=False)
+        return dists
+
+    def goalScores(self, dests, srcSystem, origSystem, goalSystem):
+        """
+        Works out the distance part of the --towards score for hops
+        from srcSystem to each of dests, on routes that started from
+        origSystem, for all of them in one go. Returns
+            {dstStation: score}
+        without the hops to goalSystem, or to any system at the same
+        position as it, which are scored on gain.
+        """
+        goalDists = self.systemDistances(goalSystem)
+        origDists = self.systemDistances(origSystem)
+        srcGoalDist = goalDists[srcSystem.row]
+        srcOrigDist = origDists[srcSystem.row]
+        origGoalDist = goalDists[origSystem.row]
+
+        dests = [
+            dest for dest in dests
+            if dest.system is not goalSystem and goalDists[dest.system.row]
+        ]
+        rows = numpy.array([dest.system.row for dest in dests], numpy.intp)
+        dstGoalDists = goalDists[rows]
+        # Biggest reward for shortening distance to goal
+        scores = 5000 * origGoalDist / dstGoalDists
+        # bias towards bigger reductions
+        scores += 50 * srcGoalDist / dstGoalDists
+        # discourage moving back towards origin
+        scores += numpy.where(
+            rows != origSystem.row, 10 * (origDists[rows] - srcOrigDist), 0
+        )
+        return dict(zip(
+            (dest.station for dest in dests), scores.tolist()
+        ))
+
     def getBestHops(self, routes, restrictTo=None):
         """
         Given a list of routes, try all available next hops from each
@@ -749,38 +1567,154 @@ class TradeCalc(object):
 
         If we have two routes: A->B->D, A->C->D and A->B->D produces
         more profit, there's no point continuing the A->C->D path.
+
+        With tdenv.keepPerDest > 1 that many of the best routes to
+        each destination are kept, since one that is slightly worse
+        now may be carrying more credits forward.
+
+        With tdenv.workers > 1 the routes are split between that many
+        forked worker processes and their results merged.
         """
 
+        tdenv = self.tdenv
+        self.loadStations(route.lastStation for route in routes)
+        workers = getattr(tdenv, 'workers', 0) or 0
+        if workers > 1 and len(routes) > 1:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                tdenv.WARN("--workers needs 'fork', using a single process.")
+                context = None
+        else:
+            context = None
+
+        if context and self.loadedStationIDs is not None:
+            # The workers can't share our DB connection, and anything
+            # they load is gone when they finish, so load everything
+            # they could need first.
+            _, destinations = self._destinationFinder(restrictTo)
+            srcStations = {
+                route.lastStation.system: route.lastStation
+                for route in routes
+            }
+            self.loadStations(
+                dest.station
+                for srcStation in srcStations.values()
+                for dest in destinations(srcStation)
+            )
+
+        if context:
+            bestToDest, stats = self._getBestToDestParallel(
+                context, workers, routes, restrictTo
+            )
+        else:
+            bestToDest, stats = self._getBestToDest(
+                routes, restrictTo, tdenv.progress
+            )
+
+        self.fitCacheHits += stats['fitCacheHits']
+        self.fitCacheMisses += stats['fitCacheMisses']
+        if self.fitCacheSize and tdenv.detail > 1:
+            tdenv.NOTE(
+                "Fit cache: {:n} hits, {:n} misses ({:n} hits, {:n} misses "
+                "in total), {:n}/{:n} entries",
+                stats['fitCacheHits'], stats['fitCacheMisses'],
+                self.fitCacheHits, self.fitCacheMisses,
+                len(self.fitCache), self.fitCacheSize,
+            )
+        tdenv.DEBUG0(
+            "Destination cache: {:n} hits, {:n} misses",
+            stats['destCacheHits'], stats['destCacheMisses'],
+        )
+        tdenv.DEBUG0(
+            "{:n} connections: {:n} pruned before getting trades, "
+            "{:n} pruned before fitting, {:n} fitted",
+            stats['connections'],
+            stats['prunedStations'], stats['prunedTrades'], stats['fits'],
+        )
+
+        if stats['connections'] == 0:
+            raise NoHopsError(
+                "No destinations could be reached within the constraints."
+            )
+
+        result = []
+        for candidates in bestToDest.values():
+            for _, (dst, route, trade, jumps, ly, score) in sorted(
+                    candidates, reverse=True
+                    ):
+                result.append(route.plus(dst, trade, jumps, score))
+
+        return result
+
+    def _getBestToDestParallel(self, context, workers, routes, restrictTo):
+        """
+        Runs _getBestToDest over slices of routes in forked worker
+        processes, which inherit the price data rather than having it
+        sent to them, and merges the results in route order so they
+        come out exactly as they would from a single process.
+        """
+        global _hopWorkerState
+
+        tdb = self.tdb
+        numSlices = min(len(routes), workers * 4)
+        bounds = [
+            len(routes) * sliceNo // numSlices
+            for sliceNo in range(numSlices + 1)
+        ]
+        slices = list(zip(bounds, bounds[1:]))
+
+        _hopWorkerState = (self, routes, restrictTo)
+        try:
+            with context.Pool(workers) as pool:
+                results = pool.map(_bestHopsWorker, slices)
+        finally:
+            _hopWorkerState = None
+
+        stationByID, systemByID = tdb.stationByID, tdb.systemByID
+        itemByID = tdb.itemByID
+        keepPerDest = getattr(self.tdenv, 'keepPerDest', 1) or 1
+        bestToDest, stats = {}, Counter()
+        for hops, sliceStats in results:
+            stats.update(sliceStats)
+            for (dstID, routeNo, load, viaIDs, viaType, distLy, score) in hops:
+                route = routes[routeNo]
+                # Same ranking as _getBestToDest.
+                key = (route.score + score, -distLy, -routeNo)
+                candidates = bestToDest.get(dstID)
+                if candidates and len(candidates) >= keepPerDest:
+                    if key < candidates[0][0]:
+                        continue
+                items, gainCr, costCr, units = load
+                items = tuple(
+                    (tradeItem._replace(item=itemByID[tradeItem.item]), qty)
+                    for tradeItem, qty in items
+                )
+                trade = TradeLoad(items, gainCr, costCr, units)
+                addCandidate(bestToDest, keepPerDest, dstID, key, (
+                    stationByID[dstID], route, trade,
+                    viaType(systemByID[ID] for ID in viaIDs),
+                    distLy, score
+                ))
+
+        return bestToDest, stats
+
+    def _destinationFinder(self, restrictTo=None):
+        """
+        Returns the set of stations getBestHops is restricted to (empty
+        when it isn't), and a function which yields the Destinations a
+        hop from a given station can go to.
+        """
         tdb = self.tdb
         tdenv = self.tdenv
         avoidPlaces = getattr(tdenv, 'avoidPlaces', None) or ()
-        assert not restrictTo or isinstance(restrictTo, set)
         maxJumpsPer = tdenv.maxJumpsPer
         maxLyPer = tdenv.maxLyPer
         maxPadSize = tdenv.padSize
         planetary = tdenv.planetary
         noPlanet = tdenv.noPlanet
         maxLsFromStar = tdenv.maxLs or float('inf')
-        reqBlackMarket = getattr(tdenv, 'blackMarket', False) or False
-        maxAge = getattr(tdenv, 'maxAge') or 0
-        credits = tdenv.credits - (getattr(tdenv, 'insurance', 0) or 0)
-        fitFunction = self.defaultFit
-        capacity = tdenv.capacity
-        maxUnits = getattr(tdenv, 'limit') or capacity
-
-        bestToDest = {}
-        safetyMargin = 1.0 - tdenv.margin
-        unique = tdenv.unique
-        loopInt = getattr(tdenv, 'loopInt', 0) or None
-
-        # Penalty is expressed as percentage, reduce it to a multiplier
-        if tdenv.lsPenalty:
-            lsPenalty = tdenv.lsPenalty / 100
-        else:
-            lsPenalty = 0
-
         goalSystem = tdenv.goalSystem
-        uniquePath = None
 
         restrictStations = set()
         if restrictTo:
@@ -825,19 +1759,177 @@ class TradeCalc(object):
                     planetary=planetary,
                 )
 
+        return restrictStations, station_iterator
+
+    def _getBestToDest(self, routes, restrictTo, progress):
+        """
+        Finds the best tdenv.keepPerDest hops to each destination
+        reachable from the routes, returning
+            {dstID: [(key, (dstStation, route, trade, via, distLy, score))]},
+            Counter() of connections, fits, pruning and cache use
+        where each list is a heap with the worst of the hops first.
+        Hops are ranked by the key
+            (route.score + score, -distLy, -routeNo)
+        so the better score wins, then the shorter hop, then the hop
+        from the earlier route.
+        """
+
+        tdenv = self.tdenv
+        assert not restrictTo or isinstance(restrictTo, set)
+        reqBlackMarket = getattr(tdenv, 'blackMarket', False) or False
+        maxAge = getattr(tdenv, 'maxAge') or 0
+        credits = tdenv.credits - (getattr(tdenv, 'insurance', 0) or 0)
+        fitFunction = self.defaultFit
+        capacity = tdenv.capacity
+        maxUnits = getattr(tdenv, 'limit') or capacity
+        keepPerDest = getattr(tdenv, 'keepPerDest', 1) or 1
+
+        # Fit results are remembered along with the range of credits
+        # they hold good for. Only a fitter that always finds the best
+        # load is guaranteed to come up with the same load when it has
+        # less money to play with.
+        fitCache = self.fitCache
+        fitCacheSize = self.fitCacheSize
+        fitCacheHits, fitCacheMisses = 0, 0
+        exactFit = fitFunction in (self.exactFit, self.bruteForceFit)
+
+        # Everything but the system we start from is the same for all
+        # of the routes, so routes ending in the same system (or one
+        # with several stations) share its list of destinations. Routes
+        # from the same place mostly come one after another, so only the
+        # most recently used systems' lists are kept.
+        destCache = OrderedDict()
+        destCacheSize = self.destCacheSize
+        destCacheHits, destCacheMisses = 0, 0
+        # Likewise the distance part of the --towards scores, for each
+        # system and starting point, when using numpy.
+        goalCache = OrderedDict()
+        goalScores = None
+
+        def holdGain(items):
+            """ Most we could gain from the items with unlimited credits. """
+            gainCr, capLeft = 0, capacity
+            for item in items:  # already sorted by gain DESC
+                qty = min(maxUnits, capLeft)
+                if item.supply > 0:
+                    qty = min(qty, item.supply)
+                gainCr += item.gainCr * qty
+                capLeft -= qty
+                if capLeft <= 0:
+                    break
+            return gainCr
+
+        def hopScore(dest, gainCr, gainPerTon):
+            """ Score for a hop to dest that gains the given amounts. """
+            multiplier = 1.0
+            # Calculate total K-lightseconds supercruise time.
+            # This will amortize for the start/end stations
+            dstSys = dest.system
+            score = None
+            if goalSystem and dstSys is not goalSystem:
+                if goalScores is not None:
+                    # See goalScores, which works these out in bulk.
+                    score = goalScores.get(dest.station)
+                else:
+                    dstGoalDist = goalDistTo(dstSys)
+                    if dstGoalDist:
+                        # Biggest reward for shortening distance to goal
+                        score = 5000 * origGoalDist / dstGoalDist
+                        # bias towards bigger reductions
+                        score += 50 * srcGoalDist / dstGoalDist
+                        # discourage moving back towards origin
+                        if dstSys is not origSystem:
+                            score += 10 * (origDistTo(dstSys) - srcOrigDist)
+            if score is not None:
+                # Gain per unit pays a small part
+                score += gainPerTon / 25
+            else:
+                # No goal, or we're there (or somewhere at the same
+                # position as it, which is as close as we can get).
+                score = gainCr
+            if lsPenalty:
+                # Only want 1dp
+                cruiseKls = int(dest.station.lsFromStar / 100) / 10
+                # Produce a curve that favors distances under 1kls
+                # positively, starts to penalize distances over 1k,
+                # and after 4kls starts to penalize aggresively
+                # http://goo.gl/Otj2XP
+                penalty = ((cruiseKls ** 2) - cruiseKls) / 3
+                penalty *= lsPenalty
+                multiplier *= (1 - penalty)
+
+            return score * multiplier
+
+        def cantWin(dest, worstKey, gainCr, gainPerTon):
+            """
+            True if a hop to dest gaining no more than the given amounts
+            would lose to the worst of the hops we are keeping for it.
+            """
+            if not (goalSystem or lsPenalty):
+                bestScore = gainCr
+            elif lsPenalty:
+                # A large enough lsPenalty makes the multiplier negative,
+                # when less gain means a better score.
+                bestScore = max(
+                    hopScore(dest, gainCr, gainPerTon), hopScore(dest, 0, 0)
+                )
+            else:
+                bestScore = hopScore(dest, gainCr, gainPerTon)
+            bestTradeScore = worstKey[0]
+            newTradeScore = route.score + bestScore
+            if bestTradeScore > newTradeScore:
+                return True
+            # The route we're on comes after any we already have.
+            if bestTradeScore == newTradeScore:
+                return -worstKey[1] <= dest.distLy
+            return False
+
+        def worstKept(dstID):
+            """ Key of the hop a new hop to dstID would have to beat. """
+            candidates = bestToDest.get(dstID)
+            if candidates and len(candidates) >= keepPerDest:
+                return candidates[0][0]
+            return None
+
+        bestToDest = {}
+        safetyMargin = 1.0 - tdenv.margin
+        unique = tdenv.unique
+        loopInt = getattr(tdenv, 'loopInt', 0) or None
+
+        # Penalty is expressed as percentage, reduce it to a multiplier
+        if tdenv.lsPenalty:
+            lsPenalty = tdenv.lsPenalty / 100
+        else:
+            lsPenalty = 0
+
+        goalSystem = tdenv.goalSystem
+        uniquePath = None
+
+        restrictStations, station_iterator = self._destinationFinder(
+            restrictTo
+        )
+
         prog = pbar.Progress(len(routes), 25)
         connections = 0
+        prunedStations, prunedTrades, fits = 0, 0, 0
+        tradeBounds = self.tradeBounds
         getSelling = self.stationsSelling.get
-        for route in routes:
-            if tdenv.progress:
+        maxBuyPrice = self.maxBuyPrice
+        lazyPrices = self.loadedStationIDs is not None
+        for routeNo, route in enumerate(routes):
+            if progress:
                 prog.increment(1)
             tdenv.DEBUG1("Route = {}", route.str())
 
             srcStation = route.lastStation
             startCr = credits + int(route.gainCr * safetyMargin)
-            routeJumps = len(route.jumps)
 
             srcSelling = getSelling(srcStation.ID, None)
+            # Credits we'd need before anything else became affordable.
+            nextCr = min(
+                (values[1] for values in srcSelling if values[1] > startCr),
+                default=float('inf')
+            )
             srcSelling = tuple(
                 values for values in srcSelling
                 if values[1] <= startCr
@@ -845,6 +1937,17 @@ class TradeCalc(object):
             if not srcSelling:
                 tdenv.DEBUG1("Nothing sold/affordable - next.")
                 continue
+            srcID = srcStation.ID
+            boundsKey = (srcID, capacity, maxUnits)
+            srcBounds = tradeBounds.get(boundsKey)
+            if srcBounds is None:
+                srcBounds = tradeBounds[boundsKey] = {}
+            else:
+                tradeBounds.move_to_end(boundsKey)
+            knownBounds = len(srcBounds)
+            # The most we could buy of the cheapest item.
+            minSellCr = min(values[1] for values in srcSelling)
+            maxLoadUnits = min(capacity, startCr // minSellCr)
 
             if goalSystem:
                 origSystem = route.firstSystem
@@ -861,8 +1964,29 @@ class TradeCalc(object):
             elif loopInt:
                 uniquePath = route.route[-loopInt:-1]
 
+            srcSys = srcStation.system
+            try:
+                dests = destCache[srcSys]
+                destCache.move_to_end(srcSys)
+                destCacheHits += 1
+            except KeyError:
+                dests = destCache[srcSys] = list(station_iterator(srcStation))
+                destCacheMisses += 1
+                if len(destCache) > destCacheSize:
+                    destCache.popitem(last=False)
+            if goalSystem and haveNumpy:
+                goalKey = (srcSys, origSystem)
+                try:
+                    goalScores = goalCache[goalKey]
+                    goalCache.move_to_end(goalKey)
+                except KeyError:
+                    goalScores = goalCache[goalKey] = self.goalScores(
+                        dests, srcSys, origSystem, goalSystem
+                    )
+                    if len(goalCache) > destCacheSize:
+                        goalCache.popitem(last=False)
             stations = (
-                dest for dest in station_iterator(srcStation)
+                dest for dest in dests
                 if dest.station != srcStation
             )
             if reqBlackMarket:
@@ -899,78 +2023,175 @@ class TradeCalc(object):
                     return True
                 stations = (d for d in stations if annotate(d))
 
-            for dest in stations:
-                dstStation = dest.station
+            if lazyPrices:
+                stations = list(stations)
+                loaded = self.loadedStationIDs
+                self.loadStations(
+                    dest.station for dest in stations
+                    if dest.station.ID not in loaded
+                )
 
+            # Use what we can from the fit cache, and then work out the
+            # trades for all of the other destinations in one go.
+            # Destinations that can't beat the best hop we already have
+            # to them, even if every ton made the best possible gain,
+            # aren't worth working out.
+            hopTrades, misses = [], []
+            for dest in stations:
                 connections += 1
-                items = self.getTrades(srcStation, dstStation, srcSelling)
-                if not items:
+                dstID = dest.station.ID
+                cacheKey = (srcID, dstID, capacity, maxUnits, fitFunction)
+                cached = fitCache.get(cacheKey) if fitCacheSize else None
+                if cached and cached[0] <= startCr <= cached[1]:
+                    fitCache.move_to_end(cacheKey)
+                    fitCacheHits += 1
+                    hopTrades.append((dest, cached[2]))
                     continue
-                trade = fitFunction(items, startCr, capacity, maxUnits)
-
-                multiplier = 1.0
-                # Calculate total K-lightseconds supercruise time.
-                # This will amortize for the start/end stations
-                dstSys = dest.system
-                if goalSystem and dstSys is not goalSystem:
-                    dstGoalDist = goalDistTo(dstSys)
-                    # Biggest reward for shortening distance to goal
-                    score = 5000 * origGoalDist / dstGoalDist
-                    # bias towards bigger reductions
-                    score += 50 * srcGoalDist / dstGoalDist
-                    # discourage moving back towards origin
-                    if dstSys is not origSystem:
-                        score += 10 * (origDistTo(dstSys) - srcOrigDist)
-                    # Gain per unit pays a small part
-                    score += (trade.gainCr / trade.units) / 25
+                fitCacheMisses += 1
+                bounds = srcBounds.get(dstID)
+                if bounds and startCr < bounds[0]:
+                    # Seen these trades before and we still can't afford
+                    # anything more than we could then.
+                    maxGainCr, maxRatio, gainPerTon = bounds[1:]
+                    maxGainCr = min(maxGainCr, int(maxRatio * startCr) + 1)
                 else:
-                    score = trade.gainCr
-                if lsPenalty:
-                    # Only want 1dp
-                    cruiseKls = int(dstStation.lsFromStar / 100) / 10
-                    # Produce a curve that favors distances under 1kls
-                    # positively, starts to penalize distances over 1k,
-                    # and after 4kls starts to penalize aggresively
-                    # http://goo.gl/Otj2XP
-                    penalty = ((cruiseKls ** 2) - cruiseKls) / 3
-                    penalty *= lsPenalty
-                    multiplier *= (1 - penalty)
-
-                score *= multiplier
-
+                    gainPerTon = maxBuyPrice.get(dstID, 0) - minSellCr
+                    maxGainCr = gainPerTon * maxLoadUnits
+                if gainPerTon <= 0:
+                    prunedStations += 1
+                    continue
+                worstKey = worstKept(dstID)
+                if worstKey and cantWin(dest, worstKey, maxGainCr, gainPerTon):
+                    prunedStations += 1
+                    continue
+                # Keep the destination's place so hits and misses come
+                # out in the same order as the destinations.
+                misses.append(len(hopTrades))
+                hopTrades.append((dest, None))
+
+            dstTrades = self.getTradesTo(
+                srcStation, (hopTrades[slot][0].station for slot in misses),
+                srcSelling
+            )
+            for slot, (dstStation, items) in zip(misses, dstTrades):
+                dest = hopTrades[slot][0]
                 dstID = dstStation.ID
-                try:
-                    # See if there is already a candidate for this destination
-                    btd = bestToDest[dstID]
-                except KeyError:
-                    # No existing candidate, we win by default
-                    pass
+                if not items:
+                    # Nothing to trade until we can afford more items.
+                    srcBounds[dstID] = (nextCr, 0, 0, 0)
+                    trade, loCr, hiCr = None, 0, nextCr - 1
                 else:
-                    bestRoute = btd[1]
-                    bestScore = btd[5]
-                    # Check if it is a better option than we just produced
-                    bestTradeScore = bestRoute.score + bestScore
-                    newTradeScore = route.score + score
-                    if bestTradeScore > newTradeScore:
+                    maxGainCr = holdGain(items)
+                    # No load can beat the best gain per credit spent.
+                    maxRatio = max(item.gainCr / item.costCr for item in items)
+                    srcBounds[dstID] = (
+                        nextCr, maxGainCr, maxRatio, items[0].gainCr
+                    )
+                    worstKey = worstKept(dstID)
+                    if worstKey and cantWin(
+                            dest, worstKey,
+                            min(maxGainCr, int(maxRatio * startCr) + 1),
+                            items[0].gainCr,
+                            ):
+                        prunedTrades += 1
                         continue
-                    if bestTradeScore == newTradeScore:
-                        bestLy = btd[4]
-                        if bestLy <= dest.distLy:
-                            continue
+                    fits += 1
+                    trade = fitFunction(items, startCr, capacity, maxUnits)
+                    loCr = trade.costCr if exactFit else startCr
+                    hiCr = startCr
+                    if trade.gainCr >= maxGainCr:
+                        # More credits won't buy a better load until
+                        # they make another item affordable.
+                        hiCr = nextCr - 1
+                # Routes gain credits with every hop, so a result
+                # that's only good for exactly these credits isn't
+                # worth keeping.
+                if fitCacheSize and loCr < hiCr:
+                    cacheKey = (srcID, dstID, capacity, maxUnits, fitFunction)
+                    fitCache[cacheKey] = (loCr, hiCr, trade)
+                    fitCache.move_to_end(cacheKey)
+                    if len(fitCache) > fitCacheSize:
+                        fitCache.popitem(last=False)
+                hopTrades[slot] = (dest, trade)
+
+            self.tradeBoundsCount += len(srcBounds) - knownBounds
+            while self.tradeBoundsCount > self.tradeBoundsSize:
+                _, oldBounds = tradeBounds.popitem(last=False)
+                self.tradeBoundsCount -= len(oldBounds)
+
+            for dest, trade in hopTrades:
+                if not trade:
+                    continue
+                dstStation = dest.station
+                score = hopScore(dest, trade.gainCr, trade.gainCr / trade.units)
+
+                dstID = dstStation.ID
+                key = (route.score + score, -dest.distLy, -routeNo)
+                # Check if it is better than the worst candidate we have
+                worstKey = worstKept(dstID)
+                if worstKey and key < worstKey:
+                    continue
 
-                bestToDest[dstID] = (
+                addCandidate(bestToDest, keepPerDest, dstID, key, (
                     dstStation, route, trade, dest.via, dest.distLy, score
-                )
+                ))
 
         prog.clear()
 
-        if connections == 0:
-            raise NoHopsError(
-                "No destinations could be reached within the constraints."
-            )
+        return bestToDest, Counter(
+            connections=connections,
+            fitCacheHits=fitCacheHits, fitCacheMisses=fitCacheMisses,
+            destCacheHits=destCacheHits, destCacheMisses=destCacheMisses,
+            prunedStations=prunedStations, prunedTrades=prunedTrades,
+            fits=fits,
+        )
 
-        result = []
-        for (dst, route, trade, jumps, ly, score) in bestToDest.values():
-            result.append(route.plus(dst, trade, jumps, score))
 
-        return result
+def addCandidate(bestToDest, keepPerDest, dstID, key, candidate):
+    """
+    Adds (key, candidate) to the heap of hops to dstID in bestToDest,
+    dropping the worst of them if there are more than keepPerDest.
+    """
+    try:
+        candidates = bestToDest[dstID]
+    except KeyError:
+        bestToDest[dstID] = [(key, candidate)]
+        return
+    if len(candidates) < keepPerDest:
+        heapq.heappush(candidates, (key, candidate))
+    else:
+        heapq.heapreplace(candidates, (key, candidate))
+
+
+# The calculator, routes and restrictions a getBestHops worker is
+# working on; set before the workers are forked so they inherit it.
+_hopWorkerState = None
+
+
+def _bestHopsWorker(span):
+    """
+    Runs TradeCalc._getBestToDest over routes[span[0]:span[1]] in a
+    worker process. Stations, systems and items are returned as IDs,
+    and routes by their index, so that the parent can map them back
+    to its own objects.
+    """
+    calc, routes, restrictTo = _hopWorkerState
+    lwr, upr = span
+    bestToDest, stats = calc._getBestToDest(routes[lwr:upr], restrictTo, False)
+    routeNos = {id(routes[routeNo]): routeNo for routeNo in range(lwr, upr)}
+    hops = []
+    for dstID, candidates in bestToDest.items():
+        for _, (dst, route, trade, via, distLy, score) in candidates:
+            load = (
+                tuple(
+                    (tradeItem._replace(item=tradeItem.item.ID), qty)
+                    for tradeItem, qty in trade.items
+                ),
+                trade.gainCr, trade.costCr, trade.units
+            )
+            viaIDs = tuple(system.ID for system in via)
+            hops.append((
+                dstID, routeNos[id(route)], load,
+                viaIDs, type(via), distLy, score
+            ))
+    return hops, stats
@@ -48,20 +48,27 @@ Simplistic use might be:
 # Imports
 
 
-from collections import namedtuple, defaultdict
+from array import array
+from collections import namedtuple, defaultdict, OrderedDict
 from pathlib import Path
 from tradeenv import TradeEnv
 from tradeexcept import TradeException
 
+import bisect
 import cache
+import hashlib
 import heapq
 import itertools
+import json
 import locale
 import math
+import mmap
 import os
+import pickle
 import re
 import sqlite3
 import sys
+import time
 
 haveNumpy = False
 try:
@@ -140,41 +147,379 @@ def makeStellarGridKey(x, y, z):
     return (int(x) >> 5, int(y) >> 5, int(z) >> 5)
 
 
+class StellarIndex(object):
+    """
+    numpy version of the Stellar Grid: the systems are sorted by
+    their grid key and their co-ordinates kept in one contiguous
+    float32 matrix, so finding the systems within a radius is a
+    binary search for each column of grid cells it overlaps and some
+    vectorized arithmetic on the rows they cover.
+
+    Candidates come out in the same order as walking the grid.
+    """
+
+    # Grid keys are packed into one int64, 16 bits per axis.
+    keyBits = 16
+    keyOffset = 1 << 15
+
+    def __init__(self, systems):
+        systems = list(systems)
+        coords = numpy.array(
+            [(system.posX, system.posY, system.posZ) for system in systems],
+            numpy.float64,
+        ).reshape(-1, 3)
+        # Same as makeStellarGridKey: truncate, then shift.
+        cells = (coords.astype(numpy.int64) >> 5) + self.keyOffset
+        keys = self.packKey(cells[:, 0], cells[:, 1], cells[:, 2])
+        order = numpy.argsort(keys, kind='stable')
+        self.systems = [systems[row] for row in order.tolist()]
+        self.coords = numpy.ascontiguousarray(coords[order], numpy.float32)
+        self.keys = keys[order]
+
+    @classmethod
+    def packKey(cls, x, y, z):
+        """ Packs offset grid co-ordinates into one key. """
+        bits = cls.keyBits
+        return (((x << bits) + y) << bits) + z
+
+    def genSystemsNear(self, system, ly):
+        """
+        Yields (candidate, distLy) for the Systems other than system
+        that are within ly of it, like TradeDB.genStellarGrid.
+        """
+        sysX, sysY, sysZ = system.posX, system.posY, system.posZ
+        offset = self.keyOffset
+        lwrX, lwrY, lwrZ = makeStellarGridKey(sysX - ly, sysY - ly, sysZ - ly)
+        uprX, uprY, uprZ = makeStellarGridKey(sysX + ly, sysY + ly, sysZ + ly)
+
+        # Each (x, y) column of cells is one run of rows: find where
+        # they all start and end in one go.
+        packKey = self.packKey
+        columns = [
+            packKey(x + offset, y + offset, 0)
+            for x in range(lwrX, uprX + 1)
+            for y in range(lwrY, uprY + 1)
+        ]
+        lwrZ, uprZ = lwrZ + offset, uprZ + offset + 1
+        bounds = self.keys.searchsorted(numpy.array(
+            [column + lwrZ for column in columns] +
+            [column + uprZ for column in columns],
+            numpy.int64,
+        )).tolist()
+        numColumns = len(columns)
+        runs = [
+            (start, end)
+            for start, end in zip(bounds[:numColumns], bounds[numColumns:])
+            if start < end
+        ]
+        if not runs:
+            return
+        if len(runs) == 1:
+            rows = numpy.arange(*runs[0])
+        else:
+            rows = numpy.concatenate([
+                numpy.arange(start, end) for start, end in runs
+            ])
+
+        # float32 is only good to about 7 digits, so this lets through
+        # anything near the edge and the exact test is done below.
+        lySq = ly ** 2
+        delta = self.coords[rows] - numpy.array(
+            (sysX, sysY, sysZ), numpy.float32
+        )
+        distSq = numpy.einsum('ij,ij->i', delta, delta)
+        rows = rows[distSq <= lySq * 1.0001 + 0.01]
+
+        systems = self.systems
+        for row in rows.tolist():
+            candidate = systems[row]
+            distSq = (
+                (candidate.posX - sysX) ** 2 +
+                (candidate.posY - sysY) ** 2 +
+                (candidate.posZ - sysZ) ** 2
+            )
+            if distSq <= lySq and candidate is not system:
+                yield candidate, distSq ** 0.5
+
+
+class SystemGraph(object):
+    """
+    The links between every pair of systems no more than 'ly' apart,
+    as compressed sparse rows: the neighbours of systems[row] are the
+    rows in neighbourRows[offsets[row]:offsets[row + 1]], nearest
+    first, and the same slice of dists has their distances.
+
+    Built by TradeDB.getSystemGraph.
+    """
+
+    def __init__(
+            self, ly, stamp, systems, offsets, neighbourRows, dists,
+            landmarks=None,
+            ):
+        self.ly, self.stamp = ly, stamp
+        self.systems = systems
+        self.offsets = offsets
+        self.neighbourRows, self.dists = neighbourRows, dists
+        self.rowByID = {system.ID: row for row, system in enumerate(systems)}
+        # [array of the route length from a landmark to every row]
+        self.landmarks = landmarks
+
+    @staticmethod
+    def stampOf(systems):
+        """
+        Identifies a list of systems and their positions: a graph is
+        only good for exactly the systems it was built from.
+        """
+        values = array('d')
+        for system in systems:
+            values.extend((system.ID, system.posX, system.posY, system.posZ))
+        return hashlib.md5(values.tobytes()).hexdigest()
+
+    def genSystemsInRange(self, system, ly):
+        """
+        Returns (candidate, distLy) for the Systems within ly of
+        system, nearest first, like TradeDB.genSystemsInRange.
+        """
+        row = self.rowByID[system.ID]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        if ly < self.ly:
+            end = bisect.bisect_right(self.dists, ly, start, end)
+        systems = self.systems
+        return zip(
+            [systems[nRow] for nRow in self.neighbourRows[start:end]],
+            self.dists[start:end],
+        )
+
+    def routeLengthsFrom(self, row):
+        """
+        Returns an array of the length of the shortest route, at up to
+        ly per jump, from systems[row] to every system; inf if there
+        is no route.
+        """
+        offsets, neighbourRows, dists = self.offsets, self.neighbourRows, self.dists
+        lengths = array('d', [math.inf]) * len(self.systems)
+        lengths[row] = 0.
+        heappop, heappush = heapq.heappop, heapq.heappush
+        openSet = [(0., row)]
+        while openSet:
+            length, row = heappop(openSet)
+            if length > lengths[row]:
+                continue
+            start, end = offsets[row], offsets[row + 1]
+            for nRow, nDist in zip(neighbourRows[start:end], dists[start:end]):
+                nDist += length
+                if nDist < lengths[nRow]:
+                    lengths[nRow] = nDist
+                    heappush(openSet, (nDist, nRow))
+        return lengths
+
+    def findLandmarks(self, count):
+        """
+        Picks count landmarks as far from each other as the links go,
+        starting from the far side of the best connected system, and
+        sets self.landmarks to the route lengths from each of them.
+        """
+        offsets = self.offsets
+        busiest = max(
+            range(len(self.systems)),
+            key=lambda row: offsets[row + 1] - offsets[row],
+            default=None,
+        )
+        landmarks = []
+        if busiest is not None:
+            # closest[row] is how near row is to a landmark so far.
+            closest = self.routeLengthsFrom(busiest)
+            for _ in range(count):
+                row, length = max(
+                    ((row, length) for row, length in enumerate(closest)
+                        if length < math.inf),
+                    key=lambda ent: ent[1],
+                )
+                if not length:
+                    break
+                lengths = self.routeLengthsFrom(row)
+                landmarks.append(lengths)
+                closest = array('d', map(min, closest, lengths))
+        self.landmarks = landmarks
+
+    def routeLengthBound(self, row, otherRow):
+        """
+        Returns a lower bound on the length of a route between two
+        rows from how much nearer one is to a landmark than the other,
+        or inf if the landmarks show there is no route at all.
+        """
+        bound = 0.
+        for lengths in self.landmarks:
+            length, otherLength = lengths[row], lengths[otherRow]
+            if length == otherLength:
+                continue
+            diff = abs(length - otherLength)
+            if diff == math.inf:
+                # Only one of them is reachable from here.
+                return diff
+            if diff > bound:
+                bound = diff
+        return bound
+
+
+class SystemPositions(object):
+    """
+    The positions of a TradeDB's systems. With numpy, they are the
+    rows of one N x 3 float32 array, which System.pos is a view of.
+    """
+
+    __slots__ = ('matrix', 'count')
+
+    def __init__(self, count, columns=((), (), ())):
+        """
+        columns are the x, y and z of each system, and only needed
+        when using numpy.
+        """
+        self.count = count
+        if haveNumpy:
+            self.matrix = numpy.empty((count, 3), numpy.float32)
+            for axis, column in enumerate(columns):
+                self.matrix[:, axis] = column
+        else:
+            self.matrix = None
+
+    def append(self, posX, posY, posZ):
+        """ Adds a position, returning its row number. """
+        row = self.count
+        self.count += 1
+        if haveNumpy:
+            self.matrix = numpy.concatenate((
+                self.matrix, numpy.array([(posX, posY, posZ)], numpy.float32)
+            ))
+        return row
+
+
+class RangeCache(object):
+    """
+    Remembers the systems TradeDB.genSystemsInRange found near each
+    system, sorted by distance, and the ly it looked out to. When it
+    holds more than 'size' neighbours in all, the systems used least
+    recently are forgotten first.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()    # system: (probedLy, [(sys, dist)])
+        self.neighbours = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, system, ly):
+        """
+        Returns (probedLy, [(candidate, distLy)]) if we have looked at
+        least ly out from system, otherwise None.
+        """
+        entry = self.entries.get(system)
+        if entry and entry[0] >= ly:
+            self.entries.move_to_end(system)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, system, ly, systems):
+        """ Remembers the sorted systems within ly of system. """
+        if not self.size:
+            return
+        entries = self.entries
+        oldEntry = entries.pop(system, None)
+        if oldEntry:
+            self.neighbours -= len(oldEntry[1])
+        entries[system] = (ly, systems)
+        self.neighbours += len(systems)
+        while self.neighbours > self.size and len(entries) > 1:
+            _, (_, evicted) = entries.popitem(last=False)
+            self.neighbours -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        """ Forgets everything, e.g. because the systems changed. """
+        self.entries.clear()
+        self.neighbours = 0
+
+    def __str__(self):
+        return (
+            "{:n} hits, {:n} misses, {:n} evictions, "
+            "{:n}/{:n} neighbours of {:n} systems".format(
+                self.hits, self.misses, self.evictions,
+                self.neighbours, self.size, len(self.entries),
+            )
+        )
+
+
+class NameIndex(object):
+    """
+    The names of a list of systems, stations etc, normalized as for
+    TradeDB.listSearch, for finding the ones that contain a normalized
+    name without normalizing every name again.
+
+    The names are kept one per line in a single string, which str.find
+    can search much faster than we could look at each name in turn.
+    """
+
+    def __init__(self, values, key):
+        self.values = values = list(values)
+        names = '\n'.join(key(value) for value in values)
+        names = names.translate(TradeDB.normalizeTrans)
+        names = names.translate(TradeDB.trimTrans)
+        self.text = '\n' + names + '\n'
+        self.starts = starts = array('q', [1])
+        # {name: the first value with it}
+        self.exact = exact = {}
+        for valueNo, name in enumerate(names.split('\n')):
+            starts.append(starts[-1] + len(name) + 1)
+            exact.setdefault(name, valueNo)
+
+    def find(self, needle):
+        """
+        Returns the values whose normalized names contain needle, in
+        the order they were given.
+        """
+        if not needle:
+            return list(self.values)
+        if '\n' in needle:
+            return []
+        text, starts, values = self.text, self.starts, self.values
+        found = []
+        pos = text.find(needle)
+        while pos >= 0:
+            valueNo = bisect.bisect_right(starts, pos) - 1
+            found.append(values[valueNo])
+            pos = text.find(needle, starts[valueNo + 1])
+        return found
+
+
 class System(object):
     """
     Describes a star system which may contain one or more Station objects.
-
-    Caution: Do not use _rangeCache directly, use TradeDB.genSystemsInRange.
     """
 
     __slots__ = (
         'ID',
-        'dbname', 'posX', 'posY', 'posZ', 'pos', 'stations',
+        'dbname', 'posX', 'posY', 'posZ', 'positions', 'row', 'stations',
         'addedID',
-        '_rangeCache'
     )
 
-    class RangeCache(object):
-        """
-        Lazily populated cache of neighboring systems.
-        """
-        def __init__(self):
-            self.systems = []
-            self.probedLy = 0.
-
     def __init__(
             self, ID, dbname, posX, posY, posZ, addedID,
-            ary=numpy.array,
-            nptype=numpy.float32,
+            positions=None, row=0,
             ):
+        """
+        positions is the SystemPositions the system is row of; by
+        default the system gets one of its own.
+        """
         self.ID = ID
         self.dbname = dbname
         self.posX, self.posY, self.posZ = posX, posY, posZ
-        if ary:
-            self.pos = ary([posX, posY, posZ], nptype)
+        if positions is None:
+            positions = SystemPositions(1, ((posX,), (posY,), (posZ,)))
+        self.positions, self.row = positions, row
         self.addedID = addedID or 0
         self.stations = ()
-        self._rangeCache = None
 
     @property
     def system(self):
@@ -235,17 +580,21 @@ class System(object):
         ) ** 0.5  # fast sqrt
 
     if haveNumpy:
-        def all_distances(
-                self, iterable,
-                ary=numpy.ascontiguousarray, norm=numpy.linalg.norm,
-                ):
+        @property
+        def pos(self):
+            """ numpy view of the system's [x, y, z]. """
+            return self.positions.matrix[self.row]
+
+        def all_distances(self, iterable=None):
             """
-            Takes a list of systems and returns their distances from this system.
+            Takes a list of systems and returns their distances from this
+            system; the systems must share its positions. Without a list,
+            returns the distance to every system by row.
             """
-            return numpy.linalg.norm(
-                ary([s.pos for s in iterable]) - self.pos,
-                ord=2, axis=1.
-            )
+            matrix = self.positions.matrix
+            if iterable is not None:
+                matrix = matrix[[s.row for s in iterable]]
+            return numpy.linalg.norm(matrix - self.pos, ord=2, axis=1)
 
     def getStation(self, stationName):
         """
@@ -284,6 +633,66 @@ class DestinationNode(namedtuple('DestinationNode', [
     pass
 
 
+class StationFeatures(object):
+    """
+    A station's services as an int with one bit for the value of each
+    attribute, e.g. "pad size is M" or "black market is ?".
+
+    Requirements compile into a mask of the values they rule out, so
+    checking a station against any number of them is one test:
+
+        mask = StationFeatures.compile(maxPadSize="ML", shipyard="Y")
+        if not station.features & mask:
+            ...
+    """
+
+    attributes = (
+        ('maxPadSize', '?SML'),
+        ('planetary', '?YN'),
+        ('market', '?YN'),
+        ('blackMarket', '?YN'),
+        ('shipyard', '?YN'),
+        ('outfitting', '?YN'),
+        ('rearm', '?YN'),
+        ('refuel', '?YN'),
+        ('repair', '?YN'),
+    )
+    # {attribute: {value: bit}}
+    bits, nextBit = {}, 1
+    for attr, values in attributes:
+        bits[attr] = {}
+        for value in values:
+            bits[attr][value] = nextBit
+            nextBit <<= 1
+    del attr, values, value, nextBit
+
+    @classmethod
+    def of(cls, station):
+        """ Returns the feature bits of a station. """
+        features = 0
+        for attr, bits in cls.bits.items():
+            features |= bits.get(getattr(station, attr), 0)
+        return features
+
+    @classmethod
+    def compile(cls, noPlanet=False, **allowed):
+        """
+        Returns the mask for stations whose attributes have one of the
+        allowed values, given as strings like checkPadSize takes, e.g.
+        compile(maxPadSize="L?", refuel="Y"). Attributes with no values
+        can have any. noPlanet is the same as planetary="N".
+        """
+        mask = 0
+        for attr, values in allowed.items():
+            if values:
+                for value, bit in cls.bits[attr].items():
+                    if value not in values:
+                        mask |= bit
+        if noPlanet:
+            mask |= cls.compile(planetary='N')
+        return mask
+
+
 class Station(object):
     """
     Describes a station (trading or otherwise) in a system.
@@ -295,7 +704,7 @@ class Station(object):
         'ID', 'system', 'dbname',
         'lsFromStar', 'market', 'blackMarket', 'shipyard', 'maxPadSize',
         'outfitting', 'rearm', 'refuel', 'repair', 'planetary',
-        'itemCount', 'dataAge',
+        'itemCount', 'dataAge', 'features',
     )
 
     def __init__(
@@ -317,6 +726,7 @@ class Station(object):
         self.planetary = planetary
         self.itemCount = itemCount
         self.dataAge = dataAge
+        self.features = StationFeatures.of(self)
         system.stations = system.stations + (self,)
 
     def name(self, detail=0):
@@ -656,6 +1066,22 @@ class TradeDB(object):
         ]
         self.importPaths = {tn: tp for tp, tn in self.importTables}
 
+        self.snapshotPath = self.dbPath.with_suffix('.snapshot')
+        self.snapshot, self.snapshotStamp = None, None
+        self.pricesSnapshotPath = self.dbPath.with_suffix('.prices-snapshot')
+        self.pricesSnapshot = None
+        self.systemGraphPath = self.dbPath.with_suffix('.graph')
+        self.systemGraph = None
+        self.routeCachePath = self.dbPath.with_suffix('.routes')
+        self.routeCacheDB, self.routeCacheStamp = None, None
+        rangeCacheSize = tdenv.rangeCacheSize
+        if rangeCacheSize is None:
+            rangeCacheSize = self.defaultRangeCacheSize
+        self.rangeCache = RangeCache(rangeCacheSize)
+        # StationFeatures filters and the table of stations they use.
+        self.stationFilters, self.stationTable = {}, None
+        # {'System' or 'Station': NameIndex}, see getNameIndex.
+        self.nameIndexes = {}
         self.dbFilename = str(self.dbPath)
         self.sqlFilename = str(self.sqlPath)
         self.pricesFilename = str(self.pricesPath)
@@ -714,44 +1140,330 @@ class TradeDB(object):
 
     def reloadCache(self):
         """
-        Checks if the .sql, .prices or *.csv files are newer than the cache.
+        Checks if the .sql, .prices or *.csv files are newer than the cache,
+        and if so brings the cache up to date with them.
         """
 
         if self.dbPath.exists():
             dbFileStamp = self.dbPath.stat().st_mtime
 
-            paths = [self.sqlPath]
-            paths += [Path(f) for (f, _) in self.importTables]
-
             changedPaths = [
                 [path, path.stat().st_mtime]
-                for path in paths
+                for path in cache.getSourcePaths(self)
                 if path.exists() and path.stat().st_mtime > dbFileStamp
             ]
 
             if not changedPaths:
-                # Do we need to reload the .prices file?
-                if not self.pricesPath.exists():
-                    self.tdenv.DEBUG1("No .prices file to load")
-                    return
-
-                pricesStamp = self.pricesPath.stat().st_mtime
-                if pricesStamp <= dbFileStamp:
-                    self.tdenv.DEBUG1("DB Cache is up to date.")
-                    return
-
-                self.tdenv.DEBUG0(".prices has changed: re-importing")
-                cache.importDataFromFile(
-                    self, self.tdenv, self.pricesPath, reset=True
-                )
+                self.tdenv.DEBUG1("DB Cache is up to date.")
                 return
 
-            self.tdenv.DEBUG0("Rebuilding DB Cache [{}]", str(changedPaths))
-        else:
-            self.tdenv.DEBUG0("Building DB Cache")
+            self.tdenv.DEBUG0("Updating DB Cache [{}]", str(changedPaths))
+            cache.updateCache(
+                self, self.tdenv, [path for path, _ in changedPaths]
+            )
+            return
 
+        self.tdenv.DEBUG0("Building DB Cache")
         cache.buildCache(self, self.tdenv)
 
+    ############################################################
+    # Snapshot of the tables that get loaded on every run, kept next
+    # to the DB so we don't have to query for them each time.
+
+    # Change this whenever what goes into the snapshot changes.
+    snapshotVersion = 3
+
+    # Default number of neighbouring systems genSystemsInRange remembers.
+    defaultRangeCacheSize = 1000000
+    systemGraphVersion = 2
+    # Landmarks getRoute measures the rest of a route against.
+    routeLandmarks = 8
+    # Searches of fewer jumps than this make do with the stellar grid
+    # rather than build a system graph, or its landmarks, for themselves.
+    systemGraphJumps = 8
+
+    # (name, column types, query): column types are array typecodes,
+    # or 's' for anything else.
+    snapshotTables = (
+        ('System', 'qsdddq', """
+            SELECT  system_id, name, pos_x, pos_y, pos_z, added_id
+              FROM  System
+        """),
+        ('Station', 'qqsqsssssssss', """
+            SELECT  station_id, system_id, name,
+                    ls_from_star, market, blackmarket, shipyard,
+                    max_pad_size, outfitting, rearm, refuel, repair, planetary
+              FROM  Station
+        """),
+        ('StationTrading', 'qqd', """
+            SELECT  station_id,
+                    COUNT(*) AS item_count,
+                    AVG(JULIANDAY(modified))
+              FROM  StationItem
+             GROUP  BY 1
+            HAVING  item_count > 0
+        """),
+    )
+    # The prices are only needed by some commands, so they have a
+    # snapshot of their own, in station order, taken the first time
+    # one of them asks for it.
+    pricesSnapshotTable = ('StationItem', 'qqqqqqqqq', """
+            SELECT  station_id, item_id,
+                    CAST(strftime('%s', modified) AS INTEGER),
+                    demand_price, demand_units, demand_level,
+                    supply_price, supply_units, supply_level
+              FROM  StationItem
+             ORDER  BY station_id, item_id
+    """)
+
+    def _snapshotStamp(self, conn):
+        """
+        Identifies the state of the DB: a snapshot is only good for
+        the DB it was taken from. SQLite counts the changes made to a
+        DB in its header, and a rebuilt DB is a new file. In WAL mode
+        the counter isn't kept up to date, so the file's time, size
+        and schema version stand in for it.
+        """
+        stat = self.dbPath.stat()
+        with self.dbPath.open('rb') as fh:
+            header = fh.read(100)
+        if len(header) == 100 and header[18:20] == b'\x01\x01':
+            changes = int.from_bytes(header[24:28], 'big')
+        else:
+            schema = conn.execute("PRAGMA schema_version").fetchone()[0]
+            changes = (stat.st_mtime_ns, stat.st_size, schema)
+        return (self.snapshotVersion, stat.st_ino, changes)
+
+    def _openSnapshot(self, conn):
+        """
+        Returns {table: columns} from the snapshot, or None if there
+        isn't one or the DB has changed since it was taken.
+        """
+        stamp = self._snapshotStamp(conn)
+        columns = self._readSnapshot(self.snapshotPath, stamp, "snapshot")
+        if columns is None:
+            return None
+        self.snapshotStamp = stamp
+        snapshot = {}
+        for table, typeCodes, _ in self.snapshotTables:
+            snapshot[table] = columns[:len(typeCodes)]
+            del columns[:len(typeCodes)]
+        return snapshot
+
+    @staticmethod
+    def _snapshotColumns(conn, typeCodes, stmt):
+        """ Runs a snapshot query, returning its columns as arrays. """
+        def packed(typeCode, values):
+            if typeCode != 's':
+                try:
+                    return array(typeCode, values)
+                except TypeError:
+                    # NULLs, or something that isn't the expected type.
+                    pass
+            return list(values)
+
+        rows = conn.execute(stmt).fetchall()
+        columns = list(zip(*rows)) or [()] * len(typeCodes)
+        return [
+            packed(typeCode, values)
+            for typeCode, values in zip(typeCodes, columns)
+        ]
+
+    def _writeSnapshot(self, path, stamp, columns):
+        """
+        Writes a snapshot file: a line of JSON with the stamp and the
+        type and size of each column, then the columns, each starting
+        on a multiple of 8 bytes. Arrays are written as they are in
+        memory so they can be mapped straight back in, anything else
+        as JSON. Failing to write it only means the next run has to
+        query the DB again.
+        """
+        layout, blobs = [], []
+        for column in columns:
+            if isinstance(column, array):
+                layout.append((column.typecode, len(column)))
+                blob = column.tobytes()
+            else:
+                blob = json.dumps(column).encode()
+                layout.append(('s', len(blob)))
+            blobs.append(blob + bytes(-len(blob) % 8))
+        header = json.dumps({'stamp': stamp, 'columns': layout}).encode()
+        header += b' ' * (-(len(header) + 1) % 8) + b'\n'
+        tempPath = path.with_name(path.name + '.new')
+        try:
+            with tempPath.open('wb') as fh:
+                fh.write(header)
+                for blob in blobs:
+                    fh.write(blob)
+            os.replace(str(tempPath), str(path))
+        except OSError as e:
+            self.tdenv.WARN("Couldn't save snapshot: {}", e)
+        else:
+            self.tdenv.DEBUG0("Saved snapshot {}", path)
+
+    def _readSnapshot(self, path, stamp, what, mapped=False):
+        """
+        Returns the list of columns in a snapshot file, or None if
+        there isn't one or it was taken with a different stamp. With
+        mapped, the arrays are memoryviews of the file mapped into
+        memory rather than copies.
+        """
+        try:
+            with path.open('rb') as fh:
+                header = json.loads(fh.readline().decode())
+                if header['stamp'] != json.loads(json.dumps(stamp)):
+                    self.tdenv.DEBUG0("{} is out of date", what.capitalize())
+                    return None
+                offset = fh.tell()
+                if mapped:
+                    data = memoryview(mmap.mmap(
+                        fh.fileno(), 0, access=mmap.ACCESS_READ
+                    ))
+                else:
+                    fh.seek(0)
+                    data = memoryview(fh.read())
+            columns = []
+            for typeCode, size in header['columns']:
+                if typeCode == 's':
+                    end = offset + size
+                else:
+                    end = offset + size * array(typeCode).itemsize
+                if end > len(data):
+                    raise ValueError("{} is truncated".format(path))
+                if typeCode == 's':
+                    column = json.loads(data[offset:end].tobytes().decode())
+                elif mapped:
+                    column = data[offset:end].cast(typeCode)
+                else:
+                    column = array(typeCode)
+                    column.frombytes(data[offset:end])
+                columns.append(column)
+                offset = end + (-end % 8)
+            return columns
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.tdenv.WARN("Ignoring unreadable {}: {}", what, e)
+            return None
+
+    def _saveSnapshot(self, conn):
+        """
+        Takes a new snapshot of the tables.
+        """
+        snapshot = {
+            table: self._snapshotColumns(conn, typeCodes, stmt)
+            for table, typeCodes, stmt in self.snapshotTables
+        }
+        stamp = self._snapshotStamp(conn)
+        self._writeSnapshot(
+            self.snapshotPath, stamp,
+            [column for columns in snapshot.values() for column in columns]
+        )
+        self.snapshotStamp = stamp
+        self.pricesSnapshot = None
+        return snapshot
+
+    def _savePricesSnapshot(self):
+        """
+        Takes a new snapshot of the prices, returning the station IDs
+        in order, where each one's rows start and the columns of the
+        rows, less the station_id.
+        """
+        _, typeCodes, stmt = self.pricesSnapshotTable
+        stnColumn, *columns = self._snapshotColumns(
+            self.getDB(), typeCodes, stmt
+        )
+        stationIDs, offsets = array('q'), array('q')
+        for offset, stnID in enumerate(stnColumn):
+            if not stationIDs or stationIDs[-1] != stnID:
+                stationIDs.append(stnID)
+                offsets.append(offset)
+        offsets.append(len(stnColumn))
+        del stnColumn
+
+        snapshot = [stationIDs, offsets] + columns
+        self._writeSnapshot(self.pricesSnapshotPath, self.snapshotStamp, snapshot)
+        return snapshot
+
+    def invalidateSnapshot(self):
+        """
+        Discards the snapshot after the DB has been changed.
+        """
+        self.snapshot, self.snapshotStamp = None, None
+        self.pricesSnapshot = None
+        for path in (self.snapshotPath, self.pricesSnapshotPath):
+            try:
+                path.unlink()
+            except OSError:
+                # Not there, or still mapped on Windows: either way
+                # its stamp won't match any more.
+                pass
+
+    def snapshotColumns(self, table):
+        """
+        Returns the list of columns of a table in the snapshot, in the
+        same order as the snapshot query, or None if there is no
+        snapshot of the DB as it is now.
+        """
+        if not self.snapshot:
+            return None
+        if self._snapshotStamp(self.getDB()) != self.snapshotStamp:
+            self.snapshot, self.snapshotStamp = None, None
+            self.pricesSnapshot = None
+            return None
+        return self.snapshot[table]
+
+    def snapshotRows(self, table):
+        """
+        Returns an iterable of the rows of a table in the snapshot, or
+        None, like snapshotColumns.
+        """
+        columns = self.snapshotColumns(table)
+        if columns is None:
+            return None
+        return zip(*columns)
+
+    def snapshotPrices(self, stationIDs=None):
+        """
+        Returns an iterable of the StationItem rows
+            (station_id, item_id, modified,
+             demand_price, demand_units, demand_level,
+             supply_price, supply_units, supply_level)
+        for the given station IDs, or for every station, from the
+        prices snapshot; or None, like snapshotColumns. The snapshot
+        is mapped in the first time it's needed, and taken then if
+        there isn't one of the DB as it is now.
+        """
+        if self.snapshotColumns('System') is None:
+            return None
+        if self.pricesSnapshot is None:
+            snapshot = self._readSnapshot(
+                self.pricesSnapshotPath, self.snapshotStamp,
+                "prices snapshot", mapped=True,
+            )
+            if snapshot is None:
+                snapshot = self._savePricesSnapshot()
+            self.pricesSnapshot = snapshot
+
+        stnIDs, offsets, *columns = self.pricesSnapshot
+        if stationIDs is None:
+            stnNos = range(len(stnIDs))
+        else:
+            stnNos = []
+            for stnID in sorted(stationIDs):
+                stnNo = bisect.bisect_left(stnIDs, stnID)
+                if stnNo < len(stnIDs) and stnIDs[stnNo] == stnID:
+                    stnNos.append(stnNo)
+
+        def rows():
+            for stnNo in stnNos:
+                start, end = offsets[stnNo], offsets[stnNo + 1]
+                yield from zip(
+                    itertools.repeat(stnIDs[stnNo], end - start),
+                    *(column[start:end] for column in columns)
+                )
+        return rows()
+
     ############################################################
     # Load "added" data.
 
@@ -789,16 +1501,27 @@ class TradeDB(object):
         Initial load the (raw) list of systems.
         CAUTION: Will orphan previously loaded objects.
         """
-        stmt = """
-                SELECT system_id,
-                       name, pos_x, pos_y, pos_z,
-                       added_id
-                  FROM System
-            """
-        self.cur.execute(stmt)
+        columns = self.snapshotColumns('System')
+        if columns is None:
+            stmt = """
+                    SELECT system_id,
+                           name, pos_x, pos_y, pos_z,
+                           added_id
+                      FROM System
+                """
+            columns = list(zip(*self.cur.execute(stmt))) or [()] * 6
+        positions = self.systemPositions = SystemPositions(
+            len(columns[0]), columns[2:5]
+        )
+        rows = zip(*columns)
+        self.rangeCache.clear()
+        self.nameIndexes.clear()
+        self.routeCacheStamp = None
         systemByID, systemByName = {}, {}
-        for (ID, name, posX, posY, posZ, addedID) in self.cur:
-            system = System(ID, name, posX, posY, posZ, addedID)
+        for rowNo, (ID, name, posX, posY, posZ, addedID) in enumerate(rows):
+            system = System(
+                ID, name, posX, posY, posZ, addedID, positions, rowNo
+            )
             systemByID[ID] = systemByName[name.upper()] = system
 
         self.systemByID, self.systemByName = systemByID, systemByName
@@ -814,9 +1537,28 @@ class TradeDB(object):
             return key.system
 
         return TradeDB.listSearch(
-            "System", key, self.systems(), key=lambda system: system.dbname
+            "System", key, self.systems(), key=lambda system: system.dbname,
+            index=self.getNameIndex("System"),
         )
 
+    def getNameIndex(self, listType):
+        """
+        Returns a NameIndex of the "System" or "Station" names, made
+        the first time they are looked up after they were loaded or
+        changed.
+        """
+        try:
+            return self.nameIndexes[listType]
+        except KeyError:
+            pass
+        if listType == "System":
+            values = self.systemByID.values()
+        else:
+            values = self.stationByID.values()
+        index = NameIndex(values, key=lambda place: place.dbname)
+        self.nameIndexes[listType] = index
+        return index
+
     def addLocalSystem(
             self,
             name,
@@ -843,7 +1585,11 @@ class TradeDB(object):
             name, x, y, z, added, modified,
         ])
         ID = cur.lastrowid
-        system = System(ID, name.upper(), x, y, z, 0)
+        positions = self.systemPositions
+        system = System(
+            ID, name.upper(), x, y, z, 0,
+            positions, positions.append(x, y, z),
+        )
         self.systemByID[ID] = system
         self.systemByName[system.dbname] = system
         if commit:
@@ -854,6 +1600,10 @@ class TradeDB(object):
         )
         # Invalidate the grid
         self.stellarGrid = None
+        self.systemGraph = None
+        self.rangeCache.clear()
+        self.nameIndexes.clear()
+        self.routeCacheStamp = None
         return system
 
     def updateLocalSystem(
@@ -897,6 +1647,7 @@ class TradeDB(object):
             added, modified,
         )
         self.systemByName[dbname] = system
+        self.nameIndexes.clear()
 
         return True
 
@@ -917,6 +1668,12 @@ class TradeDB(object):
             db.commit()
         del self.systemByName[system.dbname]
         del self.systemByID[system.ID]
+        # Invalidate the grid
+        self.stellarGrid = None
+        self.systemGraph = None
+        self.rangeCache.clear()
+        self.nameIndexes.clear()
+        self.routeCacheStamp = None
 
         self.tdenv.NOTE(
             "{} (#{}) deleted from {}",
@@ -931,7 +1688,12 @@ class TradeDB(object):
         """
         Divides the galaxy into a fixed-sized grid allowing us to
         aggregate small numbers of stars by locality.
+
+        With numpy, this is a StellarIndex instead.
         """
+        if haveNumpy:
+            self.stellarGrid = StellarIndex(self.systemByID.values())
+            return
         stellarGrid = self.stellarGrid = dict()
         for system in self.systemByID.values():
             key = makeStellarGridKey(system.posX, system.posY, system.posZ)
@@ -962,6 +1724,9 @@ class TradeDB(object):
         """
         if self.stellarGrid is None:
             self.__buildStellarGrid()
+        if haveNumpy:
+            yield from self.stellarGrid.genSystemsNear(system, ly)
+            return
 
         sysX, sysY, sysZ = system.posX, system.posY, system.posZ
         lwrBound = makeStellarGridKey(sysX - ly, sysY - ly, sysZ - ly)
@@ -991,8 +1756,8 @@ class TradeDB(object):
     def genSystemsInRange(self, system, ly, includeSelf=False):
         """
         Yields Systems within a given radius of a specified System.
-        Results are sorted by distance and cached for subsequent
-        queries in the same run.
+        Results are sorted by distance and kept in rangeCache for
+        subsequent queries in the same run.
 
         Args:
             system:
@@ -1010,23 +1775,21 @@ class TradeDB(object):
                     The distance in lightyears between system and candidate.
         """
 
-        cache = system._rangeCache
-        if not cache:
-            cache = system._rangeCache = System.RangeCache()
-        cachedSystems = cache.systems
-
-        if ly > cache.probedLy:
+        cache = self.rangeCache
+        entry = cache.get(system, ly)
+        if entry:
+            probedLy, cachedSystems = entry
+        else:
             # Consult the database for stars we haven't seen.
-            cachedSystems = cache.systems = list(
-                self.genStellarGrid(system, ly)
-            )
+            cachedSystems = list(self.genStellarGrid(system, ly))
             cachedSystems.sort(key=lambda ent: ent[1])
-            cache.probedLy = ly
+            probedLy = ly
+            cache.put(system, ly, cachedSystems)
 
         if includeSelf:
             yield system, 0.
 
-        if cache.probedLy > ly:
+        if probedLy > ly:
             # Cache may contain values outside our view
             for sys, dist in cachedSystems:
                 if dist <= ly:
@@ -1035,12 +1798,199 @@ class TradeDB(object):
             # No need to be conditional inside the loop
             yield from cachedSystems
 
+    def getSystemGraph(self, ly, build=True):
+        """
+        Returns a SystemGraph with every link between systems no more
+        than ly apart (and maybe longer ones), or None if ly is more
+        than maxSystemLinkLy.
+
+        Graphs are saved beside the DB and reused until the list of
+        systems changes; a graph for a longer ly does for shorter ones.
+        Building one takes a while, so without build this only returns
+        a graph that is already at hand.
+        """
+        if ly > self.maxSystemLinkLy:
+            return None
+        graph = self.systemGraph
+        if graph is None:
+            # Not looked for since the systems last changed.
+            systems = list(self.systemByID.values())
+            stamp = SystemGraph.stampOf(systems)
+            graph = self._openSystemGraph(stamp, systems)
+            self.systemGraph = graph or False
+        if graph and graph.ly >= ly:
+            return graph
+        if not build:
+            return None
+
+        systems = list(self.systemByID.values())
+        stamp = SystemGraph.stampOf(systems)
+        # Leave some room for the next run to ask for a bit more.
+        linkLy = min(self.maxSystemLinkLy, math.ceil(ly / 5) * 5)
+        graph = self._buildSystemGraph(linkLy, stamp, systems)
+        self._saveSystemGraph(graph)
+        self.systemGraph = graph
+        return graph
+
+    def _openSystemGraph(self, stamp, systems):
+        """
+        Returns the saved SystemGraph, or None if there isn't one for
+        these systems.
+        """
+        try:
+            with self.systemGraphPath.open('rb') as fh:
+                version, graphStamp, ly = pickle.load(fh)
+                if version != self.systemGraphVersion or graphStamp != stamp:
+                    self.tdenv.DEBUG0("System graph is out of date")
+                    return None
+                offsets, neighbourRows, dists = pickle.load(fh)
+                landmarks = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            self.tdenv.WARN("Ignoring unreadable system graph: {}", e)
+            return None
+        return SystemGraph(
+            ly, stamp, systems, offsets, neighbourRows, dists, landmarks
+        )
+
+    def _saveSystemGraph(self, graph):
+        """
+        Saves a SystemGraph; failing to only means the next run has to
+        build it again.
+        """
+        tempPath = self.systemGraphPath.with_suffix('.new')
+        try:
+            with tempPath.open('wb') as fh:
+                pickle.dump((self.systemGraphVersion, graph.stamp, graph.ly), fh)
+                pickle.dump(
+                    (graph.offsets, graph.neighbourRows, graph.dists),
+                    fh, pickle.HIGHEST_PROTOCOL
+                )
+                pickle.dump(graph.landmarks, fh, pickle.HIGHEST_PROTOCOL)
+            os.replace(str(tempPath), str(self.systemGraphPath))
+        except OSError as e:
+            self.tdenv.WARN("Couldn't save system graph: {}", e)
+        else:
+            self.tdenv.DEBUG0("Saved system graph {}", self.systemGraphPath)
+
+    def _buildSystemGraph(self, ly, stamp, systems):
+        """
+        Finds the neighbours of each of the systems within ly, in the
+        same order genSystemsInRange would list them.
+        """
+        started = time.time()
+        lySq = ly ** 2
+        offsets, neighbourRows, dists = array('q', [0]), array('i'), array('d')
+        if not haveNumpy:
+            rowByID = {system.ID: row for row, system in enumerate(systems)}
+            for system in systems:
+                near = sorted(
+                    self.genStellarGrid(system, ly), key=lambda ent: ent[1]
+                )
+                neighbourRows.extend(rowByID[nSys.ID] for nSys, _ in near)
+                dists.extend(dist for _, dist in near)
+                offsets.append(len(dists))
+        else:
+            coords = numpy.array(
+                [(system.posX, system.posY, system.posZ) for system in systems],
+                numpy.float64,
+            ).reshape(-1, 3)
+            srcs, dsts = self._findSystemLinks(coords, ly)
+            # The exact test, as genStellarGrid does it: this comes out
+            # the same as python, but numpy.sqrt doesn't always agree
+            # with "** 0.5" in the last digit.
+            delta = coords[dsts] - coords[srcs]
+            delta *= delta
+            distSq = delta[:, 0] + delta[:, 1] + delta[:, 2]
+            keep = (distSq <= lySq) & (srcs != dsts)
+            srcs, dsts = srcs[keep], dsts[keep]
+            linkDists = numpy.array(
+                [dSq ** 0.5 for dSq in distSq[keep].tolist()], numpy.float64
+            )
+            # Nearest first, ties in the order the grid visits them.
+            cells = coords.astype(numpy.int64) >> 5
+            gridOrder = numpy.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+            gridPos = numpy.empty(len(systems), numpy.int64)
+            gridPos[gridOrder] = numpy.arange(len(systems))
+            order = numpy.lexsort((gridPos[dsts], linkDists, srcs))
+            neighbourRows.frombytes(dsts[order].astype(numpy.int32).tobytes())
+            dists.frombytes(linkDists[order].tobytes())
+            counts = numpy.bincount(srcs, minlength=len(systems))
+            offsets.frombytes(numpy.cumsum(counts).astype(numpy.int64).tobytes())
+
+        self.tdenv.DEBUG0(
+            "Built {}ly system graph: {:n} links in {:.2f}s",
+            ly, len(dists), time.time() - started
+        )
+        return SystemGraph(ly, stamp, systems, offsets, neighbourRows, dists)
+
+    @staticmethod
+    def _findSystemLinks(coords, ly):
+        """
+        numpy: returns arrays of the source and destination rows of
+        every pair of coords within ly of each other, and a few just
+        outside it. Rows are put in cells 'ly' across, so all of their
+        neighbours are in the surrounding 27 cells.
+        """
+        limit = ly ** 2 * 1.0001 + 0.01
+        bits, offset = 21, 1 << 20
+        batchSize = 250000
+        cells = numpy.floor(coords / (ly * 1.0001 + 0.01)).astype(numpy.int64)
+        cells += offset
+        keys = (cells[:, 0] << (bits * 2)) + (cells[:, 1] << bits) + cells[:, 2]
+        order = numpy.argsort(keys, kind='stable')
+        coords = coords[order]
+        cellKeys, starts, counts = numpy.unique(
+            keys[order], return_index=True, return_counts=True
+        )
+
+        srcRows, dstRows = [], []
+        for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+            nearKeys = cellKeys + ((dx << (bits * 2)) + (dy << bits) + dz)
+            nearNos = cellKeys.searchsorted(nearKeys)
+            nearNos[nearNos >= len(cellKeys)] = 0
+            srcCells = numpy.flatnonzero(cellKeys[nearNos] == nearKeys)
+            dstCells = nearNos[srcCells]
+            # Every row of one cell against every row of the other, in
+            # batches to keep the temporary arrays to a few MB.
+            pairCounts = counts[srcCells] * counts[dstCells]
+            cuts = numpy.cumsum(pairCounts).searchsorted(
+                numpy.arange(batchSize, pairCounts.sum(), batchSize)
+            ).tolist()
+            bounds = sorted(set([0] + cuts + [len(pairCounts)]))
+            for lwr, upr in zip(bounds, bounds[1:]):
+                batch = slice(lwr, upr)
+                batchCounts = pairCounts[batch]
+                pairNos = numpy.repeat(
+                    numpy.arange(len(batchCounts)), batchCounts
+                )
+                firsts = numpy.cumsum(batchCounts) - batchCounts
+                pairOffsets = numpy.arange(len(pairNos)) - firsts[pairNos]
+                dstCounts = counts[dstCells[batch]][pairNos]
+                srcs = starts[srcCells[batch]][pairNos]
+                srcs += pairOffsets // dstCounts
+                dsts = starts[dstCells[batch]][pairNos]
+                dsts += pairOffsets % dstCounts
+                delta = coords[srcs] - coords[dsts]
+                near = numpy.einsum('ij,ij->i', delta, delta) <= limit
+                srcRows.append(order[srcs[near]])
+                dstRows.append(order[dsts[near]])
+        if not srcRows:
+            return numpy.array([], numpy.int64), numpy.array([], numpy.int64)
+        return numpy.concatenate(srcRows), numpy.concatenate(dstRows)
+
     def getRoute(self, origin, dest, maxJumpLy, avoiding=[], stationInterval=0):
         """
         Find a shortest route between two systems with an additional
         constraint that each system be a maximum of maxJumpLy from
         the previous system.
 
+        Without a stationInterval this searches out from both ends at
+        once; either way it is guided by a lower bound on how far the
+        rest of the route is: the straight line, or from landmarks on
+        the system graph (see SystemGraph.findLandmarks).
+
         Args:
             origin:
                 System (or station) to start from,
@@ -1085,6 +2035,54 @@ class TradeDB(object):
         if origin == dest:
             return ((origin, 0), (dest, 0))
 
+        # Systems to avoid go in with a distance of -1 so that no route
+        # to them is ever shorter.
+        avoided = {}
+        if avoiding:
+            if dest in avoiding:
+                raise ValueError("Destination is in avoidance list")
+            for avoid in avoiding:
+                if isinstance(avoid, System):
+                    avoided[avoid] = (None, -1)
+
+        routeKey = self._getRouteCacheKey(maxJumpLy, avoided, stationInterval)
+        route = self._getCachedRoute(origin, dest, routeKey)
+        if not route:
+            route = self._findRoute(
+                origin, dest, maxJumpLy, avoided, stationInterval
+            )
+            if route:
+                self._saveCachedRoute(routeKey, route)
+        return route
+
+    def _findRoute(self, origin, dest, maxJumpLy, avoided, stationInterval):
+        """ getRoute without the route cache. """
+        longRoute = (
+            origin.distanceTo(dest) >= maxJumpLy * self.systemGraphJumps
+        )
+        graph = self.getSystemGraph(maxJumpLy, build=longRoute)
+        if graph:
+            systemsInRange = graph.genSystemsInRange
+            if graph.landmarks is None and longRoute:
+                started = time.time()
+                graph.findLandmarks(self.routeLandmarks)
+                self.tdenv.DEBUG0(
+                    "Found {} route landmarks in {:.2f}s",
+                    len(graph.landmarks), time.time() - started
+                )
+                self._saveSystemGraph(graph)
+        else:
+            systemsInRange = self.genSystemsInRange
+        toDest = self._getRouteBound(graph, dest)
+        if toDest(origin) == math.inf:
+            return None
+
+        if not stationInterval:
+            return self._getRouteBothWays(
+                origin, dest, maxJumpLy, avoided, systemsInRange,
+                toDest, self._getRouteBound(graph, origin),
+            )
+
         # openSet is the list of nodes we want to visit, which will be
         # used as a priority queue (heapq).
         # Each element is a tuple of the 'priority' (the combination of
@@ -1093,15 +2091,8 @@ class TradeDB(object):
         openSet = [(0, 0, origin.ID, 0)]
         # Track predecessor nodes for everwhere we visit
         distances = {origin: (None, 0)}
+        distances.update(avoided)
 
-        if avoiding:
-            if dest in avoiding:
-                raise ValueError("Destination is in avoidance list")
-            for avoid in avoiding:
-                if isinstance(avoid, System):
-                    distances[avoid] = (None, -1)
-
-        systemsInRange = self.genSystemsInRange
         heappop  = heapq.heappop
         heappush = heapq.heappush
         distTo = float("inf")
@@ -1111,14 +2102,10 @@ class TradeDB(object):
         destID = dest.ID
         sysByID = self.systemByID
 
-        maxPadSize = self.tdenv.padSize
-        if not maxPadSize:
-            checkStations = lambda system: bool(system.stations())
-        else:
-            checkStations = lambda system: any(
-                stn for stn in system.stations
-                if stn.checkPadSize(maxPadSize)
-            )
+        padMask = StationFeatures.compile(maxPadSize=self.tdenv.padSize)
+        checkStations = lambda system: any(
+            not stn.features & padMask for stn in system.stations
+        )
 
         while openSet:
             weight, curDist, curSysID, stnDist = heappop(openSet)
@@ -1135,23 +2122,23 @@ class TradeDB(object):
                 continue
 
             system_iter = iter(systemsInRange(curSys, maxJumpLy))
-            if stationInterval:
-                if checkStations(curSys):
-                    stnDist = 0
-                else:
-                    stnDist += 1
-                    if stnDist >= stationInterval:
-                        system_iter = iter(
-                            v for v in system_iter if checkStations(v[0])
-                        )
+            if checkStations(curSys):
+                stnDist = 0
+            else:
+                stnDist += 1
+                if stnDist >= stationInterval:
+                    system_iter = iter(
+                        v for v in system_iter if checkStations(v[0])
+                    )
 
-            distFn = curSys.distanceTo
             for nSys, nDist in system_iter:
                 newDist = curDist + nDist
                 if getDist(nSys, defaultDist)[1] <= newDist:
                     continue
+                weight = toDest(nSys)
+                if weight == math.inf:
+                    continue
                 distances[nSys] = (curSys, newDist)
-                weight = distFn(nSys)
                 nID = nSys.ID
                 heappush(openSet, (newDist + weight, newDist, nID, stnDist))
                 if nID == destID:
@@ -1173,6 +2160,278 @@ class TradeDB(object):
 
         return path
 
+    @staticmethod
+    def _getRouteBound(graph, target):
+        """
+        Returns a function giving a lower bound on the length of any
+        route from a system to target, or inf if there can't be one.
+        """
+        distanceTo = target.distanceTo
+        if not graph or not graph.landmarks:
+            return distanceTo
+        rowByID, routeLengthBound = graph.rowByID, graph.routeLengthBound
+        targetRow = rowByID[target.ID]
+
+        def getBound(system):
+            bound = routeLengthBound(rowByID[system.ID], targetRow)
+            return max(bound, distanceTo(system))
+
+        return getBound
+
+    def _getRouteBothWays(
+            self, origin, dest, maxJumpLy, avoided, systemsInRange,
+            toDest, toOrigin,
+            ):
+        """
+        getRoute without a stationInterval: A* out from the origin and
+        back from the destination at the same time until no route
+        through where they meet could be bettered.
+
+        Both searches use half the difference between the bounds to
+        the destination and from the origin as their estimate (with
+        opposite signs) so they agree on it, which lets them stop as
+        soon as their next two systems add up to the best route.
+        """
+        heappop, heappush = heapq.heappop, heapq.heappush
+        sysByID = self.systemByID
+        noDist = (None, math.inf)
+
+        # For each direction: {system: (previous system, distance, ly
+        # from the previous system)} and the open set, (distance +
+        # estimate, distance, system ID).
+        forward, backward = {origin: (None, 0, 0)}, {dest: (None, 0, 0)}
+        forward.update(avoided)
+        backward.update(avoided)
+        forwardSet, backwardSet = [(0, 0, origin.ID)], [(0, 0, dest.ID)]
+        estimates = {}
+
+        def estimate(system):
+            try:
+                return estimates[system]
+            except KeyError:
+                toDestLy = toDest(system)
+                if toDestLy == math.inf:
+                    value = None
+                else:
+                    value = (toDestLy - toOrigin(system)) / 2
+                estimates[system] = value
+                return value
+
+        bestDist, meeting = math.inf, None
+        while forwardSet and backwardSet:
+            if forwardSet[0][0] + backwardSet[0][0] >= bestDist:
+                break
+            # Grow whichever side has the fewest systems waiting.
+            if len(forwardSet) <= len(backwardSet):
+                openSet, distances, others, sign = forwardSet, forward, backward, 1
+            else:
+                openSet, distances, others, sign = backwardSet, backward, forward, -1
+            _, curDist, curSysID = heappop(openSet)
+            curSys = sysByID[curSysID]
+            if curDist > distances[curSys][1]:
+                continue
+            getDist, getOther = distances.get, others.get
+            for nSys, nDist in systemsInRange(curSys, maxJumpLy):
+                newDist = curDist + nDist
+                if getDist(nSys, noDist)[1] <= newDist:
+                    continue
+                weight = estimate(nSys)
+                if weight is None:
+                    continue
+                distances[nSys] = (curSys, newDist, nDist)
+                heappush(openSet, (newDist + sign * weight, newDist, nSys.ID))
+                otherDist = getOther(nSys, noDist)[1]
+                if newDist + otherDist < bestDist:
+                    bestDist, meeting = newDist + otherDist, nSys
+
+        if not meeting:
+            return None
+
+        route = []
+        system = meeting
+        while system:
+            route.append((system, forward[system][1]))
+            system = forward[system][0]
+        route.reverse()
+        # Add up the rest of the jumps as a forward search would have.
+        system, dist = meeting, route[-1][1]
+        while system != dest:
+            system, _, jumpLy = backward[system]
+            dist += jumpLy
+            route.append((system, dist))
+        return route
+
+    ############################################################
+    # Routes getRoute found before, kept in a DB of their own next to
+    # the system graph so that saving them doesn't change the main DB:
+    # every part of a shortest route is a shortest route too, so one
+    # route answers questions about any two systems along it.
+
+    # How many routes to keep; the oldest go first.
+    routeCacheSize = 2000
+
+    routeCacheTables = (
+        """
+            CREATE TABLE IF NOT EXISTS RouteCache (
+                route_id INTEGER PRIMARY KEY,
+                stamp VARCHAR(32) NOT NULL,
+                max_ly DOUBLE NOT NULL,
+                pad_size VARCHAR(3) NOT NULL,
+                station_interval INTEGER NOT NULL,
+                avoiding VARCHAR(32) NOT NULL,
+                jumps INTEGER NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS RouteCacheJump (
+                route_id INTEGER NOT NULL,
+                jump_no INTEGER NOT NULL,
+                system_id INTEGER NOT NULL,
+                dist_ly DOUBLE NOT NULL,
+
+                PRIMARY KEY (route_id, jump_no)
+            ) WITHOUT ROWID
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS idx_route_cache_jump_by_system
+                ON RouteCacheJump (system_id, route_id, jump_no)
+        """,
+    )
+
+    def _getRouteCacheKey(self, maxJumpLy, avoided, stationInterval):
+        """
+        Returns what, besides the two systems, decides which route
+        getRoute finds: the pad size only matters for refuelling.
+        """
+        avoiding = ""
+        if avoided:
+            avoidIDs = array('q', sorted(system.ID for system in avoided))
+            avoiding = hashlib.md5(avoidIDs.tobytes()).hexdigest()
+        padSize = (stationInterval and self.tdenv.padSize) or ""
+        return (maxJumpLy, padSize, stationInterval or 0, avoiding)
+
+    def _openRouteCache(self):
+        """
+        Opens the route cache DB, creating its tables if need be, and
+        forgets routes through systems that have changed since. Returns
+        the stamp of the current systems, or False if routes can't be
+        cached.
+        """
+        if self.routeCacheStamp is not None:
+            return self.routeCacheStamp
+        graph = self.systemGraph
+        if graph:
+            stamp = graph.stamp
+        else:
+            stamp = SystemGraph.stampOf(list(self.systemByID.values()))
+        try:
+            db = self.routeCacheDB
+            if not db:
+                db = sqlite3.connect(str(self.routeCachePath))
+                self.routeCacheDB = db
+            for stmt in self.routeCacheTables:
+                db.execute(stmt)
+            db.execute("""
+                DELETE FROM RouteCacheJump
+                 WHERE route_id IN (
+                        SELECT route_id FROM RouteCache WHERE stamp != ?
+                       )
+            """, [stamp])
+            db.execute("DELETE FROM RouteCache WHERE stamp != ?", [stamp])
+            db.commit()
+        except sqlite3.Error as e:
+            self.tdenv.WARN("Can't cache routes: {}", e)
+            stamp = False
+        self.routeCacheStamp = stamp
+        return stamp
+
+    def _getCachedRoute(self, origin, dest, routeKey):
+        """
+        Returns the part of a cached route between origin and dest,
+        in either direction, or None. Routes with refuelling stops
+        only do for exactly the same origin and dest.
+        """
+        if not self._openRouteCache():
+            return None
+        db = self.routeCacheDB
+        row = db.execute("""
+            SELECT  r.route_id, a.jump_no, b.jump_no
+              FROM  RouteCache AS r
+                    INNER JOIN RouteCacheJump AS a
+                        ON (a.route_id = r.route_id AND a.system_id = ?)
+                    INNER JOIN RouteCacheJump AS b
+                        ON (b.route_id = r.route_id AND b.system_id = ?)
+             WHERE  r.max_ly = ? AND r.pad_size = ?
+                    AND r.station_interval = ? AND r.avoiding = ?
+                    AND (r.station_interval = 0 OR
+                            (a.jump_no = 0 AND b.jump_no = r.jumps))
+             LIMIT  1
+        """, [origin.ID, dest.ID] + list(routeKey)).fetchone()
+        if not row:
+            self.tdenv.DEBUG1(
+                "No cached route {} -> {}", origin.name(), dest.name()
+            )
+            return None
+
+        routeID, originNo, destNo = row
+        jumps = db.execute("""
+            SELECT  system_id, dist_ly
+              FROM  RouteCacheJump
+             WHERE  route_id = ? AND jump_no BETWEEN ? AND ?
+             ORDER  BY jump_no
+        """, [routeID, min(originNo, destNo), max(originNo, destNo)]).fetchall()
+        if originNo > destNo:
+            jumps.reverse()
+        sysByID = self.systemByID
+        startLy = jumps[0][1]
+        route = [(origin, 0)]
+        if originNo == 0:
+            route += [(sysByID[ID], distLy) for ID, distLy in jumps[1:]]
+        else:
+            route += [
+                (sysByID[ID], abs(distLy - startLy)) for ID, distLy in jumps[1:]
+            ]
+        self.tdenv.DEBUG1(
+            "Cached route {} -> {}: {} jumps",
+            origin.name(), dest.name(), len(route) - 1
+        )
+        return route
+
+    def _saveCachedRoute(self, routeKey, route):
+        """ Remembers a route getRoute found. """
+        stamp = self._openRouteCache()
+        if not stamp:
+            return
+        try:
+            db = self.routeCacheDB
+            cur = db.execute("""
+                INSERT INTO RouteCache (
+                    stamp, max_ly, pad_size, station_interval, avoiding, jumps
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            """, [stamp] + list(routeKey) + [len(route) - 1])
+            routeID = cur.lastrowid
+            db.executemany("""
+                INSERT INTO RouteCacheJump (
+                    route_id, jump_no, system_id, dist_ly
+                ) VALUES (?, ?, ?, ?)
+            """, [
+                (routeID, jumpNo, system.ID, distLy)
+                for jumpNo, (system, distLy) in enumerate(route)
+            ])
+            # Route IDs only grow until the cache is emptied, so the
+            # oldest routes are the ones with the lowest IDs.
+            oldest = routeID - self.routeCacheSize
+            if oldest > 0:
+                db.execute(
+                    "DELETE FROM RouteCacheJump WHERE route_id <= ?", [oldest]
+                )
+                db.execute(
+                    "DELETE FROM RouteCache WHERE route_id <= ?", [oldest]
+                )
+            db.commit()
+        except sqlite3.Error as e:
+            self.tdenv.WARN("Couldn't cache route: {}", e)
+
     ############################################################
     # Station data.
 
@@ -1186,13 +2445,15 @@ class TradeDB(object):
         Station constructor automatically adds itself to the System object.
         CAUTION: Will orphan previously loaded objects.
         """
-        stmt = """
-            SELECT  station_id, system_id, name,
-                    ls_from_star, market, blackmarket, shipyard,
-                    max_pad_size, outfitting, rearm, refuel, repair, planetary
-              FROM  Station
-        """
-        self.cur.execute(stmt)
+        rows = self.snapshotRows('Station')
+        if rows is None:
+            stmt = """
+                SELECT  station_id, system_id, name,
+                        ls_from_star, market, blackmarket, shipyard,
+                        max_pad_size, outfitting, rearm, refuel, repair, planetary
+                  FROM  Station
+            """
+            rows = self.cur.execute(stmt)
         stationByID = {}
         systemByID = self.systemByID
         self.tradingStationCount = 0
@@ -1200,7 +2461,7 @@ class TradeDB(object):
             ID, systemID, name,
             lsFromStar, market, blackMarket, shipyard,
             maxPadSize, outfitting, rearm, refuel, repair, planetary,
-        ) in self.cur:
+        ) in rows:
             station = Station(
                 ID, systemByID[systemID], name,
                 lsFromStar, market, blackMarket, shipyard,
@@ -1210,15 +2471,24 @@ class TradeDB(object):
             stationByID[ID] = station
 
         tradingCount = 0
-        stmt = """
-            SELECT  station_id,
-                    COUNT(*) AS item_count,
-                    AVG(JULIANDAY('now') - JULIANDAY(modified))
-              FROM  StationItem
-             GROUP  BY 1
-             HAVING item_count > 0
-        """
-        for ID, itemCount, dataAge in self.cur.execute(stmt):
+        rows = self.snapshotRows('StationTrading')
+        if rows is None:
+            stmt = """
+                SELECT  station_id,
+                        COUNT(*) AS item_count,
+                        AVG(JULIANDAY('now') - JULIANDAY(modified))
+                  FROM  StationItem
+                 GROUP  BY 1
+                 HAVING item_count > 0
+            """
+            rows = self.cur.execute(stmt)
+        else:
+            now = self.cur.execute("SELECT JULIANDAY('now')").fetchone()[0]
+            rows = (
+                (ID, itemCount, now - modified)
+                for ID, itemCount, modified in rows
+            )
+        for ID, itemCount, dataAge in rows:
             station = stationByID[ID]
             station.itemCount = itemCount
             station.dataAge = dataAge
@@ -1228,6 +2498,9 @@ class TradeDB(object):
         self.tradingStationCount = tradingCount
         self.tdenv.DEBUG1("Loaded {:n} Stations", len(stationByID))
         self.stellarGrid = None
+        self.stationFilters.clear()
+        self.nameIndexes.clear()
+        self.stationTable = None
 
     def addLocalStation(
             self,
@@ -1305,6 +2578,9 @@ class TradeDB(object):
             itemCount=0, dataAge=0,
         )
         self.stationByID[ID] = station
+        self.stationFilters.clear()
+        self.nameIndexes.clear()
+        self.stationTable = None
         if commit:
             db.commit()
         self.tdenv.NOTE(
@@ -1378,6 +2654,10 @@ class TradeDB(object):
         _check_setting("ref", "refuel", refuel, TradeDB.marketStates)
         _check_setting("rep", "repair", repair, TradeDB.marketStates)
         _check_setting("plt", "planetary", planetary, TradeDB.planetStates)
+        station.features = StationFeatures.of(station)
+        self.stationFilters.clear()
+        self.nameIndexes.clear()
+        self.stationTable = None
 
         if not changes:
             return False
@@ -1440,6 +2720,9 @@ class TradeDB(object):
 
         # Remove the ID lookup
         del self.stationByID[station.ID]
+        self.stationFilters.clear()
+        self.nameIndexes.clear()
+        self.stationTable = None
 
         # Delete database entry
         db = self.getDB()
@@ -1573,12 +2856,17 @@ class TradeDB(object):
                 if placeNameTrimmed.find(nameTrimmed) >= 0:
                     anyMatch.append(place)
 
+        # Only names which contain the normalized name can match.
+        normalizedStr = TradeDB.normalizedStr
         if sysName:
             try:
                 sys = self.systemByName[sysName]
                 exactMatch = [sys]
             except KeyError:
-                lookup(sysName, self.systemByID.values())
+                lookup(
+                    sysName,
+                    self.getNameIndex("System").find(normalizedStr(sysName))
+                )
         if stnName:
             # Are we considering the name as a station?
             # (we don't if they type, e,g '@aulin')
@@ -1600,7 +2888,9 @@ class TradeDB(object):
                 anyMatch = []
             else:
                 # Consider against all station names
-                stationCandidates = self.stationByID.values()
+                stationCandidates = self.getNameIndex("Station").find(
+                    normalizedStr(stnName)
+                )
             lookup(stnName, stationCandidates)
 
         # consult the match sets in ranking order for a single
@@ -1652,14 +2942,16 @@ class TradeDB(object):
         try:
             system = TradeDB.listSearch(
                 "System", name, self.systemByID.values(),
-                key=lambda system: system.dbname
+                key=lambda system: system.dbname,
+                index=self.getNameIndex("System"),
             )
         except LookupError:
             pass
         try:
             station = TradeDB.listSearch(
                 "Station", name, self.stationByID.values(),
-                key=lambda station: station.dbname
+                key=lambda station: station.dbname,
+                index=self.getNameIndex("Station"),
             )
         except LookupError:
             pass
@@ -1739,6 +3031,14 @@ class TradeDB(object):
         if origSys.ID not in pathList:
             pathList[origSys.ID] = openList[0]
 
+        graph = self.getSystemGraph(
+            maxLyPer, build=(maxJumps >= self.systemGraphJumps)
+        )
+        if graph:
+            systemsInRange = graph.genSystemsInRange
+        else:
+            systemsInRange = self.genSystemsInRange
+
         # As long as the open list is not empty, keep iterating.
         jumps = 0
         while openList and jumps < maxJumps:
@@ -1752,8 +3052,8 @@ class TradeDB(object):
             ring.sort(key=lambda dn: dn.distLy)
 
             for node in ring:
-                for (destSys, destDist) in self.genSystemsInRange(
-                        node.system, maxLyPer, False
+                for (destSys, destDist) in systemsInRange(
+                        node.system, maxLyPer
                         ):
                     dist = node.distLy + destDist
                     # If we already have a shorter path, do nothing
@@ -1775,40 +3075,85 @@ class TradeDB(object):
 
         # We have a system-to-system path list, now we
         # need stations to terminate at.
-        def path_iter_fn():
-            for node in pathList.values():
-                if node.distLy >= 0.0:
-                    for station in node.system.stations:
-                        yield node, station
+        stationFilter = self.getStationFilter(
+            avoidPlaces=avoidPlaces,
+            maxPadSize=maxPadSize,
+            maxLsFromStar=maxLsFromStar,
+            noPlanet=noPlanet,
+            planetary=planetary,
+        )
+        for node in pathList.values():
+            if node.distLy >= 0.0:
+                for stn in filter(stationFilter, node.system.stations):
+                    yield Destination(node.system, stn, node.via, node.distLy)
 
-        path_iter = iter(path_iter_fn())
-        if noPlanet:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.planetary == 'N'
-            )
-        if avoidPlaces:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station not in avoidPlaces
-            )
-        if maxPadSize:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.checkPadSize(maxPadSize)
-            )
-        if planetary:
-            path_iter = iter(
-                (node, station) for (node, station) in path_iter
-                if station.checkPlanetary(planetary)
+    def getStationFilter(
+            self,
+            avoidPlaces=None,
+            maxPadSize=None,
+            maxLsFromStar=0,
+            noPlanet=False,
+            planetary=None,
+            ):
+        """
+        Returns a function which tells whether a station meets all of
+        the getDestinations constraints. The pad size and planetary
+        requirements are compiled into a StationFeatures mask.
+
+        With numpy, every station is checked at once and the function
+        just looks the station up in the set that passed; filters are
+        remembered until the stations change.
+        """
+        avoidStations = frozenset(
+            place for place in avoidPlaces or ()
+            if isinstance(place, Station)
+        )
+        mask = StationFeatures.compile(
+            noPlanet=noPlanet, maxPadSize=maxPadSize, planetary=planetary,
+        )
+
+        if haveNumpy:
+            key = (mask, maxLsFromStar, avoidStations)
+            try:
+                return self.stationFilters[key]
+            except KeyError:
+                pass
+            passing = self.filterStations(mask, maxLsFromStar) - avoidStations
+            stationFilter = self.stationFilters[key] = passing.__contains__
+            return stationFilter
+
+        def stationFilter(stn):
+            if stn.features & mask:
+                return False
+            if stn in avoidStations:
+                return False
+            # Even with no limit, stations we don't know the distance
+            # to are left out.
+            if maxLsFromStar and not 0 < stn.lsFromStar <= maxLsFromStar:
+                return False
+            return True
+
+        return stationFilter
+
+    def filterStations(self, mask, maxLsFromStar=0):
+        """
+        numpy: returns a frozenset of the stations with none of the
+        features in mask and, given a maxLsFromStar, a known distance
+        from the star no more than that.
+        """
+        table = self.stationTable
+        if table is None:
+            stations = list(self.stationByID.values())
+            table = self.stationTable = (
+                stations,
+                numpy.array([stn.features for stn in stations], numpy.int64),
+                numpy.array([stn.lsFromStar for stn in stations], numpy.float64),
             )
+        stations, features, lsFromStar = table
+        keep = (features & mask) == 0
         if maxLsFromStar:
-            path_iter = iter(
-                (node, stn) for (node, stn) in path_iter
-                if stn.lsFromStar > 0 and stn.lsFromStar <= maxLsFromStar
-            )
-        for node, stn in path_iter:
-            yield Destination(node.system, stn, node.via, node.distLy)
+            keep &= (lsFromStar > 0) & (lsFromStar <= maxLsFromStar)
+        return frozenset(itertools.compress(stations, keep.tolist()))
 
     ############################################################
     # Ship data.
@@ -2005,10 +3350,15 @@ class TradeDB(object):
     # Price data.
 
     def close(self):
+        if self.rangeCache.hits or self.rangeCache.misses:
+            self.tdenv.DEBUG0("Range cache: {}", self.rangeCache)
         self.cur = None
         if self.conn:
             self.conn.close()
         self.conn = None
+        if self.routeCacheDB:
+            self.routeCacheDB.close()
+        self.routeCacheDB, self.routeCacheStamp = None, None
 
     def load(self, maxSystemLinkLy=None):
         """
@@ -2025,6 +3375,10 @@ class TradeDB(object):
         self.conn = conn = self.getDB()
         self.cur = conn.cursor()
 
+        self.snapshot = self._openSnapshot(conn)
+        if self.snapshot is None:
+            self.snapshot = self._saveSnapshot(conn)
+
         self._loadAdded()
         self._loadSystems()
         self._loadStations()
@@ -2045,12 +3399,16 @@ class TradeDB(object):
     def listSearch(
             listType, lookup, values,
             key=lambda item: item,
-            val=lambda item: item
+            val=lambda item: item,
+            index=None,
             ):
         """
         Searches [values] for 'lookup' for least-ambiguous matches,
         return the matching value as stored in [values].
 
+        index can be a NameIndex of the values, by key, so that only
+        values which could match are looked at.
+
         GIVEN [values] contains "bread", "water", "biscuits and "It",
         searching "ea" will return "bread", "WaT" will return "water"
         and "i" will return "biscuits".
@@ -2066,9 +3424,29 @@ class TradeDB(object):
         normTrans = TradeDB.normalizeTrans
         trimTrans = TradeDB.trimTrans
         needle = lookup.translate(normTrans).translate(trimTrans)
+        if index is not None:
+            try:
+                return val(index.values[index.exact[needle]])
+            except KeyError:
+                values = index.find(needle)
         partialMatch, wordMatch = [], []
-        # make a regex to match whole words
-        wordRe = re.compile(r'\b{}\b'.format(lookup), re.IGNORECASE)
+        # Whole word matches: keys that start with lookup, ignoring
+        # case, with a word boundary either side of it (as the regex
+        # r'\blookup\b' would match them) but without a regex.
+        lookupLen, lookupLower = len(lookup), lookup.lower()
+        isWordChar = lambda char: char.isalnum() or char == '_'
+
+        def isWordMatch(entryKey):
+            if not entryKey or not isWordChar(entryKey[0]):
+                return False
+            if entryKey[:lookupLen].lower() != lookupLower:
+                return False
+            wordBefore = lookupLen > 0 and isWordChar(entryKey[lookupLen - 1])
+            wordAfter = (
+                lookupLen < len(entryKey) and isWordChar(entryKey[lookupLen])
+            )
+            return wordBefore != wordAfter
+
         # describe a match
         for entry in values:
             entryKey = key(entry)
@@ -2078,7 +3456,7 @@ class TradeDB(object):
                 if len(normVal) == len(needle):
                     return val(entry)
                 match = ListSearchMatch(entryKey, val(entry))
-                if wordRe.match(entryKey):
+                if isWordMatch(entryKey):
                     wordMatch.append(match)
                 else:
                     partialMatch.append(match)